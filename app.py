@@ -3,7 +3,13 @@ import os
 from dotenv import load_dotenv
 from flask import Flask
 
-from src.db import init_db, sanitize_url
+from src.bitmap import init_bitmaps
+from src.cache import init_cache
+from src.db import REPLICA, init_db, sanitize_url
+from src.metrics import TimedQueuePool, init_metrics
+from src.recurrence import init_recurrence
+from src.replica import init_replica
+from src.sharding import init_sharding, shard_bind
 from src.routes import bp as api_routes
 
 
@@ -12,14 +18,65 @@ def create_app() -> Flask:
     load_dotenv()  # take environment variables from .env
 
     app.config['SQLALCHEMY_DATABASE_URI'] = sanitize_url(os.environ.get('DATABASE_URL'))
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql'):
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            # time pool checkouts for the metrics, labelled by bind
+            'poolclass': TimedQueuePool,
+            'pool_logging_name': 'primary',
+            # sized per worker by gunicorn_config.py
+            'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+            'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+            'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        }
+    binds = {}
+    # service reads go to the replica, see src/replica.py
+    if os.environ.get('DATABASE_REPLICA_URL'):
+        binds[REPLICA] = _bind(app, os.environ['DATABASE_REPLICA_URL'], REPLICA)
+    app.config['READ_YOUR_WRITES_SECONDS'] = float(os.environ.get('READ_YOUR_WRITES_SECONDS', 5))
+    # users are spread over DATABASE_URL, shard 0, and these databases, see src/sharding.py
+    shard_urls = [url.strip() for url in os.environ.get('DATABASE_SHARD_URLS', '').split(',') if url.strip()]
+    for shard, url in enumerate(shard_urls, start=1):
+        binds[shard_bind(shard)] = _bind(app, url, shard_bind(shard))
+    app.config['SHARDS'] = 1 + len(shard_urls)
+    app.config['SHARD_DIRECTORY_SECONDS'] = float(os.environ.get('SHARD_DIRECTORY_SECONDS', 10))
+    if binds:
+        app.config['SQLALCHEMY_BINDS'] = binds
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['USERS_PAGE_SIZE'] = int(os.environ.get('USERS_PAGE_SIZE', 100))
+    app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', 'none')
+    app.config['CACHE_MAX_ENTRIES'] = int(os.environ.get('CACHE_MAX_ENTRIES', 10000))
+    app.config['CACHE_TTL'] = int(os.environ.get('CACHE_TTL', 60))
+    app.config['REDIS_URL'] = os.environ.get('REDIS_URL')
+    # requires the migration in src/range_backend.py
+    app.config['AVAILABILITY_RANGE_BACKEND'] = os.environ.get('AVAILABILITY_RANGE_BACKEND', 'false').lower() == 'true'
+    # group searches on NumPy bitmaps, see src/bitmap.py
+    app.config['AVAILABILITY_BITMAPS'] = os.environ.get('AVAILABILITY_BITMAPS', 'false').lower() == 'true'
+    app.config['BITMAP_GRANULARITY'] = int(os.environ.get('BITMAP_GRANULARITY', 300))
+    app.config['BITMAP_MAX_USERS'] = int(os.environ.get('BITMAP_MAX_USERS', 1000))
+    # how far ahead recurring availability is expanded when a read has no end time
+    app.config['RECURRENCE_HORIZON_DAYS'] = int(os.environ.get('RECURRENCE_HORIZON_DAYS', 365))
     init_db(app)
+    init_cache(app)
+    init_replica(app)
+    init_sharding(app)
+    init_bitmaps(app)
+    init_recurrence(app)
+    app.config['SLOW_REQUEST_SECONDS'] = float(os.environ.get('SLOW_REQUEST_SECONDS', 1.0))
+    init_metrics(app)
 
     app.register_blueprint(api_routes, url_prefix='/api')
 
     return app
 
 
+def _bind(app: Flask, url: str, name: str) -> dict:
+    """ Engine config of a bind, with the primary's pool options under its own name. """
+    bind = {'url': sanitize_url(url)}
+    if bind['url'].startswith('postgresql'):
+        bind.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}), pool_logging_name=name)
+    return bind
+
+
 if __name__ == '__main__':
     app = create_app()
     app.run(debug=True, port=os.getenv('PORT', 5000))
\ No newline at end of file
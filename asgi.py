@@ -0,0 +1,163 @@
+# ASGI entry point for the read endpoints
+#
+# Serves GET /api/admin/users, /api/availability/<user_id> and /api/overlap on an event loop with async SQLAlchemy
+# (asyncpg), so a connection waiting on the database no longer holds a whole worker. Writes stay on the WSGI app,
+# route GETs of these paths here at the load balancer. With both running, use the redis cache backend so writes on the
+# WSGI side invalidate the entries read here. With DATABASE_REPLICA_URL set reads go to the replica, except those of
+# users the WSGI side wrote within the read-your-writes window, which redis shares too (see src/replica.py). It refuses
+# to start with DATABASE_SHARD_URLS set, its reads don't route to the users' shards.
+#
+# Requires the packages in requirements-asgi.txt, run with: uvicorn asgi:app --port 5002
+
+import asyncio
+import json
+import os
+from contextlib import asynccontextmanager
+
+from dotenv import load_dotenv
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from src import async_services, recurrence, replica
+from src.cache import configure_cache
+from src.db import sanitize_url
+
+MAX_PAGE_SIZE = 1000
+
+
+def async_database_url(url: str) -> str:
+    return make_url(sanitize_url(url)).set(drivername='postgresql+asyncpg').render_as_string(hide_password=False)
+
+
+load_dotenv()  # take environment variables from .env
+if os.environ.get('DATABASE_SHARD_URLS', '').strip(', '):
+    # the async services have no shard routing, they would only find the users of shard 0
+    raise RuntimeError("the ASGI app reads a single database, serve reads from the WSGI app with DATABASE_SHARD_URLS")
+engine = create_async_engine(async_database_url(os.environ.get('DATABASE_URL')),
+                             pool_size=int(os.environ.get('ASGI_POOL_SIZE', 10)),
+                             max_overflow=int(os.environ.get('ASGI_MAX_OVERFLOW', 10)))
+Session = async_sessionmaker(engine, expire_on_commit=False)
+ReplicaSession = Session
+if os.environ.get('DATABASE_REPLICA_URL'):
+    replica_engine = create_async_engine(async_database_url(os.environ['DATABASE_REPLICA_URL']),
+                                         pool_size=int(os.environ.get('ASGI_POOL_SIZE', 10)),
+                                         max_overflow=int(os.environ.get('ASGI_MAX_OVERFLOW', 10)))
+    ReplicaSession = async_sessionmaker(replica_engine, expire_on_commit=False)
+if os.environ.get('CACHE_BACKEND') == 'memory':
+    # writes run on the WSGI app, they would never invalidate an in-process cache here
+    raise RuntimeError("CACHE_BACKEND=memory can't be invalidated from the WSGI app, use redis (or none)")
+configure_cache(os.environ)
+replica.configure_replica(os.environ)
+recurrence.configure_recurrence(os.environ)
+
+
+@asynccontextmanager
+async def read_session(*user_ids: int):
+    """
+    A session on the replica, or on the primary while one of the users was written recently. The window is checked in a
+    thread, with redis it is a network round trip that would block the event loop.
+    """
+    primary = ReplicaSession is Session or (
+        bool(user_ids) and await asyncio.to_thread(replica.recent_writes.any, user_ids))
+    async with (Session() if primary else ReplicaSession()) as session:
+        yield session
+
+
+class ValidationError(Exception):
+    def __init__(self, name: str, message: str):
+        self.errors = {name: message}
+
+
+def int_param(request, name: str, required: bool = False):
+    value = request.query_params.get(name)
+    if value is None:
+        if required:
+            raise ValidationError(name, 'Missing required parameter in the query string')
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValidationError(name, f"invalid literal for int() with base 10: '{value}'")
+
+
+async def users(request):
+    if request.query_params.get('stream', '').lower() in ('true', '1', 'yes', 'on'):
+        return StreamingResponse(stream_users(), media_type='application/json')
+
+    after_id = int_param(request, 'after_id')
+    limit = int_param(request, 'limit')
+    limit = min(int(os.environ.get('USERS_PAGE_SIZE', 100)) if limit is None else limit, MAX_PAGE_SIZE)
+    if limit < 1:
+        return JSONResponse({"error": "limit must be positive"}, 400)
+
+    async with read_session() as session:
+        # fetch one extra row to know whether there is a next page
+        page = await async_services.get_users_page(session, after_id, limit + 1)
+    if len(page) > limit:
+        page = page[:limit]
+        return JSONResponse(page, headers={'X-Next-Cursor': str(page[-1]['id'])})
+    return JSONResponse(page)
+
+
+async def stream_users():
+    yield '['
+    separator = ''
+    async with read_session() as session:
+        async for batch in async_services.iter_users(session):
+            yield separator + ','.join(json.dumps(user) for user in batch)
+            separator = ','
+    yield ']'
+
+
+async def availability(request):
+    async with read_session(request.path_params['user_id']) as session:
+        slots = await async_services.get_availability(session, request.path_params['user_id'],
+                                                      int_param(request, 'start_time'), int_param(request, 'end_time'))
+    return JSONResponse(slots)
+
+
+async def overlap(request):
+    user1_id, user2_id = int_param(request, 'user1_id', required=True), int_param(request, 'user2_id', required=True)
+    start_time, end_time, limit = (int_param(request, name) for name in ('start_time', 'end_time', 'limit'))
+    after = int_param(request, 'after')
+    if after is not None:
+        start_time = after if start_time is None else max(start_time, after)
+    if start_time is not None and end_time is not None and end_time <= start_time:
+        return JSONResponse({"error": "end_time must be after start_time"}, 400)
+    if limit is not None and not 1 <= limit <= MAX_PAGE_SIZE:
+        return JSONResponse({"error": f"limit must be between 1 and {MAX_PAGE_SIZE}"}, 400)
+
+    async with read_session(user1_id, user2_id) as session:
+        # fetch one extra slot to know whether there is a next page
+        overlaps = await async_services.find_overlap(session, user1_id, user2_id, start_time, end_time,
+                                                     None if limit is None else limit + 1)
+    if limit is not None and len(overlaps) > limit:
+        overlaps = overlaps[:limit]
+        return JSONResponse(overlaps, headers={'X-Next-Cursor': str(overlaps[-1]['end_time'])})
+    return JSONResponse(overlaps)
+
+
+async def validation_error(request, exc: ValidationError):
+    return JSONResponse({'errors': exc.errors, 'message': 'Input payload validation failed'}, 400)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await engine.dispose()
+    if ReplicaSession is not Session:
+        await replica_engine.dispose()
+
+
+app = Starlette(
+    routes=[
+        Route('/api/admin/users', users),
+        Route('/api/availability/{user_id:int}', availability),
+        Route('/api/overlap', overlap),
+    ],
+    exception_handlers={ValidationError: validation_error},
+    lifespan=lifespan,
+)
@@ -0,0 +1,55 @@
+# Compare read throughput and memory per concurrent connection of the sync gunicorn stack and the ASGI entry point
+#
+# usage: BENCH_DATABASE_URL=postgresql://... python -m benchmarks.bench_asgi [concurrency levels...]
+# Needs gunicorn and the packages in requirements-asgi.txt.
+
+import random
+import sys
+
+from benchmarks.common import bench_app, http_load, process_tree_rss, start_server
+from benchmarks.datagen import Scale, generate
+
+SYNC_PORT, ASGI_PORT = 5101, 5102
+SYNC_WORKERS = 4
+
+
+def read_paths(scale: Scale, rng: random.Random) -> list:
+    paths = []
+    for _ in range(200):
+        user1_id, user2_id = rng.randint(1, scale.users), rng.randint(1, scale.users)
+        paths += [f'/api/availability/{user1_id}', f'/api/overlap?user1_id={user1_id}&user2_id={user2_id}',
+                  f'/api/admin/users?after_id={user1_id}&limit=50']
+    return paths
+
+
+def run(concurrency_levels, seconds: float = 10):
+    scale = Scale(1000, 50)
+    app = bench_app()
+    with app.app_context():
+        generate(scale)
+    paths = read_paths(scale, random.Random(42))
+
+    servers = {
+        f'gunicorn sync x{SYNC_WORKERS}': (['gunicorn', '-w', str(SYNC_WORKERS), '-b', f'127.0.0.1:{SYNC_PORT}',
+                                            'app:create_app()'], SYNC_PORT),
+        'uvicorn asgi x1': (['uvicorn', 'asgi:app', '--port', str(ASGI_PORT), '--no-access-log'], ASGI_PORT),
+    }
+
+    print(f"{'server':<18} {'conns':>5} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>6} {'RSS MiB':>8} "
+          f"{'MiB/conn':>8}")
+    for name, (command, port) in servers.items():
+        process, _ = start_server(command, port)
+        try:
+            for concurrency in concurrency_levels:
+                result = http_load(port, paths, concurrency, seconds)
+                memory = process_tree_rss(process.pid)
+                total = memory['parent'] + sum(memory['children'])
+                print(f"{name:<18} {concurrency:>5} {result['requests_per_second']:>8} {result['p50_ms']:>8} "
+                      f"{result['p99_ms']:>8} {result['errors']:>6} {total:>8.1f} {total / concurrency:>8.2f}")
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    run([int(arg) for arg in sys.argv[1:]] or [1, 10, 50, 100])
@@ -0,0 +1,85 @@
+# Availability writes per second of the single statement slot normalization against the ORM path
+#
+# Every user starts with a year of hour long slots every other hour. Writes are hour long slots at random half hours, so
+# most of them touch, overlap or bridge existing slots, and some are already covered and fail in both paths. The ORM
+# path is the one users with recurring rules take (check_availability, then merge_slots). Both paths start from the same
+# slots and run the same writes, and must leave the same, unfragmented, slots behind.
+#
+# usage: BENCH_DATABASE_URL=postgresql://... python -m benchmarks.bench_availability_writes [writes] [users]
+
+import random
+import sys
+import time
+
+from sqlalchemy import text
+
+from benchmarks.common import bench_app
+from src import compaction, services
+from src.models import Availability, db
+
+START = 2_000_000_000
+DAY = 86400
+
+SEED = [
+    "INSERT INTO users (id, name) SELECT n, 'bench' || n FROM generate_series(1, :users) n",
+    # a slot every other hour for a year
+    "INSERT INTO availabilities (user_id, start_time, end_time) SELECT u, :start + h * 7200, :start + h * 7200 + 3600 "
+    "FROM generate_series(1, :users) u, generate_series(0, 4379) h",
+    "ANALYZE",
+]
+
+
+def orm_write(user_id: int, start_time: int, end_time: int):
+    """ The write path of users with recurring rules. """
+    services._lock_users(user_id)
+    if services.check_availability(user_id, start_time, end_time):
+        db.session.rollback()
+        raise services.AvailabilityError("User is already available in the requested time")
+    if not services.merge_slots(user_id, end_time, start_time):
+        db.session.add(Availability(user_id=user_id, start_time=start_time, end_time=end_time))
+    db.session.commit()
+
+
+def timed(write, writes) -> tuple:
+    failed = 0
+    started = time.perf_counter()
+    for user_id, start_time, end_time in writes:
+        try:
+            write(user_id, start_time, end_time)
+        except services.AvailabilityError:
+            failed += 1
+    return len(writes) / (time.perf_counter() - started), failed
+
+
+def slots():
+    return db.session.query(Availability.user_id, Availability.start_time, Availability.end_time).order_by(
+        Availability.user_id, Availability.start_time).all()
+
+
+def run(num_writes: int, num_users: int):
+    app = bench_app()
+    rng = random.Random(42)
+    writes = [(rng.randint(1, num_users), START + rng.randrange(0, 365 * DAY, 1800)) for _ in range(num_writes)]
+    writes = [(user_id, start, start + 3600) for user_id, start in writes]
+
+    with app.app_context():
+        results = {}
+        for name, write in (('single statement', services.set_user_availability), ('orm', orm_write)):
+            db.session.execute(text("TRUNCATE availabilities, users CASCADE"))
+            for statement in SEED:
+                db.session.execute(text(statement), {'users': num_users, 'start': START})
+            db.session.commit()
+
+            rate, failed = timed(write, writes)
+            results[name] = slots()
+            print(f"{name:>17}: {rate:8.0f} writes/s, {failed} already available, {len(results[name])} slots, "
+                  f"{compaction.fragmented_slots()} fragmented")
+        assert results['single statement'] == results['orm']
+
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    run(*(args + [2000, 100][len(args):]))
@@ -0,0 +1,62 @@
+# Compare group searches on the interval sweep against NumPy bitmaps
+#
+# Times the common availability of 2, 10 and 100 users and the search for common slots of at least an hour, on the
+# interval path and on bitmaps, both cold (built from the database) and warm (held in memory).
+#
+# usage: BENCH_DATABASE_URL=postgresql://... python -m benchmarks.bench_bitmap [slots per user]
+
+import random
+import sys
+
+from benchmarks.bench_overlap import seed_slots
+from benchmarks.common import bench_app, measure
+from src import bitmap, services
+from src.models import User, db
+
+GROUP_SIZES = (2, 10, 100)
+
+# slots start on a 30 minute boundary, so bitmap and interval results are the same
+ALIGNED_START = 2_000_000_000 // 1800 * 1800
+
+
+def run(num_slots: int):
+    if bitmap.np is None:
+        sys.exit("numpy is not installed, see requirements-bitmap.txt")
+    app = bench_app()
+    rng = random.Random(42)
+
+    with app.app_context():
+        db.session.add_all([User(id=user_id, name=f'bench{user_id}') for user_id in range(1, max(GROUP_SIZES) + 1)])
+        for user_id in range(1, max(GROUP_SIZES) + 1):
+            seed_slots(user_id, num_slots, rng, ALIGNED_START)
+        db.session.commit()
+
+        print(f"{'users':>6} {'min duration':>12} {'intervals (ms)':>15} {'bitmap cold (ms)':>17} "
+              f"{'bitmap warm (ms)':>17} {'slots':>6}")
+        for size in GROUP_SIZES:
+            user_ids = list(range(1, size + 1))
+            for min_duration in (0, 3600):
+                def search():
+                    return services.find_group_overlap(user_ids, min_duration=min_duration)
+
+                app.config['AVAILABILITY_BITMAPS'] = False
+                expected = search()
+                intervals = measure(search, 10)
+
+                app.config['AVAILABILITY_BITMAPS'] = True
+
+                def cold():
+                    bitmap.configure_bitmaps(app.config)
+                    return search()
+
+                assert cold() == expected
+                cold_stats, warm_stats = measure(cold, 10), measure(search, 10)
+                print(f"{size:>6} {min_duration:>12} {intervals['median_ms']:>15.2f} {cold_stats['median_ms']:>17.2f} "
+                      f"{warm_stats['median_ms']:>17.2f} {len(expected):>6}")
+
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
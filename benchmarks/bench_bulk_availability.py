@@ -0,0 +1,58 @@
+# Compare availability ingestion throughput of the single slot path against the bulk path
+#
+# usage: BENCH_DATABASE_URL=postgresql://... python -m benchmarks.bench_bulk_availability [slot counts...]
+
+import random
+import sys
+import time
+
+from benchmarks.common import bench_app
+from src import services
+from src.models import Availability, User, db
+
+
+def generate_slots(num_slots: int, num_users: int, rng: random.Random):
+    """ Random one hour slots over the coming year, some of them consecutive or overlapping. """
+    slots = []
+    for _ in range(num_slots):
+        start = 2_000_000_000 + rng.randint(0, 365 * 24 * 2) * 1800
+        slots.append({'user_id': rng.randint(1, num_users), 'start_time': start, 'end_time': start + 3600})
+    return slots
+
+
+def run(slot_counts, num_users: int = 10):
+    app = bench_app()
+    rng = random.Random(42)
+    print(f"{'slots':>6} {'single (slots/s)':>17} {'bulk (slots/s)':>15} {'speedup':>8}")
+
+    with app.app_context():
+        db.session.add_all([User(id=user_id, name=f'bench{user_id}') for user_id in range(1, num_users + 1)])
+        db.session.commit()
+
+        for num_slots in slot_counts:
+            slots = generate_slots(num_slots, num_users, rng)
+
+            db.session.query(Availability).delete()
+            db.session.commit()
+            start = time.perf_counter()
+            for slot in slots:
+                try:
+                    services.set_user_availability(slot['user_id'], slot['start_time'], slot['end_time'])
+                except services.AvailabilityError:
+                    pass
+            single = num_slots / (time.perf_counter() - start)
+
+            db.session.query(Availability).delete()
+            db.session.commit()
+            start = time.perf_counter()
+            services.bulk_set_availability(slots)
+            bulk = num_slots / (time.perf_counter() - start)
+
+            print(f"{num_slots:>6} {single:>17.0f} {bulk:>15.0f} {bulk / single:>7.1f}x")
+
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    run([int(arg) for arg in sys.argv[1:]] or [100, 1000, 5000])
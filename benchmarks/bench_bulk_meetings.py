@@ -0,0 +1,75 @@
+# Compare meeting scheduling throughput of the single meeting path against the batch path
+#
+# Every user is available for the whole benchmark year and meetings are 30 minutes between random pairs of users. Both
+# paths start from the same availability and must schedule the same meetings, a conflicting one fails in both.
+#
+# usage: BENCH_DATABASE_URL=postgresql://... python -m benchmarks.bench_bulk_meetings [meeting counts...]
+
+import random
+import sys
+import time
+
+from benchmarks.common import bench_app
+from src import services
+from src.models import Availability, Meeting, MeetingParticipant, User, db
+
+START = 2_000_000_000
+YEAR = 365 * 86400
+
+
+def generate_meetings(num_meetings: int, num_users: int, rng: random.Random):
+    meetings = []
+    for _ in range(num_meetings):
+        user1_id, user2_id = rng.sample(range(1, num_users + 1), 2)
+        start = START + rng.randint(0, YEAR // 1800 - 1) * 1800
+        meetings.append({'user1_id': user1_id, 'user2_id': user2_id, 'meeting_start_time': start,
+                         'meeting_end_time': start + 1800})
+    return meetings
+
+
+def reset(num_users: int):
+    for model in (MeetingParticipant, Meeting, Availability):
+        db.session.query(model).delete()
+    db.session.add_all([Availability(user_id=user_id, start_time=START, end_time=START + YEAR)
+                        for user_id in range(1, num_users + 1)])
+    db.session.commit()
+
+
+def run(meeting_counts, num_users: int = 50):
+    app = bench_app()
+    rng = random.Random(42)
+    print(f"{'meetings':>8} {'scheduled':>9} {'single (meetings/s)':>20} {'batch (meetings/s)':>19} {'speedup':>8}")
+
+    with app.app_context():
+        db.session.add_all([User(id=user_id, name=f'bench{user_id}') for user_id in range(1, num_users + 1)])
+        db.session.commit()
+
+        for num_meetings in meeting_counts:
+            meetings = generate_meetings(num_meetings, num_users, rng)
+
+            reset(num_users)
+            scheduled = 0
+            start = time.perf_counter()
+            for meeting in meetings:
+                try:
+                    services.schedule_meeting(meeting['user1_id'], meeting['user2_id'], meeting['meeting_start_time'],
+                                              meeting['meeting_end_time'])
+                    scheduled += 1
+                except services.AvailabilityError:
+                    pass
+            single = num_meetings / (time.perf_counter() - start)
+
+            reset(num_users)
+            start = time.perf_counter()
+            results = services.bulk_schedule_meetings(meetings)
+            batch = num_meetings / (time.perf_counter() - start)
+            assert scheduled == sum(result['status'] == 'scheduled' for result in results)
+
+            print(f"{num_meetings:>8} {scheduled:>9} {single:>20.0f} {batch:>19.0f} {batch / single:>7.1f}x")
+
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    run([int(arg) for arg in sys.argv[1:]] or [100, 500, 1000])
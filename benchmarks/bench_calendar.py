@@ -0,0 +1,73 @@
+# Latency of a user's calendar as the meetings table grows to millions of rows
+#
+# Meetings between random pairs of users are generated in the database, one starting every minute, along with their
+# participant rows and daily availability for the first users. Times a week of one user's calendar (GET /api/calendar
+# through services.get_calendar) against the lookup the meetings table alone allows, an OR over user1_id/user2_id with
+# no index to serve it, and prints the plans of both.
+#
+# usage: BENCH_DATABASE_URL=postgresql://... python -m benchmarks.bench_calendar [meetings] [users]
+
+import sys
+
+from sqlalchemy import text
+
+from benchmarks.bench_range_backend import explain
+from benchmarks.common import bench_app, measure
+from src import services
+from src.models import db
+
+START = 1_700_000_000
+WEEK = 7 * 86400
+
+SEED = [
+    "INSERT INTO users (id, name) SELECT n, 'bench' || n FROM generate_series(1, :users) n",
+    # user pairs from a multiplicative hash of the meeting number, never the same user twice
+    "INSERT INTO meetings (id, user1_id, user2_id, meeting_time, end_time) "
+    "SELECT n, n % :users + 1, (n % :users + 1 + (n * 7919) % (:users - 1)) % :users + 1, "
+    ":start + n * 60, :start + n * 60 + 1800 FROM generate_series(1::bigint, :meetings) n",
+    "INSERT INTO meeting_participants (meeting_id, user_id, start_time, end_time) "
+    "SELECT id, user1_id, meeting_time, end_time FROM meetings "
+    "UNION ALL SELECT id, user2_id, meeting_time, end_time FROM meetings",
+    # availability from 9 to 17 every day for the first 100 users
+    "INSERT INTO availabilities (user_id, start_time, end_time) "
+    "SELECT u, :start + d * 86400 + 32400, :start + d * 86400 + 61200 "
+    "FROM generate_series(1, LEAST(:users, 100)) u, generate_series(0, (:meetings * 60) / 86400) d",
+    "ANALYZE",
+]
+
+OR_SCAN = text("SELECT id, meeting_time FROM meetings WHERE (user1_id = :user_id OR user2_id = :user_id) "
+               "AND meeting_time >= :start_time AND meeting_time < :end_time ORDER BY meeting_time")
+
+
+def run(num_meetings: int, num_users: int):
+    app = bench_app()
+
+    with app.app_context():
+        for statement in SEED:
+            db.session.execute(text(statement), {'users': num_users, 'meetings': num_meetings, 'start': START})
+        db.session.commit()
+
+        # a week in the middle of the generated range
+        week = (START + num_meetings * 30, START + num_meetings * 30 + WEEK)
+        calendar = services.get_calendar(1, *week)
+        params = {'user_id': 1, 'start_time': week[0], 'end_time': week[1]}
+        meetings = sum(entry['type'] == 'meeting' for entry in calendar)
+
+        indexed = measure(lambda: services.get_calendar(1, *week))
+        scanned = measure(lambda: db.session.execute(OR_SCAN, params).all())
+        print(f"{num_meetings} meetings, {num_users} users, {len(calendar)} calendar entries "
+              f"({meetings} meetings) in the week")
+        print(f"{'read':>28} {'median (ms)':>12} {'p95 (ms)':>9}")
+        print(f"{'calendar (participants)':>28} {indexed['median_ms']:>12.2f} {indexed['p95_ms']:>9.2f}")
+        print(f"{'meetings OR scan':>28} {scanned['median_ms']:>12.2f} {scanned['p95_ms']:>9.2f}")
+        # the meetings query is the last one of a calendar read
+        print(f"\ncalendar meetings plan:\n{explain(lambda: services.get_calendar(1, *week))}")
+        print(f"\nmeetings OR scan plan:\n{explain(lambda: db.session.execute(OR_SCAN, params))}")
+
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    run(*(args + [2_000_000, 10_000][len(args):]))
@@ -0,0 +1,88 @@
+# Time to first byte and memory of a multi-year free/busy export against the JSON availability read
+#
+# One user has two availability slots and a meeting every day for the given number of years. Reads the whole range
+# through GET /api/availability (one JSON list built in full) and streams it through GET /api/freebusy as NDJSON and
+# iCalendar, timing the first chunk and the whole body, and tracing the peak Python memory of each read.
+#
+# usage: BENCH_DATABASE_URL=postgresql://... python -m benchmarks.bench_freebusy [years...]
+
+import sys
+import time
+import tracemalloc
+
+from sqlalchemy import text
+
+from benchmarks.common import bench_app
+from src.models import db
+
+START = 1_500_000_000
+DAY = 86400
+
+SEED = [
+    "INSERT INTO users (id, name) VALUES (1, 'bench1'), (2, 'bench2')",
+    # 9:00 to 12:00 and 13:00 to 17:00, a meeting with user 2 in between
+    "INSERT INTO availabilities (user_id, start_time, end_time) "
+    "SELECT 1, :start + d * 86400 + s, :start + d * 86400 + e "
+    "FROM generate_series(0, :days - 1) d, (VALUES (32400, 43200), (46800, 61200)) slots(s, e)",
+    "INSERT INTO meetings (id, user1_id, user2_id, meeting_time, end_time) "
+    "SELECT d + 1, 1, 2, :start + d * 86400 + 43200, :start + d * 86400 + 46800 FROM generate_series(0, :days - 1) d",
+    "INSERT INTO meeting_participants (meeting_id, user_id, start_time, end_time) "
+    "SELECT id, user1_id, meeting_time, end_time FROM meetings "
+    "UNION ALL SELECT id, user2_id, meeting_time, end_time FROM meetings",
+    "ANALYZE",
+]
+
+
+def read(client, path: str) -> dict:
+    """ Seconds to the first chunk and to the whole body of a GET, and the body size. """
+    start = time.perf_counter()
+    response = client.get(path, buffered=False)
+    chunks = iter(response.response)
+    first = next(chunks, b'')
+    first_byte = time.perf_counter() - start
+    size = len(first) + sum(len(chunk) for chunk in chunks)
+    response.close()
+    return {'first_byte': first_byte, 'total': time.perf_counter() - start, 'bytes': size}
+
+
+def peak_memory(client, path: str) -> float:
+    """ Peak Python memory allocated while serving a GET, in MiB. """
+    tracemalloc.start()
+    read(client, path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 2 ** 20
+
+
+def run(years_list):
+    app = bench_app()
+    client = app.test_client()
+    print(f"{'years':>5} {'read':>13} {'first byte (ms)':>16} {'total (ms)':>11} {'MiB':>8} {'peak MiB':>9}")
+
+    with app.app_context():
+        for years in years_list:
+            days = years * 365
+            for table in ('meeting_participants', 'meetings', 'availabilities', 'users'):
+                db.session.execute(text(f"DELETE FROM {table}"))
+            for statement in SEED:
+                db.session.execute(text(statement), {'start': START, 'days': days})
+            db.session.commit()
+
+            end = START + days * DAY
+            paths = {'availability': f'/api/availability/1?start_time={START}&end_time={end}',
+                     'ndjson': f'/api/freebusy/1?start_time={START}&end_time={end}',
+                     'ics': f'/api/freebusy/1?start_time={START}&end_time={end}&format=ics'}
+            for name, path in paths.items():
+                # warm up, then time and trace separate reads, tracing slows allocation heavy code down
+                read(client, path)
+                timing = read(client, path)
+                peak = peak_memory(client, path)
+                print(f"{years:>5} {name:>13} {timing['first_byte'] * 1000:>16.1f} {timing['total'] * 1000:>11.1f} "
+                      f"{timing['bytes'] / 2 ** 20:>8.1f} {peak:>9.1f}")
+
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    run([int(arg) for arg in sys.argv[1:]] or [1, 5, 20])
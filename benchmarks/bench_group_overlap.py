@@ -0,0 +1,36 @@
+# Time the k-way group overlap for growing groups of users
+#
+# usage: BENCH_DATABASE_URL=postgresql://... python -m benchmarks.bench_group_overlap [slots per user]
+
+import random
+import sys
+
+from benchmarks.bench_overlap import seed_slots
+from benchmarks.common import bench_app, measure
+from src import services
+from src.models import User, db
+
+
+def run(num_slots: int, group_sizes=(2, 5, 10, 25, 50)):
+    app = bench_app()
+    rng = random.Random(42)
+
+    with app.app_context():
+        db.session.add_all([User(id=user_id, name=f'bench{user_id}') for user_id in range(1, max(group_sizes) + 1)])
+        for user_id in range(1, max(group_sizes) + 1):
+            seed_slots(user_id, num_slots, rng)
+        db.session.commit()
+
+        print(f"{'users':>6} {'slots/user':>10} {'median (ms)':>12} {'p95 (ms)':>9} {'common slots':>13}")
+        for size in group_sizes:
+            user_ids = list(range(1, size + 1))
+            stats = measure(lambda: services.find_group_overlap(user_ids), repeat=10)
+            common = len(services.find_group_overlap(user_ids))
+            print(f"{size:>6} {num_slots:>10} {stats['median_ms']:>12.2f} {stats['p95_ms']:>9.2f} {common:>13}")
+
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
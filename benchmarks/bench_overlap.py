@@ -0,0 +1,68 @@
+# Compare the sweep line overlap engine against the SQL cross join it replaced
+#
+# usage: BENCH_DATABASE_URL=postgresql://... python -m benchmarks.bench_overlap [slot counts...]
+
+import random
+import sys
+
+from sqlalchemy import text
+
+from benchmarks.common import bench_app, measure
+from src import services
+from src.models import Availability, User, db
+
+SQL_JOIN = """
+    SELECT
+        GREATEST(a1.start_time, a2.start_time) AS overlap_start,
+        LEAST(a1.end_time, a2.end_time) AS overlap_end
+    FROM availabilities a1
+    JOIN availabilities a2 ON a1.user_id = :user1_id AND a2.user_id = :user2_id
+    WHERE GREATEST(a1.start_time, a2.start_time) < LEAST(a1.end_time, a2.end_time)
+"""
+
+
+def seed_slots(user_id: int, num_slots: int, rng: random.Random, start: int = 2_000_000_000):
+    """ Non overlapping slots of 30 to 120 minutes, spread over the coming years. """
+    rows = []
+    for _ in range(num_slots):
+        start += rng.randint(0, 4) * 1800
+        end = start + rng.randint(1, 4) * 1800
+        rows.append({'user_id': user_id, 'start_time': start, 'end_time': end})
+        start = end + 1800
+    db.session.execute(Availability.__table__.insert(), rows)
+
+
+def run(slot_counts):
+    app = bench_app()
+    rng = random.Random(42)
+    print(f"{'slots/user':>10} {'sql join (ms)':>14} {'sweep (ms)':>11} {'speedup':>8}")
+
+    with app.app_context():
+        db.session.add_all([User(id=1, name='bench1'), User(id=2, name='bench2')])
+        db.session.commit()
+
+        for num_slots in slot_counts:
+            db.session.query(Availability).delete()
+            seed_slots(1, num_slots, rng)
+            seed_slots(2, num_slots, rng)
+            db.session.commit()
+
+            def sql_join():
+                return db.session.execute(text(SQL_JOIN), {'user1_id': 1, 'user2_id': 2}).all()
+
+            def sweep():
+                return services.find_overlap(1, 2)
+
+            assert sorted(tuple(row) for row in sql_join()) == [(s['start_time'], s['end_time']) for s in sweep()]
+
+            repeat = 5 if num_slots >= 5000 else 20
+            joined, swept = measure(sql_join, repeat), measure(sweep, repeat)
+            speedup = joined['median_ms'] / swept['median_ms']
+            print(f"{num_slots:>10} {joined['median_ms']:>14.2f} {swept['median_ms']:>11.2f} {speedup:>7.1f}x")
+
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    run([int(arg) for arg in sys.argv[1:]] or [10, 100, 1000, 5000])
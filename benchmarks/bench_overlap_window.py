@@ -0,0 +1,59 @@
+# Overlap of a bounded time window as the calendars' history grows
+#
+# Times the full overlap of two users against the overlap of the last week of their calendars and against the first
+# page (limit 50) of everything from that week on. The windowed reads are range scans of the (user_id, start_time)
+# index, so their latency should stay flat while the full overlap grows with the history. Prints the plan of the
+# windowed read at the largest size.
+#
+# usage: BENCH_DATABASE_URL=postgresql://... python -m benchmarks.bench_overlap_window [slot counts...]
+
+import random
+import sys
+
+from sqlalchemy import func, select
+
+from benchmarks.bench_overlap import seed_slots
+from benchmarks.bench_range_backend import explain
+from benchmarks.common import bench_app, measure
+from src import services
+from src.models import Availability, User, db
+
+WEEK = 7 * 86400
+# early enough for 50k slots per user to stay within the int4 columns
+HISTORY_START = 1_000_000_000
+
+
+def run(slot_counts):
+    app = bench_app()
+    rng = random.Random(42)
+    print(f"{'slots/user':>10} {'full (ms)':>10} {'week (ms)':>10} {'page of 50 (ms)':>16}")
+
+    with app.app_context():
+        db.session.add_all([User(id=1, name='bench1'), User(id=2, name='bench2')])
+        db.session.commit()
+
+        for num_slots in slot_counts:
+            db.session.query(Availability).delete()
+            seed_slots(1, num_slots, rng, HISTORY_START)
+            seed_slots(2, num_slots, rng, HISTORY_START)
+            db.session.commit()
+            db.session.execute(db.text("ANALYZE availabilities"))
+
+            # the calendars end at different times, take the last week both cover
+            last = min(db.session.scalars(select(func.max(Availability.end_time)).group_by(Availability.user_id)))
+            week = (last - WEEK, last)
+            assert services.find_overlap(1, 2, *week)
+
+            full = measure(lambda: services.find_overlap(1, 2))
+            windowed = measure(lambda: services.find_overlap(1, 2, *week))
+            page = measure(lambda: services.find_overlap(1, 2, week[0], None, 50))
+            print(f"{num_slots:>10} {full['median_ms']:>10.2f} {windowed['median_ms']:>10.2f} "
+                  f"{page['median_ms']:>16.2f}")
+
+        print(f"\nwindowed read plan:\n{explain(lambda: services.find_overlap(1, 2, *week))}")
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    run([int(arg) for arg in sys.argv[1:]] or [1000, 10000, 50000])
@@ -0,0 +1,89 @@
+# Compare availability lookups on the start_time/end_time columns against the int8range column and its GiST index
+#
+# Times check_availability and the slot merge of a new availability on the same data, before and after the migration
+# in src/range_backend.py, and prints the plan the availability check ran with in both modes.
+#
+# usage: BENCH_DATABASE_URL=postgresql://... python -m benchmarks.bench_range_backend [users] [slots per user]
+
+import random
+import sys
+
+from sqlalchemy import event
+
+from benchmarks.bench_overlap import seed_slots
+from benchmarks.common import bench_app, measure
+from src import range_backend, services
+from src.models import Availability, User, db
+
+
+def explain(fn) -> str:
+    """ Run fn and return the plan of the last statement it executed. """
+    executed = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        executed.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', capture)
+    try:
+        fn()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', capture)
+
+    statement, parameters = executed[-1]
+    rows = db.session.connection().exec_driver_sql(f"EXPLAIN (ANALYZE, COSTS OFF) {statement}", parameters)
+    return '\n'.join(f"    {row[0]}" for row in rows)
+
+
+def run(num_users: int, num_slots: int):
+    app = bench_app()
+    rng = random.Random(42)
+
+    with app.app_context():
+        if not range_backend.is_available():
+            sys.exit("btree_gist extension is not installed on the benchmark server")
+
+        db.session.add_all([User(id=user_id, name=f'bench{user_id}') for user_id in range(1, num_users + 1)])
+        for user_id in range(1, num_users + 1):
+            seed_slots(user_id, num_slots, rng)
+        db.session.commit()
+        db.session.execute(db.text("ANALYZE availabilities"))
+
+        # a slot in the middle of the first user's calendar, a request inside it and a new slot bridging its neighbours
+        slots = db.session.query(Availability).filter_by(user_id=1).order_by(Availability.start_time).all()
+        middle, following = slots[len(slots) // 2], slots[len(slots) // 2 + 1]
+        inside = (middle.start_time, middle.end_time)
+        bridge = (middle.end_time - 1, following.start_time + 1)
+
+        def check():
+            return services.check_availability(1, *inside)
+
+        def merge():
+            services.merge_slots(1, bridge[1], bridge[0])
+            db.session.rollback()
+
+        results = {}
+        for mode in ('columns', 'range'):
+            if mode == 'range':
+                range_backend.migrate()
+                db.session.execute(db.text("ANALYZE availabilities"))
+                app.config['AVAILABILITY_RANGE_BACKEND'] = True
+
+            assert check()
+            results[mode] = {'check': measure(check), 'merge': measure(merge)}
+            print(f"check_availability plan ({mode}):\n{explain(check)}\n")
+            db.session.rollback()
+
+        print(f"{num_users} users x {num_slots} slots")
+        print(f"{'operation':>10} {'columns (ms)':>13} {'range (ms)':>11} {'speedup':>8}")
+        for operation in ('check', 'merge'):
+            columns, ranged = results['columns'][operation], results['range'][operation]
+            speedup = columns['median_ms'] / ranged['median_ms']
+            print(f"{operation:>10} {columns['median_ms']:>13.2f} {ranged['median_ms']:>11.2f} {speedup:>7.1f}x")
+
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    run(*(args or [200, 1000]))
@@ -0,0 +1,71 @@
+# Compare recurring availability rules against the same availability materialized as one row per day
+#
+# Every user is available on weekdays from 9 to 17 for a year, half of them through materialized rows and half through
+# a single rule. Prints the storage of both (tables with their indexes) and the latency of a month of availability,
+# the overlap of two users and an availability check.
+#
+# usage: BENCH_DATABASE_URL=postgresql://... python -m benchmarks.bench_recurrence [users per mode]
+
+import sys
+import time
+
+from sqlalchemy import text
+
+from benchmarks.common import bench_app, measure
+from src import services
+from src.models import Availability, AvailabilityRule, User, db
+from src.recurrence import DAY, configure_recurrence, occurrences
+
+WEEKDAYS = 0b0011111
+# a Monday, far enough ahead to stay valid
+START = 2_000_419_200
+END = START + 364 * DAY
+
+
+def table_size(table: str) -> int:
+    return db.session.execute(text("SELECT pg_total_relation_size(:table)"), {'table': table}).scalar()
+
+
+def run(num_users: int):
+    app = bench_app()
+    # unbounded reads expand rules this far from now, cover the whole benchmark year
+    configure_recurrence({'RECURRENCE_HORIZON_DAYS': (END - int(time.time())) // DAY + 1})
+
+    with app.app_context():
+        db.session.add_all([User(id=user_id, name=f'bench{user_id}') for user_id in range(1, 2 * num_users + 1)])
+        db.session.commit()
+        rules = [AvailabilityRule(user_id=num_users + user_id, weekdays=WEEKDAYS, start_offset=9 * 3600,
+                                  end_offset=17 * 3600, timezone='UTC', valid_from=START, valid_until=END)
+                 for user_id in range(1, num_users + 1)]
+        db.session.add_all(rules)
+
+        days = list(occurrences(rules[0], START, END))
+        db.session.execute(Availability.__table__.insert(), [
+            {'user_id': user_id, 'start_time': start, 'end_time': end}
+            for user_id in range(1, num_users + 1) for start, end in days])
+        db.session.commit()
+        db.session.execute(text("ANALYZE"))
+
+        materialized = table_size('availabilities')
+        recurring = table_size('availability_rules') + table_size('availability_exceptions')
+        print(f"{num_users} users per mode, {len(days)} days each")
+        print(f"storage: materialized {materialized / 1024:.0f} KiB, rules {recurring / 1024:.0f} KiB")
+
+        month = (START + 90 * DAY, START + 120 * DAY)
+        meeting = (days[100][0] + 3600, days[100][0] + 7200)
+        print(f"{'operation':>18} {'materialized (ms)':>18} {'rules (ms)':>11}")
+        for name, operation in [
+            ('month', lambda first: services.get_availability(first, *month)),
+            ('overlap', lambda first: services.find_overlap(first, first + 1)),
+            ('check_availability', lambda first: services.check_availability(first, *meeting)),
+        ]:
+            assert operation(1) == operation(num_users + 1)
+            rows, ruled = measure(lambda: operation(1)), measure(lambda: operation(num_users + 1))
+            print(f"{name:>18} {rows['median_ms']:>18.2f} {ruled['median_ms']:>11.2f}")
+
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
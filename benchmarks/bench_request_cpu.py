@@ -0,0 +1,60 @@
+# Per request CPU cost of the hot read endpoints
+#
+# Requests are handed straight to the WSGI app, without a server or the test client, against a warm cache, so what is
+# measured is the framework side of a request: routing, argument parsing, hooks and JSON serialization. Set
+# BENCH_CACHE_BACKEND=none to include the queries.
+#
+# usage: BENCH_DATABASE_URL=postgresql://... python -m benchmarks.bench_request_cpu [requests] [slots per user]
+
+import os
+import random
+import sys
+import time
+
+from werkzeug.test import EnvironBuilder
+
+from benchmarks.bench_overlap import seed_slots
+from benchmarks.common import bench_app
+from src.models import User, db
+
+
+def run(num_requests: int, num_slots: int):
+    os.environ.setdefault('BENCH_CACHE_BACKEND', 'memory')
+    app = bench_app()
+    rng = random.Random(42)
+
+    with app.app_context():
+        db.session.add_all([User(id=1, name='bench1'), User(id=2, name='bench2')])
+        db.session.commit()
+        seed_slots(1, num_slots, rng)
+        seed_slots(2, num_slots, rng)
+        db.session.commit()
+        db.session.remove()
+
+    paths = ['/api/availability/1', '/api/availability/1?start_time=2000000000&end_time=2100000000',
+             '/api/overlap?user1_id=1&user2_id=2']
+    print(f"{'path':<64} {'cpu/request (us)':>17} {'requests/s':>11}")
+    for path in paths:
+        environ = EnvironBuilder(path=path).get_environ()
+
+        def request():
+            statuses = []
+            body = b''.join(app.wsgi_app(dict(environ), lambda status, headers: statuses.append(status)))
+            return statuses[0], body
+
+        for _ in range(50):
+            assert request()[0] == '200 OK'
+
+        cpu_started, wall_started = time.process_time(), time.perf_counter()
+        for _ in range(num_requests):
+            request()
+        cpu, wall = time.process_time() - cpu_started, time.perf_counter() - wall_started
+        print(f"{path:<64} {cpu / num_requests * 1e6:>17.0f} {num_requests / wall:>11.0f}")
+
+    with app.app_context():
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    run(*(args + [2000, 200][len(args):]))
@@ -0,0 +1,72 @@
+# Compare gunicorn serving profiles: startup time, memory per worker and throughput
+#
+# usage: BENCH_DATABASE_URL=postgresql://... python -m benchmarks.bench_serving [concurrency]
+# The gevent profile is skipped unless gevent and psycogreen are installed.
+
+import http.client
+import importlib.util
+import random
+import sys
+import time
+
+from benchmarks.bench_asgi import read_paths
+from benchmarks.common import bench_app, http_load, process_tree_rss, start_server
+from benchmarks.datagen import Scale, generate
+
+PORT = 5103
+WORKERS = 4
+
+PROFILES = {
+    'sync': {'GUNICORN_WORKER_CLASS': 'sync', 'GUNICORN_PRELOAD': 'false'},
+    'sync + preload': {'GUNICORN_WORKER_CLASS': 'sync'},
+    'gthread x4 + preload': {'GUNICORN_WORKER_CLASS': 'gthread', 'GUNICORN_THREADS': '4'},
+    'gevent x100 + preload': {'GUNICORN_WORKER_CLASS': 'gevent', 'GUNICORN_WORKER_CONNECTIONS': '100'},
+}
+
+
+def wait_until_serving(timeout: float = 60):
+    """ The master listens before the app is loaded, so wait for an actual response. """
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', PORT, timeout=1)
+            connection.request('GET', '/api/admin/users?limit=1')
+            if connection.getresponse().status == 200:
+                return
+        except (OSError, http.client.HTTPException):
+            time.sleep(0.05)
+    raise RuntimeError("gunicorn did not start serving")
+
+
+def run(concurrency: int, seconds: float = 10):
+    scale = Scale(1000, 50)
+    app = bench_app()
+    with app.app_context():
+        generate(scale)
+    paths = read_paths(scale, random.Random(42))
+    has_gevent = importlib.util.find_spec('gevent') and importlib.util.find_spec('psycogreen')
+
+    print(f"{'profile':<22} {'startup s':>9} {'PSS MiB/worker':>14} {'RSS MiB/worker':>14} {'req/s':>8} {'p99 ms':>8}")
+    for name, env in PROFILES.items():
+        if env['GUNICORN_WORKER_CLASS'] == 'gevent' and not has_gevent:
+            print(f"{name:<22} skipped, gevent and psycogreen are not installed")
+            continue
+
+        started = time.perf_counter()
+        process, _ = start_server(['gunicorn', '-c', 'gunicorn_config.py', 'app:create_app()'], PORT,
+                                  env={**env, 'PORT': str(PORT), 'GUNICORN_WORKERS': str(WORKERS)})
+        try:
+            wait_until_serving()
+            startup = time.perf_counter() - started
+            result = http_load(PORT, paths, concurrency, seconds)
+            pss = process_tree_rss(process.pid, 'Pss')['children']
+            rss = process_tree_rss(process.pid)['children']
+            print(f"{name:<22} {startup:>9.2f} {sum(pss) / len(pss):>14.1f} {sum(rss) / len(rss):>14.1f} "
+                  f"{result['requests_per_second']:>8} {result['p99_ms']:>8}")
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 16)
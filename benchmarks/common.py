@@ -0,0 +1,134 @@
+# Shared helpers for the benchmark scripts
+#
+# Benchmarks drop and recreate every table, so they run against BENCH_DATABASE_URL (a scratch database) and refuse to
+# run without it.
+
+import os
+import statistics
+import sys
+import time
+from typing import Callable
+
+
+def bench_app():
+    """ Create the app against the scratch benchmark database, with empty tables. """
+    url = os.environ.get('BENCH_DATABASE_URL')
+    if not url:
+        sys.exit("BENCH_DATABASE_URL is not set, benchmarks need a scratch database")
+    os.environ['DATABASE_URL'] = url
+    # measure the database path unless a benchmark asks for the cache explicitly
+    os.environ['CACHE_BACKEND'] = os.environ.get('BENCH_CACHE_BACKEND', 'none')
+
+    from app import create_app
+    from src.models import db
+
+    app = create_app()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    return app
+
+
+def measure(fn: Callable, repeat: int = 20) -> dict:
+    """ Call fn repeat times and return timing stats in milliseconds. """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+    return {
+        'min_ms': round(timings[0], 3),
+        'median_ms': round(statistics.median(timings), 3),
+        'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3),
+    }
+
+
+def start_server(command: list, port: int, env: dict = None, timeout: float = 30):
+    """ Start a server process and wait until it accepts connections. Returns the process and its startup time. """
+    import socket
+    import subprocess
+
+    started = time.perf_counter()
+    process = subprocess.Popen(command, env={**os.environ, **(env or {})}, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    while time.perf_counter() - started < timeout:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            return process, time.perf_counter() - started
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError(f"{command[0]} exited with status {process.returncode}")
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f"{command[0]} did not start listening on {port}")
+
+
+def process_tree_rss(pid: int, field: str = 'Rss') -> dict:
+    """
+    Resident memory in MiB of a process and each of its children, read from /proc (Linux only). Pass field='Pss' to
+    split pages shared between processes (e.g. copy-on-write after a fork) among them.
+    """
+
+    def rss(process_id: int) -> float:
+        with open(f'/proc/{process_id}/smaps_rollup') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+        return 0.0
+
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        children = []
+    return {'parent': rss(pid), 'children': [rss(child) for child in children]}
+
+
+def http_load(port: int, paths: list, concurrency: int, seconds: float) -> dict:
+    """
+    Keep concurrency keep-alive connections busy with GET requests cycling through paths for a number of seconds.
+    Returns requests per second, error count and latency percentiles.
+    """
+    import http.client
+    import threading
+
+    deadline = time.perf_counter() + seconds
+    latencies, errors, lock = [], [0], threading.Lock()
+
+    def client(offset: int):
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        local, failed, index = [], 0, offset
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                connection.request('GET', paths[index % len(paths)])
+                response = connection.getresponse()
+                response.read()
+                if response.status >= 400:
+                    failed += 1
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            local.append(time.perf_counter() - started)
+            index += 1
+        connection.close()
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client, args=(offset,)) for offset in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    return {
+        'requests_per_second': round(len(latencies) / seconds, 1),
+        'errors': errors[0],
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2) if latencies else None,
+        'p99_ms': round(latencies[int(len(latencies) * 0.99)] * 1000, 2) if latencies else None,
+    }
@@ -0,0 +1,37 @@
+# Compare two benchmark result files and flag regressions
+#
+# usage: python -m benchmarks.compare baseline.json candidate.json [--threshold 0.2]
+# Exits with status 1 when any median got slower than the threshold allows.
+
+import argparse
+import json
+import sys
+
+
+def load(path: str) -> dict:
+    with open(path) as f:
+        report = json.load(f)
+    return {(scale['scale'], name): stats for scale in report['scales'] for name, stats in scale['results'].items()}
+
+
+def compare(baseline: dict, candidate: dict, threshold: float) -> list:
+    regressions = []
+    for key in sorted(baseline.keys() & candidate.keys()):
+        before, after = baseline[key]['median_ms'], candidate[key]['median_ms']
+        change = (after - before) / before if before else 0.0
+        flag = 'REGRESSION' if change > threshold else ''
+        print(f"{key[0]:>12} {key[1]:<34} {before:>9.3f} -> {after:>9.3f} ms {change:>+8.1%} {flag}")
+        if flag:
+            regressions.append(key)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown of the median, 0.2 is 20%%')
+    args = parser.parse_args()
+
+    if compare(load(args.baseline), load(args.candidate), args.threshold):
+        sys.exit(1)
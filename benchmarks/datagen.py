@@ -0,0 +1,102 @@
+# Synthetic dataset generator for benchmarks
+#
+# Generates users with non overlapping availability slots over a time horizon:
+# - density is the share of the horizon each user is available for
+# - overlap_ratio is the share of each user's slots copied from a shared team calendar, the rest are placed at random,
+#   so a higher ratio means more overlap between any two users
+#
+# usage: BENCH_DATABASE_URL=postgresql://... python -m benchmarks.datagen --users 1000 --slots 100
+
+import argparse
+import random
+import time
+from dataclasses import dataclass
+
+from src.intervals import coalesce
+from src.models import Availability, User, db
+
+HORIZON_START = 2_000_000_000
+BATCH_SIZE = 10000
+
+
+@dataclass
+class Scale:
+    users: int
+    slots_per_user: int
+    density: float = 0.3
+    overlap_ratio: float = 0.5
+    slot_length: int = 3600
+
+    @classmethod
+    def parse(cls, spec: str) -> 'Scale':
+        """ Parse a scale spec like 1000x100 (users x slots per user). """
+        users, slots = spec.lower().split('x')
+        return cls(int(users), int(slots))
+
+    @property
+    def horizon(self) -> int:
+        """ Length of time the slots are spread over, so they cover density of it. """
+        return int(self.slots_per_user * self.slot_length / self.density)
+
+    def __str__(self):
+        return f"{self.users}x{self.slots_per_user}"
+
+
+def user_slots(scale: Scale, team_slots: list, rng: random.Random) -> list:
+    """
+    Sorted slots of one user, a share of them taken from the team calendar. Consecutive cells are coalesced into one
+    slot, the way the availability endpoints store them.
+    """
+    shared = rng.sample(team_slots, int(len(team_slots) * scale.overlap_ratio))
+    taken = {start // scale.slot_length for start in shared}
+    grid = scale.horizon // scale.slot_length
+    while len(taken) < scale.slots_per_user:
+        taken.add(rng.randrange(grid))
+
+    return list(coalesce((HORIZON_START + cell * scale.slot_length, HORIZON_START + (cell + 1) * scale.slot_length)
+                         for cell in sorted(taken)))
+
+
+def generate(scale: Scale, seed: int = 42) -> int:
+    """ Fill empty users and availabilities tables with a dataset at the given scale. Returns the number of slots. """
+    rng = random.Random(seed)
+    grid = scale.horizon // scale.slot_length
+    team_slots = [cell * scale.slot_length for cell in rng.sample(range(grid), scale.slots_per_user)]
+
+    users = User.__table__.insert()
+    slots = Availability.__table__.insert()
+    rows, total = [], 0
+    for first_id in range(1, scale.users + 1, BATCH_SIZE):
+        last_id = min(first_id + BATCH_SIZE, scale.users + 1)
+        db.session.execute(users, [{'id': user_id, 'name': f'user{user_id}'} for user_id in range(first_id, last_id)])
+
+        for user_id in range(first_id, last_id):
+            rows.extend({'user_id': user_id, 'start_time': start, 'end_time': end}
+                        for start, end in user_slots(scale, team_slots, rng))
+            if len(rows) >= BATCH_SIZE:
+                db.session.execute(slots, rows)
+                total += len(rows)
+                rows = []
+
+    if rows:
+        db.session.execute(slots, rows)
+        total += len(rows)
+    db.session.commit()
+    return total
+
+
+if __name__ == '__main__':
+    from benchmarks.common import bench_app
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--slots', type=int, default=100, help='slots per user')
+    parser.add_argument('--density', type=float, default=0.3)
+    parser.add_argument('--overlap-ratio', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    with bench_app().app_context():
+        started = time.perf_counter()
+        count = generate(Scale(args.users, args.slots, args.density, args.overlap_ratio), args.seed)
+        print(f"Generated {args.users} users and {count} slots in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,97 @@
+# Multi-threaded booking load test
+#
+# Every thread books 30 minute meetings between random pairs of a small pool of users, so bookings contend for the
+# same users and slots. Reports bookings per second, the share of requests rejected because the slot was already taken
+# and the number of transactions retried after a serialization conflict, then checks nobody was double booked.
+#
+# usage: BENCH_DATABASE_URL=postgresql://... python -m benchmarks.load_booking [thread counts...]
+
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+from benchmarks.common import bench_app
+from src import services
+from src.api_exceptions import AvailabilityError
+from src.models import Availability, Meeting, MeetingParticipant, User, db
+
+NUM_USERS = 20
+DAY_START = 2_000_000_000
+MEETING_LENGTH = 1800
+SLOTS_PER_DAY = 24 * 3600 // MEETING_LENGTH
+
+
+def reset(app):
+    with app.app_context():
+        for model in (MeetingParticipant, Meeting, Availability):
+            db.session.query(model).delete()
+        db.session.add_all([Availability(user_id=user_id, start_time=DAY_START, end_time=DAY_START + 24 * 3600)
+                            for user_id in range(1, NUM_USERS + 1)])
+        db.session.commit()
+
+
+def worker(app, seed: int, bookings: int, outcomes: Counter, lock: threading.Lock):
+    rng = random.Random(seed)
+    local = Counter()
+    with app.app_context():
+        for _ in range(bookings):
+            user1_id, user2_id = rng.sample(range(1, NUM_USERS + 1), 2)
+            start = DAY_START + rng.randrange(SLOTS_PER_DAY) * MEETING_LENGTH
+            try:
+                services.schedule_meeting(user1_id, user2_id, start, start + MEETING_LENGTH)
+                local['booked'] += 1
+            except AvailabilityError:
+                local['slot_taken'] += 1
+            except Exception:
+                local['failed'] += 1
+        db.session.remove()
+
+    with lock:
+        outcomes.update(local)
+
+
+def double_bookings(app) -> int:
+    with app.app_context():
+        starts = defaultdict(list)
+        for user1_id, user2_id, meeting_time in db.session.query(Meeting.user1_id, Meeting.user2_id,
+                                                                 Meeting.meeting_time):
+            starts[user1_id].append(meeting_time)
+            starts[user2_id].append(meeting_time)
+        return sum(len(times) - len(set(times)) for times in starts.values())
+
+
+def run(thread_counts, bookings_per_thread: int = 50):
+    app = bench_app()
+    with app.app_context():
+        db.session.add_all([User(id=user_id, name=f'bench{user_id}') for user_id in range(1, NUM_USERS + 1)])
+        db.session.commit()
+
+    print(f"{'threads':>7} {'bookings/s':>11} {'booked':>7} {'slot taken':>11} {'failed':>7} {'retries':>8} "
+          f"{'double booked':>14}")
+    for threads in thread_counts:
+        reset(app)
+        services.retry_stats.clear()
+        outcomes, lock = Counter(), threading.Lock()
+        workers = [threading.Thread(target=worker, args=(app, seed, bookings_per_thread, outcomes, lock))
+                   for seed in range(threads)]
+
+        start = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        total = threads * bookings_per_thread
+        print(f"{threads:>7} {outcomes['booked'] / elapsed:>11.1f} {outcomes['booked']:>7} "
+              f"{outcomes['slot_taken'] / total:>10.1%} {outcomes['failed']:>7} {services.retry_stats['retries']:>8} "
+              f"{double_bookings(app):>14}")
+
+    with app.app_context():
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    run([int(arg) for arg in sys.argv[1:]] or [1, 2, 4, 8, 16])
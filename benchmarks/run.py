@@ -0,0 +1,157 @@
+# Benchmark suite: times every service function and HTTP endpoint at several dataset scales
+#
+# Results are written as JSON so runs on two commits can be compared with benchmarks.compare.
+#
+# usage: BENCH_DATABASE_URL=postgresql://... python -m benchmarks.run --scales 100x10 1000x100 --output results.json
+
+import argparse
+import json
+import platform
+import random
+import subprocess
+import time
+
+from benchmarks.common import bench_app, measure
+from benchmarks.datagen import HORIZON_START, Scale, generate
+from src import services
+from src.api_exceptions import AvailabilityError
+from src.models import db
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def reset(app):
+    # recreated rather than emptied, so tables added later (participants, rules, exceptions) can't block the next scale
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+
+def writes(scale: Scale, rng: random.Random):
+    """ Arguments for fresh writes: slots past the end of the generated horizon, one per call. """
+    cursor = HORIZON_START + scale.horizon + 3600
+    while True:
+        cursor += 7200
+        yield rng.randint(1, scale.users), cursor, cursor + 3600
+
+
+def meeting_times(scale: Scale, count: int, rng: random.Random):
+    """
+    Arguments for count meetings between pairs of users with a common slot, picked up front so finding them is not
+    timed. No user is booked twice, so every meeting stays schedulable.
+    """
+    meetings, booked = [], set()
+    while len(meetings) < count and len(booked) < scale.users - 1:
+        user1_id, user2_id = rng.sample(range(1, scale.users + 1), 2)
+        overlap = services.find_overlap(user1_id, user2_id)
+        if overlap and not booked & {user1_id, user2_id}:
+            slot = rng.choice(overlap)
+            meetings.append((user1_id, user2_id, slot['start_time'], slot['end_time']))
+            booked.update((user1_id, user2_id))
+    return iter(meetings)
+
+
+def bench_services(scale: Scale, repeat: int, rng: random.Random) -> dict:
+    def random_user():
+        return rng.randint(1, scale.users)
+
+    def random_time():
+        return HORIZON_START + rng.randrange(scale.horizon)
+
+    new_slots, meetings = writes(scale, rng), meeting_times(scale, repeat, rng)
+
+    def set_user_availability():
+        try:
+            services.set_user_availability(*next(new_slots))
+        except AvailabilityError:
+            pass
+
+    def schedule_meeting():
+        services.schedule_meeting(*next(meetings))
+
+    return {
+        'get_availability': measure(lambda: services.get_availability(random_user(), None, None), repeat),
+        'get_availability_window': measure(
+            lambda: services.get_availability(random_user(), random_time(), random_time() + 7 * 86400), repeat),
+        'find_overlap': measure(lambda: services.find_overlap(random_user(), random_user()), repeat),
+        'check_availability': measure(
+            lambda: services.check_availability(random_user(), random_time(), random_time() + 1800), repeat),
+        'set_user_availability': measure(set_user_availability, repeat),
+        'schedule_meeting': measure(schedule_meeting, repeat),
+    }
+
+
+def bench_http(app, scale: Scale, repeat: int, rng: random.Random) -> dict:
+    client = app.test_client()
+    new_slots = writes(scale, rng)
+    with app.app_context():
+        meetings = meeting_times(scale, repeat, rng)
+
+    def user():
+        return rng.randint(1, scale.users)
+
+    def post_availability():
+        user_id, start, end = next(new_slots)
+        client.post(f'/api/availability/{user_id}', json={'start_time': start, 'end_time': end})
+
+    def post_meeting():
+        user1_id, user2_id, start, end = next(meetings)
+        client.post('/api/meeting', json={'user1_id': user1_id, 'user2_id': user2_id, 'meeting_start_time': start,
+                                          'meeting_end_time': end})
+
+    return {
+        'GET /api/admin/users': measure(lambda: client.get('/api/admin/users'), repeat),
+        'GET /api/availability/<user_id>': measure(lambda: client.get(f'/api/availability/{user()}'), repeat),
+        'GET /api/overlap': measure(lambda: client.get(f'/api/overlap?user1_id={user()}&user2_id={user()}'), repeat),
+        'POST /api/availability/<user_id>': measure(post_availability, repeat),
+        'POST /api/meeting': measure(post_meeting, repeat),
+    }
+
+
+def run(scales, repeat: int, seed: int) -> dict:
+    app = bench_app()
+    report = {
+        'revision': git_revision(),
+        'timestamp': int(time.time()),
+        'python': platform.python_version(),
+        'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0],
+        'repeat': repeat,
+        'scales': [],
+    }
+
+    for scale in scales:
+        reset(app)
+        rng = random.Random(seed)
+        with app.app_context():
+            slots = generate(scale, seed)
+            results = bench_services(scale, repeat, rng)
+            db.session.remove()
+        results.update(bench_http(app, scale, repeat, rng))
+
+        report['scales'].append({'scale': str(scale), 'users': scale.users, 'slots_per_user': scale.slots_per_user,
+                                 'slots': slots, 'results': results})
+        for name, stats in results.items():
+            print(f"{str(scale):>12} {name:<34} median {stats['median_ms']:>9.3f} ms  p95 {stats['p95_ms']:>9.3f} ms")
+
+    with app.app_context():
+        db.drop_all()
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', nargs='+', default=['100x10', '1000x100'], help='users x slots per user')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default='bench_results.json')
+    args = parser.parse_args()
+
+    report = run([Scale.parse(scale) for scale in args.scales], args.repeat, args.seed)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
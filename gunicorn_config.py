@@ -1,10 +1,29 @@
 import multiprocessing
 import os
 
+from dotenv import load_dotenv
+
 # Gunicorn configuration settings
 
+load_dotenv()  # the settings below, and the app's, may come from .env
+
+# Worker class: sync (default), gthread or gevent (requires gevent and psycogreen)
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
+
 # Number of worker processes
-workers = multiprocessing.cpu_count() * 2 + 1
+workers = int(os.getenv("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+
+# The memory cache lives in each worker, a write would only invalidate the entries of the worker that served it
+if os.getenv("CACHE_BACKEND") == "memory" and workers > 1:
+    raise RuntimeError("CACHE_BACKEND=memory is per process, use redis (or none) with more than one worker")
+
+# Threads per worker for gthread, concurrent connections per worker for gevent
+threads = int(os.getenv("GUNICORN_THREADS", 4 if worker_class == "gthread" else 1))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", 100))
+
+# Load the app once in the master and fork it into the workers, so imports, swagger and engine setup are not repeated
+# per worker and their memory is shared copy-on-write
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
 
 # Gunicorn timeout setting
 timeout = 30
@@ -18,3 +37,37 @@ loglevel = 'info'
 # Enable access and error logs
 accesslog = '-'
 errorlog = '-'
+
+
+def pool_settings(max_connections: int) -> tuple:
+    """
+    Size each worker's connection pool so all workers together stay within max_connections: a worker gets as many
+    pooled connections as it serves requests concurrently, and whatever is left of its share as overflow.
+    """
+    concurrency = {"gthread": threads, "gevent": worker_connections}.get(worker_class, 1)
+    share = max(1, max_connections // workers)
+    pool_size = min(concurrency, share)
+    return pool_size, share - pool_size
+
+
+# Total connections all workers may open, keep it below the server's max_connections minus other clients
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", 90))
+pool_size, max_overflow = pool_settings(DB_MAX_CONNECTIONS)
+os.environ.setdefault("DB_POOL_SIZE", str(pool_size))
+os.environ.setdefault("DB_MAX_OVERFLOW", str(max_overflow))
+
+
+def post_fork(server, worker):
+    if worker_class == "gevent":
+        from psycogreen.gevent import patch_psycopg
+
+        patch_psycopg()
+
+    if preload_app:
+        # connections opened in the master must not be shared with the forked workers, drop them without closing
+        from src.db import db
+
+        app = server.app.wsgi()
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
@@ -1,32 +1,57 @@
+import argparse
+import csv
+import io
 import random
+import time
+from multiprocessing import Pool
 
 from dotenv import load_dotenv
 from faker import Faker
 from datetime import datetime, timedelta
 
 from app import create_app
+from src.compaction import coalesce_slots
 from src.models import db, User, Availability
+from sqlalchemy import create_engine, func, text
 from sqlalchemy_utils import create_database, database_exists, get_tables
 
 fake = Faker()
 
+# users are generated in blocks with their own random stream, so the data only depends on the seed and not on how the
+# blocks are split between worker processes
+BLOCK_SIZE = 1000
+SLOT_UNIT = 1800  # slots start and end on half hours
+
+
+def prepare_database(app):
+    if app.config['SHARDS'] > 1:
+        # seeded users would all land on shard 0, and the fast seed takes its ids from shard 0 alone
+        raise RuntimeError("seed.py loads one database: seed shard 0 with DATABASE_SHARD_URLS unset, then spread the "
+                           "users with python -m src.sharding rebalance")
+    database_uri = app.config['SQLALCHEMY_DATABASE_URI']
+    database_name = database_uri.split("/")[-1]
+
+    if not database_exists(database_uri):
+        create_database(database_uri)
+        print(f"Created database: {database_name}")
+    else:
+        print(f"Database {database_name} already exists")
+
+    # create all tables
+    db.create_all()
+
+
+def normalize_slots():
+    """ Merge the seeded slots that overlap or touch, single statement availability writes assume there are none. """
+    if db.engine.dialect.name == 'postgresql':
+        print(f"Merged {coalesce_slots()} overlapping or touching slots.")
+
 
 def seed_users_and_availability(num_users=10, num_slots_per_user=5):
     app = create_app()
     load_dotenv()  # take environment variables from .env
     with app.app_context():
-
-        database_uri = app.config['SQLALCHEMY_DATABASE_URI']
-        database_name = database_uri.split("/")[-1]
-
-        if not database_exists(database_uri):
-            create_database(database_uri)
-            print(f"Created database: {database_name}")
-        else:
-            print(f"Database {database_name} already exists")
-
-        # create all tables
-        db.create_all()
+        prepare_database(app)
 
         # Create users
         for _ in range(num_users):
@@ -51,9 +76,105 @@ def seed_users_and_availability(num_users=10, num_slots_per_user=5):
         # Commit all changes to the database
         db.session.commit()
         print(f"Seeded {num_users} users with {num_slots_per_user} availability slots each.")
+        normalize_slots()
+
+
+def generate_block(block: int, first_id: int, last_id: int, num_slots_per_user: int, seed: int, start_epoch: int,
+                   names: list):
+    """
+    Rows of the users in [first_id, last_id) and their availability: non overlapping slots of 30 minutes to 2 hours,
+    placed one after the other with random gaps from start_epoch on.
+    """
+    rng = random.Random(f"{seed}:{block}")
+    users, slots = [], []
+    for user_id in range(first_id, last_id):
+        users.append((user_id, rng.choice(names)))
+        cursor = start_epoch + rng.randrange(48) * SLOT_UNIT
+        for _ in range(num_slots_per_user):
+            start = cursor + rng.randint(1, 16) * SLOT_UNIT
+            cursor = start + rng.randint(1, 4) * SLOT_UNIT
+            slots.append((user_id, start, cursor))
+    return users, slots
+
+
+def copy_rows(connection, table: str, columns: tuple, rows: list):
+    """ Load rows with Postgres COPY, or a single executemany insert on other databases. """
+    if connection.dialect.name == 'postgresql':
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        with connection.connection.cursor() as cursor:
+            cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    else:
+        placeholders = ', '.join(f':{column}' for column in columns)
+        connection.execute(text(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})"),
+                           [dict(zip(columns, row)) for row in rows])
+
+
+def load_partition(args: tuple) -> int:
+    """ Worker: generate and load a range of user blocks on its own connection. Returns the number of rows loaded. """
+    database_uri, blocks, first_user_id, num_users, num_slots_per_user, seed, start_epoch, names = args
+    engine = create_engine(database_uri)
+    loaded = 0
+    with engine.begin() as connection:
+        for block in blocks:
+            first_id = first_user_id + block * BLOCK_SIZE
+            last_id = min(first_id + BLOCK_SIZE, first_user_id + num_users)
+            users, slots = generate_block(block, first_id, last_id, num_slots_per_user, seed, start_epoch, names)
+            copy_rows(connection, 'users', ('id', 'name'), users)
+            copy_rows(connection, 'availabilities', ('user_id', 'start_time', 'end_time'), slots)
+            loaded += len(users) + len(slots)
+    engine.dispose()
+    return loaded
+
+
+def fast_seed(num_users: int, num_slots_per_user: int, workers: int, seed: int):
+    """
+    Bulk seeding for large datasets: rows are generated in blocks, loaded with COPY (executemany off Postgres) and the
+    user id space is split across worker processes. Output is deterministic for a given seed.
+    """
+    app = create_app()
+    with app.app_context():
+        prepare_database(app)
+        database_uri = db.engine.url.render_as_string(hide_password=False)
+        first_user_id = (db.session.query(func.max(User.id)).scalar() or 0) + 1
+
+    Faker.seed(seed)
+    names = [fake.user_name() for _ in range(1000)]
+    # a fixed start (2030-01-01 UTC) rather than now, so a seed always yields the same timestamps
+    start_epoch = 1893456000
 
+    num_blocks = (num_users + BLOCK_SIZE - 1) // BLOCK_SIZE
+    partitions = [list(range(worker, num_blocks, workers)) for worker in range(workers)]
+    jobs = [(database_uri, blocks, first_user_id, num_users, num_slots_per_user, seed, start_epoch, names)
+            for blocks in partitions if blocks]
+
+    started = time.perf_counter()
+    with Pool(len(jobs)) as pool:
+        rows = sum(pool.map(load_partition, jobs))
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        # ids were set explicitly, move the sequence past them
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute(text("SELECT setval(pg_get_serial_sequence('users', 'id'), (SELECT max(id) FROM users))"))
+            db.session.commit()
+        normalize_slots()
 
+    print(f"Seeded {num_users} users with {num_slots_per_user} availability slots each: "
+          f"{rows} rows in {elapsed:.1f}s ({rows / elapsed:,.0f} rows/sec) using {len(jobs)} workers.")
 
 
 if __name__ == '__main__':
-    seed_users_and_availability()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--slots', type=int, default=5, help='availability slots per user')
+    parser.add_argument('--fast', action='store_true', help='bulk load with COPY across worker processes')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    if args.fast:
+        fast_seed(args.users, args.slots, args.workers, args.seed)
+    else:
+        seed_users_and_availability(args.users, args.slots)
@@ -0,0 +1,82 @@
+# Async read path for the ASGI entry point (asgi.py)
+#
+# Runs the queries and interval logic of src/services.py on an async session, and shares its cache entries. The cache
+# is called from a thread, a redis backend makes network round trips that would block the event loop.
+
+import asyncio
+from itertools import islice
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src import recurrence
+from src.cache import MISSING, cache
+from src.intervals import clip, intersect
+from src.models import User
+from src.recurrence import with_recurring
+from src.services import as_slots, as_users, availability_query, availability_window_query, users_page_query
+
+
+async def get_users_page(session: AsyncSession, after_id: Optional[int], limit: int) -> List[dict]:
+    return as_users(await session.execute(users_page_query(after_id, limit)))
+
+
+async def iter_users(session: AsyncSession, batch_size: int = 1000) -> AsyncIterator[List[dict]]:
+    """ Stream all users sorted by id in batches, from a server side cursor. """
+    result = await session.stream(select(User.id, User.name).order_by(User.id).execution_options(yield_per=batch_size))
+    async for batch in result.partitions():
+        yield as_users(batch)
+
+
+async def get_availability(session: AsyncSession, user_id: int, start_time: Optional[int],
+                           end_time: Optional[int]) -> List[dict]:
+    key, availability = await lookup('availability', [user_id], (start_time, end_time))
+    if availability is MISSING:
+        slots = await session.execute(availability_query(user_id, start_time, end_time))
+        recurring = (await recurring_slots(session, [user_id], start_time, end_time)).get(user_id)
+        if recurring is not None:
+            slots = recurrence.within(with_recurring(slots, recurring), start_time, end_time)
+        availability = as_slots(slots)
+        await store(key, availability)
+    return availability
+
+
+async def find_overlap(session: AsyncSession, user1_id: int, user2_id: int, start_time: Optional[int] = None,
+                       end_time: Optional[int] = None, limit: Optional[int] = None) -> List[dict]:
+    key, overlaps = await lookup('overlap', sorted((user1_id, user2_id)), (start_time, end_time, limit))
+    if overlaps is MISSING:
+        recurring = await recurring_slots(session, [user1_id, user2_id], start_time, end_time)
+        slots1, slots2 = [
+            with_recurring(await session.execute(availability_window_query(user_id, start_time, end_time)),
+                           recurring.get(user_id)) for user_id in (user1_id, user2_id)]
+        overlaps = as_slots(islice(clip(intersect(slots1, slots2), start_time, end_time), limit))
+        await store(key, overlaps)
+    return overlaps
+
+
+async def lookup(kind: str, user_ids: List[int], params: tuple) -> Tuple[Optional[str], object]:
+    """ cache.lookup off the event loop. """
+    if cache.backend is None:
+        return None, MISSING
+    return await asyncio.to_thread(cache.lookup, kind, user_ids, params)
+
+
+async def store(key: Optional[str], value):
+    """ cache.store off the event loop. """
+    if cache.backend is not None and key is not None:
+        await asyncio.to_thread(cache.store, key, value)
+
+
+async def recurring_slots(session: AsyncSession, user_ids: Iterable[int], start_time: Optional[int] = None,
+                          end_time: Optional[int] = None) -> Dict[int, Iterator[tuple]]:
+    """ recurrence.recurring_slots on an async session. """
+    rules = (await session.execute(recurrence.rules_query(user_ids))).all()
+    if not rules:
+        return {}
+
+    start_time, end_time = recurrence.expansion_range(start_time, end_time, recurrence.horizon_days)
+    exceptions = await session.execute(recurrence.exceptions_query({rule.user_id for rule in rules}, start_time,
+                                                                   end_time))
+    # the async reads answer with whole lists, not streams, the exceptions are fetched at once in start time order
+    return recurrence.expand(rules, exceptions.all(), start_time, end_time)
@@ -0,0 +1,170 @@
+# Bitmap availability for group searches
+#
+# Each user's availability is held as a bit array with one bit per cell of BITMAP_GRANULARITY seconds, covering whole
+# days from the user's first slot to their last. Intersecting a group is then an AND of the users' arrays over the
+# searched window and finding the free periods is a run length pass over the result, both vectorized with NumPy, so
+# the cost depends on the window length instead of on how fragmented the calendars are.
+#
+# A cell is set only when a slot covers all of it, so bitmap results are the exact ones rounded inwards to the cell
+# boundaries. Bitmaps are built from the availabilities table on first use and rebuilt after a write to the user, the
+# same generations that expire the cache (src/cache.py) tell when they are stale.
+#
+# NumPy is optional (requirements-bitmap.txt), without it AVAILABILITY_BITMAPS has no effect.
+
+import threading
+from collections import OrderedDict
+from itertools import groupby
+from typing import List, Mapping, Optional, Sequence, Tuple
+
+from flask import current_app
+
+from src.cache import cache
+from src.models import Availability, db
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DAY = 86400
+
+Interval = Tuple[int, int]
+
+
+class UserBitmap:
+    """ Availability of one user as packed bits, one per cell, starting at the cell origin (the start of a day). """
+
+    def __init__(self, origin: int, bits):
+        self.origin = origin
+        self.bits = bits
+
+    @classmethod
+    def from_slots(cls, slots: Sequence[Interval], granularity: int) -> 'UserBitmap':
+        starts = -(-np.array([start for start, _ in slots], dtype=np.int64) // granularity)
+        ends = np.array([end for _, end in slots], dtype=np.int64) // granularity
+        covering = starts < ends
+        if not covering.any():
+            return cls(0, np.zeros(0, dtype=np.uint8))
+        starts, ends = starts[covering], ends[covering]
+
+        cells_per_day = DAY // granularity
+        origin = int(starts.min()) // cells_per_day * cells_per_day
+        size = -(-(int(ends.max()) - origin) // cells_per_day) * cells_per_day
+
+        # +1 where a slot starts, -1 where it ends, a cell is covered while the running sum is positive
+        edges = np.zeros(size + 1, dtype=np.int32)
+        np.add.at(edges, starts - origin, 1)
+        np.add.at(edges, ends - origin, -1)
+        return cls(origin, np.packbits(np.cumsum(edges[:-1]) > 0))
+
+    @property
+    def end(self) -> int:
+        return self.origin + len(self.bits) * 8
+
+    def window(self, first: int, last: int):
+        """ Boolean array of the cells first (inclusive) to last (exclusive), cells outside the bitmap are unset. """
+        cells = np.zeros(last - first, dtype=bool)
+        low, high = max(first, self.origin) - self.origin, min(last, self.end) - self.origin
+        if low < high:
+            # unpack only the bytes holding the window
+            unpacked = np.unpackbits(self.bits[low // 8:-(-high // 8)])
+            cells[low + self.origin - first:high + self.origin - first] = unpacked[low % 8:low % 8 + high - low]
+        return cells
+
+
+class BitmapStore:
+    """ Per process LRU of user bitmaps, each kept with the cache generation of the user it was built at. """
+
+    def __init__(self, granularity: int = 300, max_users: int = 1000):
+        self._lock = threading.Lock()
+        self.reset(granularity, max_users)
+
+    def reset(self, granularity: int, max_users: int):
+        """ Drop every bitmap and start over at the given granularity. """
+        if DAY % (granularity * 8):
+            raise ValueError("BITMAP_GRANULARITY must split a day into a multiple of 8 cells")
+        with self._lock:
+            self.granularity = granularity
+            self.max_users = max_users
+            self._bitmaps = OrderedDict()
+            self._generations = {}
+
+    def get(self, user_ids: Sequence[int]) -> List[Optional[UserBitmap]]:
+        """ Bitmaps of the given users, None for a user without availability. Missing or stale ones are loaded. """
+        # read the generations before the rows, a write in between then only costs a rebuild on the next read
+        generations = dict(zip(user_ids, self.generations(user_ids)))
+        with self._lock:
+            found = {user_id: self._bitmaps[user_id][1] for user_id in user_ids
+                     if user_id in self._bitmaps and self._bitmaps[user_id][0] == generations[user_id]}
+            for user_id in found:
+                self._bitmaps.move_to_end(user_id)
+
+        missing = [user_id for user_id in user_ids if user_id not in found]
+        if missing:
+            rows = db.session.query(Availability.user_id, Availability.start_time, Availability.end_time).filter(
+                Availability.user_id.in_(missing)).order_by(Availability.user_id).all()
+            loaded = {user_id: UserBitmap.from_slots([(start, end) for _, start, end in slots], self.granularity)
+                      for user_id, slots in groupby(rows, key=lambda row: row[0])}
+            with self._lock:
+                for user_id in missing:
+                    found[user_id] = loaded.get(user_id)
+                    self._bitmaps[user_id] = (generations[user_id], found[user_id])
+                    self._bitmaps.move_to_end(user_id)
+                while len(self._bitmaps) > self.max_users:
+                    self._bitmaps.popitem(last=False)
+
+        return [found[user_id] for user_id in user_ids]
+
+    def generations(self, user_ids: Sequence[int]) -> List[int]:
+        # shared with the cache when there is one, so writes in other workers are seen too
+        if cache.backend is not None:
+            return cache.backend.generations([str(user_id) for user_id in user_ids])
+        with self._lock:
+            return [self._generations.get(user_id, 0) for user_id in user_ids]
+
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+
+    def __len__(self):
+        return len(self._bitmaps)
+
+
+def free_periods(bitmaps: Sequence[UserBitmap], granularity: int, start_time: int, end_time: int,
+                 min_duration: int = 0) -> List[Interval]:
+    """
+    Periods within [start_time, end_time) in which every bitmap is set, at least min_duration seconds long and sorted
+    by start time.
+    """
+    first, last = -(-start_time // granularity), end_time // granularity
+    if first >= last:
+        return []
+
+    common = bitmaps[0].window(first, last)
+    for bitmap in bitmaps[1:]:
+        common &= bitmap.window(first, last)
+        if not common.any():
+            return []
+
+    # runs of set cells start where the padded array steps up and end where it steps down
+    steps = np.flatnonzero(np.diff(common, prepend=False, append=False))
+    starts, ends = steps[::2], steps[1::2]
+    long_enough = (ends - starts) * granularity >= max(min_duration, 1)
+    return [(int(first + start) * granularity, int(first + end) * granularity)
+            for start, end in zip(starts[long_enough], ends[long_enough])]
+
+
+bitmaps = BitmapStore()
+
+
+def is_enabled() -> bool:
+    return np is not None and bool(current_app.config.get('AVAILABILITY_BITMAPS'))
+
+
+def init_bitmaps(app):
+    configure_bitmaps(app.config)
+
+
+def configure_bitmaps(config: Mapping):
+    """ Reset the module level store with BITMAP_GRANULARITY (seconds per cell) and BITMAP_MAX_USERS. """
+    bitmaps.reset(int(config.get('BITMAP_GRANULARITY', 300)), int(config.get('BITMAP_MAX_USERS', 1000)))
@@ -0,0 +1,169 @@
+# Read-through cache for availability and overlap queries
+#
+# Entries are keyed by the users they were computed from along with a per user generation number. A write bumps the
+# user's generation, which makes every entry computed from the old data unreachable at once (they age out through LRU
+# eviction or their TTL), so invalidation is exact without tracking which keys belong to which user.
+#
+# Generations are only shared by the processes sharing a backend. The memory backend is for a single process: with
+# several workers, a write would only invalidate the entries of the worker that served it, so it is off by default and
+# refused by gunicorn_config.py with more than one worker.
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Iterable, List, Mapping, Optional, Tuple
+
+MISSING = object()
+
+
+class MemoryBackend:
+    """
+    In-process backend, for a single process: a bounded LRU with a TTL per entry. Generations are kept apart so they
+    are never evicted.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: int = 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def generations(self, names: List[str]) -> List[int]:
+        with self._lock:
+            return [self._generations.get(name, 0) for name in names]
+
+    def bump(self, name: str):
+        with self._lock:
+            self._generations[name] = self._generations.get(name, 0) + 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisBackend:
+    """
+    Shared backend for all workers, on any client with the redis-py get/set/mget/incr interface, so a local redis (or
+    an in-process stand-in such as fakeredis) can replace the production one. Size is bounded by the server's
+    maxmemory with a volatile-lru policy: entries carry a TTL and get evicted, generations don't and never are.
+    """
+
+    def __init__(self, client, ttl: int = 60, prefix: str = 'calendly:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key: str):
+        value = self.client.get(self.prefix + key)
+        return MISSING if value is None else json.loads(value)
+
+    def set(self, key: str, value):
+        self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+    def generations(self, names: List[str]) -> List[int]:
+        return [int(value or 0) for value in self.client.mget([self.prefix + 'gen:' + name for name in names])]
+
+    def bump(self, name: str):
+        self.client.incr(self.prefix + 'gen:' + name)
+
+
+class Cache:
+    """ Read-through cache in front of a backend, counting hits and misses. A cache without a backend is disabled. """
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        # lookups run on every request thread
+        self._stats_lock = threading.Lock()
+
+    def get_or_load(self, kind: str, user_ids: Iterable[int], params: tuple, loader: Callable):
+        """ Return the cached value of a query over the given users, running loader to fill it on a miss. """
+        key, value = self.lookup(kind, user_ids, params)
+        if value is MISSING:
+            value = loader()
+            self.store(key, value)
+        return value
+
+    def lookup(self, kind: str, user_ids: Iterable[int], params: tuple) -> Tuple[Optional[str], object]:
+        """ Return the key of a query over the given users along with its cached value, or MISSING. """
+        if self.backend is None:
+            return None, MISSING
+
+        user_ids = list(user_ids)
+        generations = self.backend.generations([str(user_id) for user_id in user_ids])
+        users = ','.join(f'{user_id}.{generation}' for user_id, generation in zip(user_ids, generations))
+        key = f"{kind}:{users}:{':'.join(str(param) for param in params)}"
+
+        value = self.backend.get(key)
+        with self._stats_lock:
+            if value is MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return key, value
+
+    def store(self, key: Optional[str], value):
+        if self.backend is not None and key is not None:
+            self.backend.set(key, value)
+
+    def invalidate_user(self, user_id: int):
+        """ Drop every cached entry computed from the user's availability. """
+        if self.backend is not None:
+            self.backend.bump(str(user_id))
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {'hits': hits, 'misses': misses, 'hit_ratio': hits / lookups if lookups else 0.0}
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.hits = self.misses = 0
+
+
+cache = Cache()
+
+
+def init_cache(app, backend: Optional[object] = None):
+    configure_cache(app.config, backend)
+
+
+def configure_cache(config: Mapping, backend: Optional[object] = None):
+    """
+    Configure the module level cache: CACHE_BACKEND is one of none (default), redis or memory (a single process only),
+    with CACHE_MAX_ENTRIES, CACHE_TTL and REDIS_URL.
+    """
+    kind = config.get('CACHE_BACKEND', 'none')
+    ttl = int(config.get('CACHE_TTL', 60))
+
+    if backend is None and kind == 'memory':
+        backend = MemoryBackend(max_entries=int(config.get('CACHE_MAX_ENTRIES', 10000)), ttl=ttl)
+    elif backend is None and kind == 'redis':
+        import redis
+
+        backend = RedisBackend(redis.Redis.from_url(config['REDIS_URL']), ttl=ttl)
+
+    cache.backend = backend
+    cache.reset_stats()
@@ -0,0 +1,167 @@
+# Compaction of expired availability
+#
+# Availability can't be set in the past, so slots (and recurring rule exceptions) that ended before now are never read
+# by a scheduling decision again, they only grow the tables and their indexes. The job deletes them in small batches,
+# each its own short transaction on rows locked with SKIP LOCKED, so it never holds locks long or waits behind a
+# booking. Slots can be moved to the availabilities_archive table instead of being dropped.
+#
+# Deleted rows leave free space in the indexes that later inserts reuse, but the indexes only shrink once rebuilt, which
+# --reindex does without blocking writes (REINDEX CONCURRENTLY, Postgres).
+#
+# Writes keep each user's slots apart, merging a new slot with every slot it overlaps or touches. The job counts the
+# slots that still overlap or touch an earlier one (older writes left some behind) and --coalesce merges them. The
+# single statement write of set_user_availability relies on slots being apart, so `make migrate` runs
+# --coalesce --no-purge once per release, before the new code serves writes.
+#
+# usage: python -m src.compaction [--before TIMESTAMP] [--batch-size N] [--archive] [--reindex] [--coalesce]
+#                                 [--no-purge]
+
+import argparse
+import logging
+import time
+from collections import Counter
+from typing import Dict, Optional
+
+from sqlalchemy import delete, insert, inspect, select, text
+
+from src import bitmap, range_backend
+from src.cache import cache
+from src.models import ArchivedAvailability, Availability, AvailabilityException, db
+
+BATCH_SIZE = 1000
+COMPACTED_TABLES = (Availability, AvailabilityException)
+
+# slots overlapping or touching an earlier slot of the same user, which a write would have merged
+FRAGMENTED_SLOTS = text("""
+    SELECT count(*) FROM (
+        SELECT start_time, max(end_time) OVER (
+            PARTITION BY user_id ORDER BY start_time, id ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) AS reach
+        FROM availabilities
+    ) slots WHERE start_time <= reach
+""")
+
+logger = logging.getLogger(__name__)
+
+# rows removed and archived per table since the process started, exported on /metrics
+compaction_stats = Counter()
+# index sizes in bytes of the compacted tables, as measured before and after the last run
+last_index_bytes: Dict[str, Dict[str, int]] = {}
+# fragmented slots left after the last run
+last_fragmented_slots: Optional[int] = None
+
+
+def index_bytes() -> Dict[str, int]:
+    """ Total size of the indexes of every compacted table, in bytes. Postgres only, empty elsewhere. """
+    if db.engine.dialect.name != 'postgresql':
+        return {}
+    return {model.__tablename__: db.session.execute(text("SELECT pg_indexes_size(:table)"),
+                                                    {'table': model.__tablename__}).scalar()
+            for model in COMPACTED_TABLES}
+
+
+def fragmented_slots() -> int:
+    """ Number of slots that overlap or touch an earlier slot of their user, one scan of the availabilities table. """
+    return db.session.execute(FRAGMENTED_SLOTS).scalar()
+
+
+def coalesce_slots() -> int:
+    """ Merge every user's overlapping or touching slots and commit. Postgres only. Returns the rows merged away. """
+    user_ids = db.session.execute(text(range_backend.COALESCE_SLOTS)).scalars().all()
+    db.session.commit()
+    for user_id in set(user_ids):
+        cache.invalidate_user(user_id)
+        bitmap.bitmaps.invalidate_user(user_id)
+    return len(user_ids)
+
+
+def purge_batch(model, before: int, batch_size: int, archive: bool = False) -> int:
+    """
+    Delete up to batch_size rows of model that ended at or before the cutoff and commit, moving availability rows to
+    the archive when asked. Returns the number of rows deleted.
+    """
+    expired = select(model.id).where(model.end_time <= before).limit(batch_size).with_for_update(skip_locked=True)
+    rows = db.session.execute(delete(model).where(model.id.in_(expired.scalar_subquery())).returning(
+        model.user_id, model.start_time, model.end_time)).all()
+    if rows and archive and model is Availability:
+        archived_at = int(time.time())
+        db.session.execute(insert(ArchivedAvailability), [
+            {'user_id': user_id, 'start_time': start, 'end_time': end, 'archived_at': archived_at}
+            for user_id, start, end in rows])
+        compaction_stats[('archived', model.__tablename__)] += len(rows)
+    db.session.commit()
+
+    # unbounded reads cache past slots too
+    for user_id in {row[0] for row in rows}:
+        cache.invalidate_user(user_id)
+        bitmap.bitmaps.invalidate_user(user_id)
+    compaction_stats[('removed', model.__tablename__)] += len(rows)
+    return len(rows)
+
+
+def compact(before: Optional[int] = None, batch_size: int = BATCH_SIZE, archive: bool = False,
+            reindex: bool = False, coalesce: bool = False, purge: bool = True) -> dict:
+    """
+    Purge (or archive) every slot and exception that ended at or before the cutoff, now by default, batch by batch,
+    unless purge is off, and merge fragmented slots when asked. Returns the rows removed per table, the slots merged
+    and still fragmented, and the index sizes before and after.
+    """
+    before = int(time.time()) if before is None else before
+    report = {'before': before, 'removed': {}, 'index_bytes': {'before': index_bytes()}}
+
+    for model in COMPACTED_TABLES if purge else ():
+        removed = 0
+        while True:
+            deleted = purge_batch(model, before, batch_size, archive)
+            removed += deleted
+            if deleted < batch_size:
+                break
+        report['removed'][model.__tablename__] = removed
+
+    if coalesce and db.engine.dialect.name == 'postgresql':
+        report['coalesced'] = coalesce_slots()
+    report['fragmented_slots'] = fragmented_slots()
+
+    if reindex and db.engine.dialect.name == 'postgresql':
+        rebuild_indexes()
+    report['index_bytes']['after'] = index_bytes()
+
+    global last_fragmented_slots
+    last_index_bytes.clear()
+    last_index_bytes.update(report['index_bytes'])
+    last_fragmented_slots = report['fragmented_slots']
+    logger.info("compaction removed %s, %s fragmented slots left, index bytes %s", report['removed'],
+                report['fragmented_slots'], report['index_bytes'])
+    return report
+
+
+def rebuild_indexes():
+    """ Vacuum the compacted tables and rebuild their indexes without blocking writes, outside of a transaction. """
+    db.session.remove()
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        for model in COMPACTED_TABLES:
+            connection.execute(text(f"VACUUM (ANALYZE) {model.__tablename__}"))
+            connection.execute(text(f"REINDEX TABLE CONCURRENTLY {model.__tablename__}"))
+
+
+if __name__ == '__main__':
+    from app import create_app
+
+    parser = argparse.ArgumentParser(description="Purge or archive expired availability")
+    parser.add_argument('--before', type=int, help="epoch timestamp, slots ended by then are removed (default: now)")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--archive', action='store_true', help="move slots to availabilities_archive")
+    parser.add_argument('--reindex', action='store_true', help="rebuild the indexes afterwards to shrink them")
+    parser.add_argument('--coalesce', action='store_true', help="merge each user's overlapping or touching slots")
+    parser.add_argument('--no-purge', dest='purge', action='store_false', help="keep the expired slots")
+    args = parser.parse_args()
+
+    with create_app().app_context():
+        if not inspect(db.engine).has_table(Availability.__tablename__):
+            # a release before the database was ever seeded
+            parser.exit(message="no availabilities table, nothing to compact\n")
+        result = compact(args.before, args.batch_size, args.archive, args.reindex, args.coalesce, args.purge)
+    for table, removed in result['removed'].items():
+        sizes = result['index_bytes']
+        print(f"{table}: {removed} rows removed, indexes {sizes['before'].get(table, 0)} -> "
+              f"{sizes['after'].get(table, 0)} bytes")
+    print(f"{result.get('coalesced', 0)} slots coalesced, {result['fragmented_slots']} fragmented slots left")
@@ -0,0 +1,224 @@
+# Cross-shard versions of the service functions
+#
+# The services in src/services.py decorated with on_shard (src/sharding.py) call the function of the same name here
+# when their users live on several shards. Reads fetch each shard's part in parallel, one thread and session per shard,
+# and combine them in memory. A meeting between users of two shards is written on both in a two-phase commit.
+
+import heapq
+from collections import defaultdict
+from functools import partial
+from itertools import islice
+from typing import Dict, Iterator, List, Optional
+
+from sqlalchemy import select, text
+
+from src import sharding
+from src.api_exceptions import AvailabilityError, InvalidTimestampError, UserNotFoundError
+from src.cache import cache
+from src.intervals import clip, intersect, intersect_many
+from src.models import Meeting, MeetingParticipant, User, db
+
+
+def get_all_users() -> List[User]:
+    users = []
+    for shard in range(sharding.shard_count()):
+        with sharding.use_shard(shard):
+            users.extend(User.query.all())
+    return sorted(users, key=lambda user: user.id)
+
+
+def get_users_page(after_id: Optional[int], limit: int) -> List[dict]:
+    pages = sharding.on_each({shard: partial(services.get_users_page, after_id, limit)
+                              for shard in range(sharding.shard_count())})
+    return list(islice(heapq.merge(*pages.values(), key=lambda user: user['id']), limit))
+
+
+def iter_users(batch_size: int = 1000) -> Iterator[List[dict]]:
+    """ Every shard's users merged by id, from a server side cursor on each shard. """
+    users = select(User.id, User.name).order_by(User.id).execution_options(yield_per=batch_size)
+    results = [db.session.execute(users, bind_arguments={'bind': sharding.engine(shard)})
+               for shard in range(sharding.shard_count())]
+    rows = heapq.merge(*results, key=lambda row: row[0])
+    while True:
+        batch = services.as_users(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def find_overlap(user1_id: int, user2_id: int, start_time: Optional[int] = None, end_time: Optional[int] = None,
+                 limit: Optional[int] = None) -> List[dict]:
+    def load():
+        slots = _user_slots([user1_id, user2_id], start_time, end_time)
+        return services.as_slots(islice(clip(intersect(slots[user1_id], slots[user2_id]), start_time, end_time),
+                                        limit))
+
+    return cache.get_or_load('overlap', sorted((user1_id, user2_id)), (start_time, end_time, limit), load)
+
+
+def find_group_overlap(user_ids: List[int], start_time: Optional[int] = None, end_time: Optional[int] = None,
+                       min_duration: int = 0) -> List[dict]:
+    slots = _user_slots(sorted(set(user_ids)), start_time, end_time)
+    common = clip(intersect_many(list(slots.values())), start_time, end_time)
+    return services.as_slots((start, end) for start, end in common if end - start >= max(min_duration, 1))
+
+
+def suggest_meetings(user_ids: List[int], duration: int, start_time: int, end_time: Optional[int] = None, k: int = 5,
+                     step: Optional[int] = None) -> List[dict]:
+    """ Unlike services.suggest_meetings, every user's slots in the range are read in full before the search. """
+    slots = _user_slots(sorted(set(user_ids)), start_time, end_time)
+    return services.as_slots(services._suggestions(intersect_many(list(slots.values())), duration, start_time,
+                                                   end_time, k, step))
+
+
+def _user_slots(user_ids: List[int], start_time: Optional[int], end_time: Optional[int]) -> Dict[int, List[tuple]]:
+    """ services._user_slots of users on several shards, each shard reads its users' slots, the shards in parallel. """
+    shards = sharding.on_each({shard: partial(services._user_slots, users, start_time, end_time)
+                               for shard, users in sharding.by_shard(user_ids).items()})
+    return {user_id: slots for shard_slots in shards.values() for user_id, slots in shard_slots.items()}
+
+
+def schedule_meeting(user1_id: int, user2_id: int, meeting_start_time: int, meeting_end_time: int) -> int:
+    """
+    services.schedule_meeting for users of two shards, in a two-phase commit: the meeting is stored on both shards
+    with the same id. The users are locked in shard order, so bookings across the same shards queue up instead of
+    deadlocking, then both shards check and book their user in parallel.
+    """
+    return services.retry_on_conflict(_schedule_meeting)(user1_id, user2_id, meeting_start_time, meeting_end_time)
+
+
+def _schedule_meeting(user1_id: int, user2_id: int, meeting_start_time: int, meeting_end_time: int) -> int:
+    if not services.is_valid_timestamps(meeting_start_time, meeting_end_time):
+        raise InvalidTimestampError("Invalid timestamps")
+
+    shards = sharding.shards_of([user1_id, user2_id])
+    with sharding.TwoPhaseCommit(shards.values()) as transaction:
+        for user_id in sorted(shards, key=shards.get):
+            if not transaction.run(shards[user_id], partial(services._lock_users, user_id)):
+                raise UserNotFoundError("One or both users do not exist")
+
+        meeting_id = transaction.run(transaction.shards[0], _next_meeting_id)
+        available = transaction.run_all({shard: partial(_book_meeting, meeting_id, user_id, user1_id, user2_id,
+                                                        meeting_start_time, meeting_end_time)
+                                         for user_id, shard in shards.items()})
+        if not all(available.values()):
+            raise AvailabilityError("No overlap found in availability for the requested time")
+        transaction.commit()
+    return meeting_id
+
+
+def _next_meeting_id() -> int:
+    # the shards hand out disjoint series of ids, see sharding.init_shards
+    return db.session.execute(text("SELECT nextval(pg_get_serial_sequence('meetings', 'id'))")).scalar()
+
+
+def _book_meeting(meeting_id: int, user_id: int, user1_id: int, user2_id: int, meeting_start_time: int,
+                  meeting_end_time: int) -> bool:
+    """ A shard's part of a cross-shard meeting: store it if the shard's user is available, and take it out. """
+    if not services.check_availability(user_id, meeting_start_time, meeting_end_time):
+        return False
+    db.session.add(Meeting(id=meeting_id, user1_id=user1_id, user2_id=user2_id, meeting_time=meeting_start_time,
+                           end_time=meeting_end_time))
+    db.session.add_all([MeetingParticipant(meeting_id=meeting_id, user_id=participant, start_time=meeting_start_time,
+                                           end_time=meeting_end_time) for participant in (user1_id, user2_id)])
+    services._update_availability(user_id, meeting_start_time, meeting_end_time)
+    return True
+
+
+def bulk_set_availability(slots: List[dict], reroute: bool = True) -> List[dict]:
+    """
+    services.bulk_set_availability on each shard for the slots of its users, in one transaction per shard. Slots
+    failing because their user was moved off the shard since the directory cached it are run again, once, on the new
+    one.
+    """
+    user_ids = {}
+    for index, slot in enumerate(slots):
+        try:
+            user_ids[index] = int(slot['user_id'])
+        except (KeyError, TypeError, ValueError):
+            # rejected by the shard 0 batch
+            user_ids[index] = None
+    shards = sharding.shards_of({user_id for user_id in user_ids.values() if user_id is not None})
+
+    batches = defaultdict(list)
+    for index, user_id in user_ids.items():
+        batches[shards.get(user_id, 0)].append(index)
+    results = _run_batches(services.bulk_set_availability, slots, batches)
+    if not reroute:
+        return results
+    users = {index: (user_id,) for index, user_id in user_ids.items() if user_id is not None}
+    return _rerouted(bulk_set_availability, slots, results, users, shards, "User does not exist")
+
+
+def bulk_schedule_meetings(meetings: List[dict], reroute: bool = True) -> List[dict]:
+    """
+    services.bulk_schedule_meetings on each shard for the meetings between its users, in one transaction per shard,
+    then the meetings between users of two shards one by one, each in its own two-phase commit. Those are checked
+    against the batches' meetings through the database: a conflict fails them without naming the meeting of the batch.
+    Batched meetings failing because a user was moved off the shard since the directory cached it are run again, once.
+    """
+    users, batches = {}, defaultdict(list)
+    for index, meeting in enumerate(meetings):
+        try:
+            users[index] = (int(meeting['user1_id']), int(meeting['user2_id']))
+        except (KeyError, TypeError, ValueError):
+            batches[0].append(index)
+    shards = sharding.shards_of({user_id for pair in users.values() for user_id in pair})
+
+    across = []
+    for index, (user1_id, user2_id) in users.items():
+        if shards[user1_id] == shards[user2_id]:
+            batches[shards[user1_id]].append(index)
+        else:
+            across.append(index)
+    results = _run_batches(services.bulk_schedule_meetings, meetings, batches)
+    if reroute:
+        batched = {index: pair for index, pair in users.items() if shards[pair[0]] == shards[pair[1]]}
+        results = _rerouted(bulk_schedule_meetings, meetings, results, batched, shards,
+                            "One or both users do not exist")
+
+    for index in across:
+        try:
+            meeting_id = services.schedule_meeting(*users[index], int(meetings[index]['meeting_start_time']),
+                                                   int(meetings[index]['meeting_end_time']))
+            results[index] = {'index': index, 'status': 'scheduled', 'id': meeting_id}
+        except (KeyError, TypeError, ValueError):
+            results[index] = {'index': index, 'status': 'error',
+                              'error': "Meeting must have user1_id, user2_id, meeting_start_time and meeting_end_time"}
+        except (AvailabilityError, InvalidTimestampError, UserNotFoundError) as e:
+            results[index] = {'index': index, 'status': 'error', 'error': str(e)}
+    return results
+
+
+def _rerouted(bulk, items: List[dict], results: List[Optional[dict]], users: Dict[int, tuple], shards: Dict[int, int],
+              error: str) -> List[Optional[dict]]:
+    """
+    Run again through bulk, with reroute off, the items of users that failed with error on the shard the directory
+    had cached for them, when it places them on another shard once read afresh.
+    """
+    failed = [index for index in users if results[index] is not None and results[index].get('error') == error]
+    stale = {user_id for index in failed for user_id in users[index]}
+    if not stale or not sharding.directory.forget(stale):
+        return results
+    fresh = sharding.shards_of(stale)
+    moved = [index for index in failed if any(fresh[user_id] != shards[user_id] for user_id in users[index])]
+    if moved:
+        for index, result in zip(moved, bulk([items[index] for index in moved], reroute=False)):
+            results[index] = dict(result, index=index)
+    return results
+
+
+def _run_batches(bulk, items: List[dict], batches: Dict[int, List[int]]) -> List[Optional[dict]]:
+    """ Run a bulk service on each shard for the items at its indexes, and place the results back at theirs. """
+    results = [None] * len(items)
+    for shard, indexes in sorted(batches.items()):
+        indexes.sort()
+        with sharding.use_shard(shard):
+            for index, result in zip(indexes, bulk([items[index] for index in indexes])):
+                results[index] = dict(result, index=index)
+    return results
+
+
+# src/services.py needs this module's functions to decorate its own, and they call its services: imported last, so
+# either module can be imported first
+from src import services  # noqa: E402
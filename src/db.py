@@ -1,8 +1,29 @@
 # Database setup and connection
 
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 
-db = SQLAlchemy()
+# bind of the read replica engine, configured from DATABASE_REPLICA_URL (see src/replica.py)
+REPLICA = 'replica'
+# session.info key of the engine, or connection, of the shard a session's statements are routed to (see src/sharding.py)
+SHARD = 'shard'
+
+
+class RoutingSession(Session):
+    """
+    Session that runs every statement on the shard in session.info['shard'] when one is set, and on the replica bind
+    while session.info['replica'] is set.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.info.get(SHARD) is not None:
+            return self.info[SHARD]
+        if bind is None and self.info.get(REPLICA) and REPLICA in db.engines:
+            return db.engines[REPLICA]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 
 def init_db(app):
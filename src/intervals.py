@@ -0,0 +1,111 @@
+# Interval algorithms for availability slots
+#
+# A slot is a (start_time, end_time) pair of epoch timestamps. Every function here expects its input streams sorted by
+# start time (the order the availability queries return them in) and walks them in a single linear pass.
+
+import heapq
+from typing import Iterable, Iterator, Optional, Sequence, Tuple
+
+Interval = Tuple[int, int]
+
+
+def coalesce(slots: Iterable[Interval]) -> Iterator[Interval]:
+    """ Merge overlapping and consecutive slots of a stream sorted by start time. """
+    current: Optional[list] = None
+    for start, end in slots:
+        if current is None:
+            current = [start, end]
+        elif start <= current[1]:
+            current[1] = max(current[1], end)
+        else:
+            yield current[0], current[1]
+            current = [start, end]
+
+    if current is not None:
+        yield current[0], current[1]
+
+
+def clip(slots: Iterable[Interval], start_time: Optional[int] = None,
+         end_time: Optional[int] = None) -> Iterator[Interval]:
+    """ Cut slots to [start_time, end_time), either bound may be open, dropping the ones left empty. """
+    for start, end in slots:
+        if start_time is not None:
+            start = max(start, start_time)
+        if end_time is not None:
+            end = min(end, end_time)
+        if start < end:
+            yield start, end
+
+
+def intersect(slots1: Iterable[Interval], slots2: Iterable[Interval]) -> Iterator[Interval]:
+    """
+    Two pointer sweep over two slot streams sorted by start time, yielding the time slots common to both.
+    The output is sorted by start time and has no overlapping or consecutive slots.
+    """
+    stream1, stream2 = coalesce(slots1), coalesce(slots2)
+    slot1, slot2 = next(stream1, None), next(stream2, None)
+
+    while slot1 is not None and slot2 is not None:
+        start = max(slot1[0], slot2[0])
+        end = min(slot1[1], slot2[1])
+        if start < end:
+            yield start, end
+
+        # the slot that ends first cannot overlap anything else in the other stream
+        if slot1[1] <= slot2[1]:
+            slot1 = next(stream1, None)
+        else:
+            slot2 = next(stream2, None)
+
+
+def intersect_many(streams: Sequence[Iterable[Interval]]) -> Iterator[Interval]:
+    """
+    k-way merge of slot streams sorted by start time, yielding the time slots common to all of them.
+    The current slot of every stream sits in a heap keyed by end time, so the sweep costs O(n log k), and it stops as
+    soon as any stream runs out since nothing after that can be common to all.
+    """
+    iterators = [coalesce(stream) for stream in streams]
+    heap = []
+    latest_start = None
+    for index, iterator in enumerate(iterators):
+        slot = next(iterator, None)
+        if slot is None:
+            return
+        heap.append((slot[1], index))
+        latest_start = slot[0] if latest_start is None else max(latest_start, slot[0])
+
+    if not heap:
+        return
+    heapq.heapify(heap)
+
+    while True:
+        earliest_end, index = heap[0]
+        if latest_start < earliest_end:
+            yield latest_start, earliest_end
+
+        slot = next(iterators[index], None)
+        if slot is None:
+            return
+        heapq.heapreplace(heap, (slot[1], index))
+        latest_start = max(latest_start, slot[0])
+
+
+def subtract(slots: Iterable[Interval], removed: Iterable[Interval]) -> Iterator[Interval]:
+    """ Slots of the first stream with the time covered by the second taken out, both sorted by start time. """
+    cuts = coalesce(removed)
+    cut = next(cuts, None)
+    for start, end in coalesce(slots):
+        # cuts ending before this slot cannot affect it or any later slot
+        while cut is not None and cut[1] <= start:
+            cut = next(cuts, None)
+
+        while cut is not None and cut[0] < end:
+            if start < cut[0]:
+                yield start, cut[0]
+            start = cut[1]
+            if start >= end:
+                break
+            cut = next(cuts, None)
+
+        if start < end:
+            yield start, end
@@ -0,0 +1,236 @@
+# Request metrics: per route latency histograms, SQL statements and database time per request, pool checkout wait and
+# connections per bind
+#
+# Statement timings come from SQLAlchemy engine events and are accumulated on flask.g for the current request, shard
+# threads included, then folded into the app's histograms when the response goes out, or once a streamed body is sent.
+# Metrics live in the worker process, each gunicorn worker exposes its own on /metrics.
+
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+
+from flask import Response, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+from src import compaction, replica, services, sharding
+from src.cache import cache
+from src.db import db
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+MAX_LOGGED_STATEMENTS = 50
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: dict) -> list:
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{_labels({**labels, 'le': bound})} {cumulative}")
+        lines.append(f"{name}_bucket{_labels({**labels, 'le': '+Inf'})} {self.count}")
+        lines.append(f"{name}_sum{_labels(labels)} {self.sum}")
+        lines.append(f"{name}_count{_labels(labels)} {self.count}")
+        return lines
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+
+class Metrics:
+    def __init__(self, slow_request_seconds: float):
+        self.slow_request_seconds = slow_request_seconds
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.statements = defaultdict(lambda: Histogram(STATEMENT_BUCKETS))
+        self.db_time = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.pool_wait = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.responses = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, method: str, route: str, status: int, stats: dict, duration: float):
+        with self._lock:
+            self.latency[(method, route)].observe(duration)
+            self.statements[route].observe(stats['statements'])
+            self.db_time[route].observe(stats['db_time'])
+            for bind, wait in stats['pool_waits']:
+                self.pool_wait[bind].observe(wait)
+            self.responses[(method, route, status)] += 1
+
+    def render(self) -> str:
+        with self._lock:
+            lines = ['# HELP http_request_duration_seconds Request latency by route',
+                     '# TYPE http_request_duration_seconds histogram']
+            for (method, route), histogram in sorted(self.latency.items()):
+                lines += histogram.render('http_request_duration_seconds', {'method': method, 'route': route})
+
+            lines += ['# HELP http_responses_total Responses by route and status',
+                      '# TYPE http_responses_total counter']
+            lines += [f"http_responses_total{_labels({'method': method, 'route': route, 'status': status})} {count}"
+                      for (method, route, status), count in sorted(self.responses.items())]
+
+            lines += ['# HELP db_statements_per_request SQL statements executed per request',
+                      '# TYPE db_statements_per_request histogram']
+            for route, histogram in sorted(self.statements.items()):
+                lines += histogram.render('db_statements_per_request', {'route': route})
+
+            lines += ['# HELP db_time_seconds_per_request Time spent executing SQL per request',
+                      '# TYPE db_time_seconds_per_request histogram']
+            for route, histogram in sorted(self.db_time.items()):
+                lines += histogram.render('db_time_seconds_per_request', {'route': route})
+
+            lines += ['# HELP db_pool_checkout_wait_seconds Time waiting for a pooled connection, by bind',
+                      '# TYPE db_pool_checkout_wait_seconds histogram']
+            for bind, histogram in sorted(self.pool_wait.items()):
+                lines += histogram.render('db_pool_checkout_wait_seconds', {'bind': bind})
+
+        lines += ['# HELP db_pool_connections Connections of each bind\'s pool, checked out, idle or in overflow',
+                  '# TYPE db_pool_connections gauge']
+        for bind, engine in sorted(db.engines.items(), key=lambda item: item[0] or ''):
+            pool = engine.pool
+            if isinstance(pool, QueuePool):
+                lines += [f"db_pool_connections{_labels({'bind': bind or 'primary', 'state': state})} {count}"
+                          for state, count in (('checked_out', pool.checkedout()), ('idle', pool.checkedin()),
+                                               ('overflow', max(pool.overflow(), 0)))]
+        lines += ['# HELP db_reads_total Service reads by the bind they were routed to',
+                  '# TYPE db_reads_total counter']
+        lines += [f"db_reads_total{_labels({'bind': bind})} {count}"
+                  for bind, count in sorted(replica.route_stats.items())]
+        lines += ['# HELP db_cross_shard_reads_total Reads of users on several shards, fetched from each in parallel',
+                  '# TYPE db_cross_shard_reads_total counter',
+                  f"db_cross_shard_reads_total {sharding.shard_stats['cross_shard_reads']}",
+                  '# HELP db_two_phase_commits_total Cross-shard transactions by outcome, in doubt ones are left to '
+                  'recovery', '# TYPE db_two_phase_commits_total counter']
+        lines += [f"db_two_phase_commits_total{_labels({'outcome': outcome})} {sharding.shard_stats[outcome]}"
+                  for outcome in ('committed', 'rolled_back', 'in_doubt')]
+        lines += ['# HELP users_moved_total Users moved to another shard by the rebalancer',
+                  '# TYPE users_moved_total counter', f"users_moved_total {sharding.shard_stats['moved_users']}"]
+
+        lines += ['# HELP cache_hits_total Availability and overlap cache hits', '# TYPE cache_hits_total counter',
+                  f'cache_hits_total {cache.hits}',
+                  '# HELP cache_misses_total Availability and overlap cache misses',
+                  '# TYPE cache_misses_total counter', f'cache_misses_total {cache.misses}',
+                  '# HELP db_transaction_retries_total Transactions retried after a serialization conflict',
+                  '# TYPE db_transaction_retries_total counter',
+                  f"db_transaction_retries_total {services.retry_stats['retries']}"]
+
+        lines += ['# HELP compaction_rows_total Expired rows removed or archived by the compaction job',
+                  '# TYPE compaction_rows_total counter']
+        lines += [f"compaction_rows_total{_labels({'table': table, 'action': action})} {count}"
+                  for (action, table), count in sorted(compaction.compaction_stats.items())]
+        lines += ['# HELP compaction_index_bytes Index size of the compacted tables before and after the last run',
+                  '# TYPE compaction_index_bytes gauge']
+        lines += [f"compaction_index_bytes{_labels({'table': table, 'phase': phase})} {size}"
+                  for phase, sizes in sorted(compaction.last_index_bytes.items())
+                  for table, size in sorted(sizes.items())]
+        lines += ['# HELP availability_slots_merged_total Existing slots merged into new ones by availability writes',
+                  '# TYPE availability_slots_merged_total counter',
+                  f"availability_slots_merged_total {services.merge_stats['absorbed']}"]
+        if compaction.last_fragmented_slots is not None:
+            lines += ['# HELP availability_fragmented_slots Slots overlapping or touching an earlier slot of their '
+                      'user, as counted by the last compaction', '# TYPE availability_fragmented_slots gauge',
+                      f'availability_fragmented_slots {compaction.last_fragmented_slots}']
+        return '\n'.join(lines) + '\n'
+
+
+class TimedQueuePool(QueuePool):
+    """ QueuePool that records how long each checkout waited for a connection, under its bind (the pool's name). """
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            stats = _request_stats()
+            if stats is not None:
+                stats['pool_waits'].append((self.logging_name or 'primary', time.perf_counter() - started))
+
+
+def _request_stats():
+    return g.get('request_stats') if has_app_context() else None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # on the statement's own execution context, a failed statement takes its start time with it
+    context.query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context.query_started
+    stats = _request_stats()
+    if stats is None:
+        return
+    # shard threads working for the request share its stats (src/sharding.py)
+    with stats['lock']:
+        stats['statements'] += 1
+        stats['db_time'] += elapsed
+        if len(stats['queries']) < MAX_LOGGED_STATEMENTS:
+            stats['queries'].append((elapsed, statement))
+
+
+def init_metrics(app):
+    """
+    Record metrics for every request and serve them on /metrics in the Prometheus text format. Requests slower than
+    SLOW_REQUEST_SECONDS are logged with the statements they ran.
+    """
+    metrics = Metrics(float(app.config.get('SLOW_REQUEST_SECONDS', 1.0)))
+    app.extensions['metrics'] = metrics
+
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+    @app.before_request
+    def start_request():
+        g.request_stats = {'started': time.perf_counter(), 'statements': 0, 'db_time': 0.0, 'pool_waits': [],
+                           'queries': [], 'lock': threading.Lock()}
+
+    @app.after_request
+    def record_request(response):
+        stats = g.get('request_stats')
+        if stats is None:
+            return response
+
+        method, path, status = request.method, request.full_path, response.status_code
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+
+        def record():
+            duration = time.perf_counter() - stats['started']
+            metrics.record(method, route, status, stats, duration)
+            if duration >= metrics.slow_request_seconds:
+                queries = '\n'.join(f"  {elapsed * 1000:.1f}ms {statement}" for elapsed, statement in stats['queries'])
+                logger.warning("Slow request %s %s took %.1fms with %d statements (%.1fms in db):\n%s", method, path,
+                               duration * 1000, stats['statements'], stats['db_time'] * 1000, queries)
+
+        if response.is_streamed:
+            # the body runs its queries after this, the request is recorded once it is sent
+            response.call_on_close(record)
+        else:
+            g.pop('request_stats')
+            record()
+        return response
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
@@ -11,8 +11,10 @@ class User(db.Model):
 
 class Availability(db.Model):
     __tablename__ = 'availabilities'
+    # serves every per user read in start time order and the window bounds on start_time
+    __table_args__ = (db.Index('ix_availabilities_user_id_start_time', 'user_id', 'start_time'),)
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     start_time = db.Column(db.Integer, nullable=False, index=True)  # Epoch timestamp
     end_time = db.Column(db.Integer, nullable=False, index=True)  # Epoch timestamp
 
@@ -22,4 +24,63 @@ class Meeting(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user1_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     user2_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    meeting_time = db.Column(db.Integer, nullable=False)  # Epoch timestamp
+    meeting_time = db.Column(db.Integer, nullable=False)  # Epoch timestamp, the start of the meeting
+    end_time = db.Column(db.Integer, nullable=True)  # Epoch timestamp, null for meetings scheduled before it was stored
+
+
+class MeetingParticipant(db.Model):
+    """ One row per user of a meeting, with its times copied so a user's calendar is one index range scan. """
+    __tablename__ = 'meeting_participants'
+    __table_args__ = (db.Index('ix_meeting_participants_user_id_start_time', 'user_id', 'start_time'),)
+    # no foreign key, partitioned meetings (src/partitioning.py) are keyed by (id, meeting_time)
+    meeting_id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    start_time = db.Column(db.Integer, nullable=False)  # Epoch timestamp
+    end_time = db.Column(db.Integer, nullable=False)  # Epoch timestamp
+
+
+class AvailabilityRule(db.Model):
+    """ Recurring weekly availability, expanded into slots only for the time range being read (src/recurrence.py). """
+    __tablename__ = 'availability_rules'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    weekdays = db.Column(db.Integer, nullable=False)  # Bit mask, bit 0 is Monday
+    start_offset = db.Column(db.Integer, nullable=False)  # Seconds after local midnight
+    end_offset = db.Column(db.Integer, nullable=False)  # Seconds after local midnight, at most a day
+    timezone = db.Column(db.String(64), nullable=False, default='UTC')  # IANA name, for the local days
+    valid_from = db.Column(db.Integer, nullable=False)  # Epoch timestamp
+    valid_until = db.Column(db.Integer, nullable=True)  # Epoch timestamp, open ended if null
+
+
+class AvailabilityException(db.Model):
+    """ Time taken out of a user's recurring availability: a booked meeting or a one off absence. """
+    __tablename__ = 'availability_exceptions'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    start_time = db.Column(db.Integer, nullable=False)  # Epoch timestamp
+    end_time = db.Column(db.Integer, nullable=False)  # Epoch timestamp
+
+
+class ArchivedAvailability(db.Model):
+    """ Expired availability moved out of the availabilities table by the compaction job (src/compaction.py). """
+    __tablename__ = 'availabilities_archive'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)  # no foreign key, the archive outlives users
+    start_time = db.Column(db.Integer, nullable=False)  # Epoch timestamp
+    end_time = db.Column(db.Integer, nullable=False)  # Epoch timestamp
+    archived_at = db.Column(db.Integer, nullable=False)  # Epoch timestamp
+
+
+class UserShard(db.Model):
+    """ Shard of a user moved by the rebalancer (src/sharding.py), users without a row live on shard 0. """
+    __tablename__ = 'user_shards'
+    # on shard 0 only, no foreign key, the user's row is on its shard
+    user_id = db.Column(db.Integer, primary_key=True)
+    shard = db.Column(db.Integer, nullable=False)
+
+
+class ShardTransaction(db.Model):
+    """ Cross-shard transaction committed, recorded on its first shard to resolve the others after a crash. """
+    __tablename__ = 'shard_transactions'
+    id = db.Column(db.String(36), primary_key=True)
+    committed_at = db.Column(db.Integer, nullable=False)  # Epoch timestamp
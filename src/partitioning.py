@@ -0,0 +1,159 @@
+# Optional monthly partitioning of the meetings table by meeting_time (Postgres)
+#
+# The migration swaps meetings for a table partitioned by range of meeting_time, one partition per calendar month (UTC)
+# from the first meeting to MONTHS_AHEAD months from now, plus a default partition for anything later. The ORM keeps
+# writing to meetings and Postgres routes each row to its month. Old months can then be detached, a metadata only
+# change, instead of deleted row by row; a detached partition stays behind as a plain table to archive or drop.
+# Partitions for the coming months are added by the extend command, run it from the same cron as src/compaction.py.
+#
+# The primary key of a partitioned table has to include the partition key, it becomes (id, meeting_time).
+#
+# usage: python -m src.partitioning migrate|extend|rollback
+#        python -m src.partitioning detach TIMESTAMP [--drop]
+
+import argparse
+import re
+import time
+from datetime import datetime, timezone
+from typing import List, Tuple
+
+from sqlalchemy import text
+
+from src.db import db
+
+MONTHS_AHEAD = 12
+
+BOUNDS = re.compile(r"FROM \('?(-?\d+)'?\) TO \('?(-?\d+)'?\)")
+
+MIGRATE = [
+    "LOCK TABLE meetings IN ACCESS EXCLUSIVE MODE",
+    "ALTER TABLE meetings RENAME TO meetings_unpartitioned",
+    "CREATE TABLE meetings (LIKE meetings_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE (meeting_time)",
+    "ALTER SEQUENCE meetings_id_seq OWNED BY meetings.id",
+    "ALTER TABLE meetings ADD PRIMARY KEY (id, meeting_time)",
+    "ALTER TABLE meetings ADD FOREIGN KEY (user1_id) REFERENCES users (id)",
+    "ALTER TABLE meetings ADD FOREIGN KEY (user2_id) REFERENCES users (id)",
+    "CREATE TABLE meetings_default PARTITION OF meetings DEFAULT",
+]
+
+COPY = [
+    "INSERT INTO meetings SELECT * FROM meetings_unpartitioned",
+    "DROP TABLE meetings_unpartitioned",
+]
+
+ROLLBACK = [
+    "LOCK TABLE meetings IN ACCESS EXCLUSIVE MODE",
+    "CREATE TABLE meetings_unpartitioned (LIKE meetings INCLUDING DEFAULTS)",
+    "INSERT INTO meetings_unpartitioned SELECT * FROM meetings",
+    "ALTER SEQUENCE meetings_id_seq OWNED BY meetings_unpartitioned.id",
+    "DROP TABLE meetings",
+    "ALTER TABLE meetings_unpartitioned RENAME TO meetings",
+    "ALTER TABLE meetings ADD PRIMARY KEY (id)",
+    "ALTER TABLE meetings ADD FOREIGN KEY (user1_id) REFERENCES users (id)",
+    "ALTER TABLE meetings ADD FOREIGN KEY (user2_id) REFERENCES users (id)",
+]
+
+
+def is_partitioned() -> bool:
+    query = text("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'meetings'::regclass)")
+    return db.session.execute(query).scalar()
+
+
+def month_start(timestamp: int, months: int = 0) -> datetime:
+    """ Start of the month the timestamp falls in, moved by the given number of months. """
+    moment = datetime.fromtimestamp(timestamp, timezone.utc)
+    index = moment.year * 12 + moment.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def month_partitions(start_time: int, end_time: int) -> List[Tuple[str, int, int]]:
+    """ (name, low, high) of the monthly partitions covering [start_time, end_time). """
+    partitions, month = [], month_start(start_time)
+    while month.timestamp() < end_time:
+        following = month_start(int(month.timestamp()), 1)
+        partitions.append((f"meetings_{month:%Y_%m}", int(month.timestamp()), int(following.timestamp())))
+        month = following
+    return partitions
+
+
+def partitions() -> List[Tuple[str, int, int]]:
+    """ (name, low, high) of the range partitions currently attached to meetings, sorted by low. """
+    rows = db.session.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = 'meetings'::regclass"))
+    bounds = [(name, BOUNDS.search(bound)) for name, bound in rows]
+    return sorted(((name, int(match[1]), int(match[2])) for name, match in bounds if match), key=lambda row: row[1])
+
+
+def create_partitions(start_time: int, end_time: int) -> List[str]:
+    """ Add the missing monthly partitions covering [start_time, end_time), returns the names of the new ones. """
+    existing = {name for name, _, _ in partitions()}
+    created = []
+    for name, low, high in month_partitions(start_time, end_time):
+        if name not in existing:
+            # rows of the month already in the default partition are moved over first, attaching would reject them
+            db.session.execute(text(f"CREATE TABLE {name} (LIKE meetings INCLUDING DEFAULTS)"))
+            db.session.execute(text(f"WITH moved AS (DELETE FROM meetings_default WHERE meeting_time >= {low} "
+                                    f"AND meeting_time < {high} RETURNING *) INSERT INTO {name} SELECT * FROM moved"))
+            db.session.execute(text(f"ALTER TABLE meetings ATTACH PARTITION {name} "
+                                    f"FOR VALUES FROM ({low}) TO ({high})"))
+            created.append(name)
+    return created
+
+
+def migrate(months_ahead: int = MONTHS_AHEAD):
+    """ Convert the meetings table to monthly partitions, in one transaction. """
+    for statement in MIGRATE:
+        db.session.execute(text(statement))
+    first = db.session.execute(text("SELECT min(meeting_time) FROM meetings_unpartitioned")).scalar()
+    now = int(time.time())
+    create_partitions(min(first, now) if first is not None else now, int(month_start(now, months_ahead).timestamp()))
+    for statement in COPY:
+        db.session.execute(text(statement))
+    db.session.commit()
+
+
+def extend(months_ahead: int = MONTHS_AHEAD) -> List[str]:
+    """ Add the partitions of the coming months. """
+    now = int(time.time())
+    created = create_partitions(now, int(month_start(now, months_ahead).timestamp()))
+    db.session.commit()
+    return created
+
+
+def detach(before: int, drop: bool = False) -> List[str]:
+    """
+    Detach the partitions holding only meetings before the given time, dropping them when asked. Returns their names.
+    """
+    detached = [name for name, _, high in partitions() if high <= before]
+    for name in detached:
+        db.session.execute(text(f"ALTER TABLE meetings DETACH PARTITION {name}"))
+        if drop:
+            db.session.execute(text(f"DROP TABLE {name}"))
+    db.session.commit()
+    return detached
+
+
+def rollback():
+    """ Back to a single meetings table, detached partitions are left alone. """
+    for statement in ROLLBACK:
+        db.session.execute(text(statement))
+    db.session.commit()
+
+
+if __name__ == '__main__':
+    from app import create_app
+
+    parser = argparse.ArgumentParser(description="Monthly partitions of the meetings table")
+    parser.add_argument('command', choices=['migrate', 'extend', 'detach', 'rollback'])
+    parser.add_argument('before', type=int, nargs='?', help="detach: epoch timestamp, older months are detached")
+    parser.add_argument('--drop', action='store_true', help="detach: drop the detached partitions")
+    args = parser.parse_args()
+    if args.command == 'detach' and args.before is None:
+        parser.error("detach needs a timestamp")
+
+    commands = {'migrate': migrate, 'extend': extend, 'detach': lambda: detach(args.before, args.drop),
+                'rollback': rollback}
+    with create_app().app_context():
+        tables = commands[args.command]()
+    print(f"{args.command} done" + (f": {', '.join(tables)}" if tables else ''))
@@ -0,0 +1,98 @@
+# Optional Postgres range type storage for availability slots
+#
+# The migration adds a stored int8range column derived from start_time/end_time, so the ORM keeps writing the two
+# integer columns, and an exclusion constraint that forbids overlapping slots of the same user. The constraint is
+# backed by a GiST index on (user_id, slot), which serves the @> and && lookups of the availability check, slot merge
+# and meeting split in src/services.py once AVAILABILITY_RANGE_BACKEND is enabled. Overlap between users stays on the
+# sweep over two index ordered scans, a range join probes the index once per slot and loses to it.
+#
+# usage: python -m src.range_backend migrate|rollback
+
+import sys
+
+from flask import current_app
+from sqlalchemy import func, literal_column, text
+
+from src.db import db
+
+SLOT = literal_column('availabilities.slot')
+
+# Merge each user's overlapping or consecutive slots, which the exclusion constraint would reject: rows are numbered
+# into islands of slots that overlap anything before them, the first row of an island takes the island's bounds and the
+# others are deleted.
+COALESCE_SLOTS = """
+    WITH ordered AS (
+        SELECT id, user_id, start_time, end_time,
+               CASE WHEN start_time <= max(end_time) OVER (
+                        PARTITION BY user_id ORDER BY start_time, id ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING)
+                    THEN 0 ELSE 1 END AS starts_island
+        FROM availabilities
+    ), islands AS (
+        SELECT id, user_id, start_time, end_time,
+               sum(starts_island) OVER (PARTITION BY user_id ORDER BY start_time, id) AS island
+        FROM ordered
+    ), merged AS (
+        SELECT user_id, island, min(id) AS keep_id, min(start_time) AS start_time, max(end_time) AS end_time
+        FROM islands GROUP BY user_id, island HAVING count(*) > 1
+    ), updated AS (
+        UPDATE availabilities a SET start_time = m.start_time, end_time = m.end_time
+        FROM merged m WHERE a.id = m.keep_id
+    )
+    DELETE FROM availabilities a USING islands i, merged m
+    WHERE a.id = i.id AND i.user_id = m.user_id AND i.island = m.island AND a.id <> m.keep_id
+    RETURNING a.user_id
+"""
+
+MIGRATE = [
+    "CREATE EXTENSION IF NOT EXISTS btree_gist",
+    "LOCK TABLE availabilities IN SHARE ROW EXCLUSIVE MODE",
+    COALESCE_SLOTS,
+    "ALTER TABLE availabilities ADD COLUMN IF NOT EXISTS slot int8range "
+    "GENERATED ALWAYS AS (int8range(start_time, end_time)) STORED",
+    # deferred, so a transaction can extend one slot over others before deleting them
+    "ALTER TABLE availabilities ADD CONSTRAINT availabilities_no_overlap "
+    "EXCLUDE USING gist (user_id WITH =, slot WITH &&) DEFERRABLE INITIALLY DEFERRED",
+]
+
+ROLLBACK = [
+    "ALTER TABLE availabilities DROP CONSTRAINT IF EXISTS availabilities_no_overlap",
+    "ALTER TABLE availabilities DROP COLUMN IF EXISTS slot",
+]
+
+def is_enabled() -> bool:
+    return bool(current_app.config.get('AVAILABILITY_RANGE_BACKEND'))
+
+
+def is_available() -> bool:
+    """ Whether the server ships the btree_gist extension the exclusion constraint needs (part of postgres contrib). """
+    query = text("SELECT count(*) FROM pg_available_extensions WHERE name = 'btree_gist'")
+    return db.session.execute(query).scalar() > 0
+
+
+def int8range(start_time: int, end_time: int):
+    return func.int8range(start_time, end_time)
+
+
+def migrate():
+    """ Convert the availabilities table to range storage, in one transaction. """
+    for statement in MIGRATE:
+        db.session.execute(text(statement))
+    db.session.commit()
+
+
+def rollback():
+    for statement in ROLLBACK:
+        db.session.execute(text(statement))
+    db.session.commit()
+
+
+if __name__ == '__main__':
+    from app import create_app
+
+    commands = {'migrate': migrate, 'rollback': rollback}
+    if len(sys.argv) != 2 or sys.argv[1] not in commands:
+        sys.exit("usage: python -m src.range_backend migrate|rollback")
+
+    with create_app().app_context():
+        commands[sys.argv[1]]()
+        print(f"{sys.argv[1]} done")
@@ -0,0 +1,194 @@
+# Recurring availability rules
+#
+# A rule such as "every weekday 9:00-17:00 in Europe/Berlin" is stored as one row and expanded into slots only for the
+# time range being read, day by day in the rule's timezone so the local hours hold across DST changes. Exceptions
+# (booked meetings, one off absences) are taken out of the expanded slots. Reads merge the result with the user's
+# materialized availability rows. Reads without an end expand rules up to RECURRENCE_HORIZON_DAYS ahead and reads
+# without a start as far back, set by configure_recurrence from the Flask config in app.py and from the environment in
+# asgi.py. Rules can't start further back than that either (services.add_availability_rule).
+
+import heapq
+import time
+from collections import defaultdict, deque
+from datetime import datetime, time as day_time, timedelta
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from sqlalchemy import Select, select
+
+from src.intervals import coalesce, subtract
+from src.models import AvailabilityException, AvailabilityRule, db
+
+DAY = 86400
+ONE_DAY = timedelta(days=1)
+
+Interval = Tuple[int, int]
+
+# days ahead of now that rules are expanded to for reads without an end, see configure_recurrence
+horizon_days = 365
+
+# exception rows fetched at a time, they are streamed in start time order whatever the range
+EXCEPTIONS_BATCH_SIZE = 100
+
+# rules are read as plain rows, expanding them needs no ORM instances
+RULE_COLUMNS = select(AvailabilityRule.user_id, AvailabilityRule.weekdays, AvailabilityRule.start_offset,
+                      AvailabilityRule.end_offset, AvailabilityRule.timezone, AvailabilityRule.valid_from,
+                      AvailabilityRule.valid_until)
+
+
+def init_recurrence(app):
+    configure_recurrence(app.config)
+
+
+def configure_recurrence(config: Mapping):
+    """ Set the expansion horizon from RECURRENCE_HORIZON_DAYS (default 365), for the sync and async read paths. """
+    global horizon_days
+    horizon_days = int(config.get('RECURRENCE_HORIZON_DAYS', 365))
+
+
+@lru_cache(maxsize=None)
+def _zone(name: str) -> ZoneInfo:
+    return ZoneInfo(name)
+
+
+def occurrences(rule, start_time: int, end_time: int) -> Iterator[Interval]:
+    """
+    Slots of a rule (an AvailabilityRule or a row of RULE_COLUMNS) overlapping [start_time, end_time), sorted by start
+    time and cut to the rule's validity.
+    """
+    # read the columns once, attribute access on a mapped instance is slow in the loop
+    weekdays, valid_from, valid_until = rule.weekdays, rule.valid_from, rule.valid_until
+    start_offset, end_offset = timedelta(seconds=rule.start_offset), timedelta(seconds=rule.end_offset)
+    low = max(start_time, valid_from)
+    high = end_time if valid_until is None else min(end_time, valid_until)
+    if low >= high:
+        return
+
+    zone = _zone(rule.timezone)
+    day = datetime.fromtimestamp(low, zone).date()
+    while True:
+        midnight = datetime.combine(day, day_time(), zone)
+        if midnight.timestamp() >= high:
+            return
+        if weekdays >> day.weekday() & 1:
+            # wall clock arithmetic, 9:00 stays 9:00 on the days the offset from UTC changes
+            start = max(int((midnight + start_offset).timestamp()), valid_from)
+            end = int((midnight + end_offset).timestamp())
+            if valid_until is not None:
+                end = min(end, valid_until)
+            if start < end and end > start_time and start < end_time:
+                yield start, end
+        day += ONE_DAY
+
+
+def rules_query(user_ids: Iterable[int]) -> Select:
+    return RULE_COLUMNS.where(AvailabilityRule.user_id.in_(list(user_ids)))
+
+
+def exceptions_query(user_ids: Iterable[int], start_time: int, end_time: int) -> Select:
+    exception = AvailabilityException
+    return select(exception.user_id, exception.start_time, exception.end_time).where(
+        exception.user_id.in_(list(user_ids)), exception.end_time > start_time, exception.start_time < end_time
+    ).order_by(exception.start_time)
+
+
+def expansion_range(start_time: Optional[int], end_time: Optional[int], horizon_days: int) -> Tuple[int, int]:
+    """ Range to expand rules over, an open end stops horizon_days from now and an open start as far back. """
+    now = int(time.time())
+    return (now - horizon_days * DAY if start_time is None else start_time,
+            now + horizon_days * DAY if end_time is None else end_time)
+
+
+def expand(rules: Iterable, exceptions: Iterable, start_time: int, end_time: int) -> Dict[int, Iterator[Interval]]:
+    """
+    Expand rule rows over [start_time, end_time) per user, without the exception rows. The exceptions are streamed in
+    start time order (see exceptions_query) and taken out as the expansion reaches them, so a range of any length is
+    read in constant memory.
+    """
+    by_user = defaultdict(list)
+    for rule in rules:
+        by_user[rule.user_id].append(rule)
+    removed = _split(exceptions, by_user)
+
+    return {user_id: subtract(heapq.merge(*(occurrences(rule, start_time, end_time) for rule in user_rules)),
+                              removed[user_id])
+            for user_id, user_rules in by_user.items()}
+
+
+def _split(rows: Iterable, user_ids: Iterable[int]) -> Dict[int, Iterator[Interval]]:
+    """
+    One lazy stream of (start, end) per user out of one stream of (user_id, start, end) rows. Rows of other users read
+    on the way are held until their own stream gets to them.
+    """
+    rows = iter(rows)
+    pending = {user_id: deque() for user_id in user_ids}
+
+    def user_rows(user_id: int) -> Iterator[Interval]:
+        held = pending[user_id]
+        while True:
+            if held:
+                yield held.popleft()
+                continue
+            row = next(rows, None)
+            if row is None:
+                return
+            other, start, end = row
+            if other == user_id:
+                yield start, end
+            elif other in pending:
+                pending[other].append((start, end))
+
+    return {user_id: user_rows(user_id) for user_id in pending}
+
+
+def recurring_slots(user_ids: Iterable[int], start_time: Optional[int] = None,
+                    end_time: Optional[int] = None) -> Dict[int, Iterator[Interval]]:
+    """
+    Lazily expanded recurring availability of the users that have rules, within [start_time, end_time) and without
+    their exceptions, sorted by start time. Without a start or an end, rules are expanded from or up to
+    RECURRENCE_HORIZON_DAYS away from now. Two queries, whatever the number of users.
+    """
+    rules = db.session.execute(rules_query(user_ids)).all()
+    if not rules:
+        return {}
+
+    start_time, end_time = expansion_range(start_time, end_time, horizon_days)
+    exceptions = db.session.execute(exceptions_query({rule.user_id for rule in rules}, start_time, end_time)
+                                    .execution_options(yield_per=EXCEPTIONS_BATCH_SIZE))
+    return expand(rules, exceptions, start_time, end_time)
+
+
+def within(slots: Iterable[Interval], start_time: Optional[int], end_time: Optional[int]) -> List[Interval]:
+    """ The slots entirely within a time range, the way availability reads filter materialized rows. """
+    return [(start, end) for start, end in slots
+            if (not start_time or start >= start_time) and (not end_time or end <= end_time)]
+
+
+def with_recurring(slots: Iterable[Interval], recurring: Optional[Iterator[Interval]]) -> Iterable[Interval]:
+    """ Merge materialized slots with recurring ones, both sorted by start time. """
+    if recurring is None:
+        return slots
+    return coalesce(heapq.merge(((start, end) for start, end in slots), recurring))
+
+
+def is_valid_timezone(name: str) -> bool:
+    try:
+        _zone(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return False
+    return True
+
+
+def has_rules(user_id: int) -> bool:
+    return db.session.query(AvailabilityRule.id).filter_by(user_id=user_id).first() is not None
+
+
+def as_rule(rule: AvailabilityRule) -> dict:
+    return {'id': rule.id, 'weekdays': [day for day in range(7) if rule.weekdays >> day & 1],
+            'start_offset': rule.start_offset, 'end_offset': rule.end_offset, 'timezone': rule.timezone,
+            'valid_from': rule.valid_from, 'valid_until': rule.valid_until}
+
+
+def as_rules(rules: List[AvailabilityRule]) -> List[dict]:
+    return [as_rule(rule) for rule in rules]
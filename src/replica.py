@@ -0,0 +1,154 @@
+# Read replica routing
+#
+# With DATABASE_REPLICA_URL set, the app gets a second engine, the 'replica' bind, and the service reads decorated with
+# reads_replica run their queries on it. Writes stay on the primary, and so does any read made by a session holding
+# changes of its own.
+#
+# A replica lags behind the primary, so once a write commits, reads of the users it touched go to the primary for
+# READ_YOUR_WRITES_SECONDS. A user sees their own change right away, and no reader caches a replica's stale copy of it
+# under the cache generation the write just bumped. The window is tracked in the process, or in redis when it is the
+# cache backend, so it holds across workers.
+
+import inspect
+import threading
+import time
+from collections import Counter
+from functools import wraps
+from typing import Callable, Iterable, Mapping, Optional
+
+from src.db import REPLICA, SHARD, db
+
+# reads served by each bind since the process started, exported on /metrics
+route_stats = Counter()
+
+
+class RecentWrites:
+    """ In-process record of the users written within the last seconds. """
+
+    MAX_USERS = 100000
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self._until = {}
+        self._lock = threading.Lock()
+
+    def mark(self, user_ids: Iterable[int]):
+        until = time.monotonic() + self.seconds
+        with self._lock:
+            if len(self._until) > self.MAX_USERS:
+                now = time.monotonic()
+                self._until = {user_id: expires for user_id, expires in self._until.items() if expires > now}
+            self._until.update((user_id, until) for user_id in user_ids)
+
+    def any(self, user_ids: Iterable[int]) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            return any(self._until.get(user_id, 0) > now for user_id in user_ids)
+
+
+class RedisRecentWrites:
+    """ Record of the recently written users shared by all workers, as keys expiring with the window. """
+
+    def __init__(self, client, seconds: float, prefix: str = 'calendly:wrote:'):
+        self.client = client
+        self.milliseconds = int(seconds * 1000)
+        self.prefix = prefix
+
+    def mark(self, user_ids: Iterable[int]):
+        pipeline = self.client.pipeline()
+        for user_id in user_ids:
+            pipeline.set(f'{self.prefix}{user_id}', 1, px=self.milliseconds)
+        pipeline.execute()
+
+    def any(self, user_ids: Iterable[int]) -> bool:
+        keys = [f'{self.prefix}{user_id}' for user_id in user_ids]
+        return bool(keys) and self.client.exists(*keys) > 0
+
+
+recent_writes = RecentWrites(5)
+
+
+def init_replica(app, client: Optional[object] = None):
+    configure_replica(app.config, client)
+
+
+def configure_replica(config: Mapping, client: Optional[object] = None):
+    """
+    Configure the read-your-writes window: READ_YOUR_WRITES_SECONDS long, kept in redis at REDIS_URL (or the given
+    client) when CACHE_BACKEND is redis, in the process otherwise.
+    """
+    global recent_writes
+    seconds = float(config.get('READ_YOUR_WRITES_SECONDS', 5))
+
+    if client is None and config.get('CACHE_BACKEND') == 'redis':
+        import redis
+
+        client = redis.Redis.from_url(config['REDIS_URL'])
+    recent_writes = RecentWrites(seconds) if client is None else RedisRecentWrites(client, seconds)
+
+
+def mark_written(user_ids: Iterable[int]):
+    """ Send reads of the users to the primary for the read-your-writes window, once their write committed. """
+    user_ids = list(user_ids)
+    if user_ids and REPLICA in db.engines:
+        recent_writes.mark(user_ids)
+
+
+def _use_replica(user_ids: Iterable[int]) -> bool:
+    session = db.session
+    # the replica is a copy of the default database, reads routed to another shard stay there
+    use = (REPLICA in db.engines and session.info.get(SHARD) is None
+           and not (session.new or session.dirty or session.deleted)
+           and not session.info.get('stale_users') and not recent_writes.any(user_ids))
+    route_stats[REPLICA if use else 'primary'] += 1
+    return use
+
+
+def user_arguments(signature: inspect.Signature, user_params: Iterable[str], args: tuple, kwargs: dict) -> list:
+    """ The user ids a call was given in the arguments named by user_params, each a user id or a list of them. """
+    arguments = signature.bind(*args, **kwargs).arguments
+    user_ids = []
+    for name in user_params:
+        value = arguments.get(name)
+        user_ids.extend(value if isinstance(value, (list, tuple, set)) else [value] if value else [])
+    return user_ids
+
+
+def reads_replica(*user_params: str) -> Callable:
+    """
+    Run a service read on the replica when one is configured. user_params name the arguments holding the user id, or
+    list of user ids, the read is about: it stays on the primary while one of them was written recently.
+    """
+
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        def users(args, kwargs) -> list:
+            return user_arguments(signature, user_params, args, kwargs)
+
+        if inspect.isgeneratorfunction(fn):
+            # the queries of a generator run as it is consumed, the bind is switched for its whole iteration
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                if db.session.info.get(REPLICA) or not _use_replica(users(args, kwargs)):
+                    yield from fn(*args, **kwargs)
+                    return
+                db.session.info[REPLICA] = True
+                try:
+                    yield from fn(*args, **kwargs)
+                finally:
+                    db.session.info.pop(REPLICA, None)
+        else:
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                if db.session.info.get(REPLICA) or not _use_replica(users(args, kwargs)):
+                    return fn(*args, **kwargs)
+                db.session.info[REPLICA] = True
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    db.session.info.pop(REPLICA, None)
+
+        return wrapper
+
+    return decorator
@@ -1,38 +1,109 @@
 # API routes
 
-from flask import Blueprint
-from flask_restx import Api, Resource, reqparse
+import json
+import time
+
+from flask import Blueprint, Response, current_app, make_response, stream_with_context
+from flask_restx import Api, Resource, inputs, representations, reqparse
 
 from src import services
+from src.cache import cache
 from src.api_exceptions import AvailabilityError, InvalidTimestampError, UserNotFoundError
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 bp = Blueprint('api', __name__)
 api = Api(bp, version='1.0', title='Calendly API', description='A simple API server for scheduling meetings', doc='/docs')
 
 
+@api.representation('application/json')
+def output_json(data, code, headers=None):
+    """ Serialize responses with orjson when it is installed, it encodes the slot lists several times faster. """
+    if orjson is None:
+        return representations.output_json(data, code, headers)
+
+    response = make_response(orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE), code)
+    response.headers.extend(headers or {})
+    return response
+
+
+def object_list(value, name: str) -> list:
+    """ reqparse type for a JSON array of objects, type=list would take a string for the list of its characters. """
+    if not isinstance(value, list) or not all(isinstance(item, dict) for item in value):
+        raise ValueError(f"{name} must be a list of objects")
+    return value
+
+
 @api.route('/admin/users')
 class Users(Resource):
+    MAX_PAGE_SIZE = 1000
+    parser = reqparse.RequestParser()
+    parser.add_argument('after_id', type=int, location='args')
+    parser.add_argument('limit', type=int, location='args')
+    parser.add_argument('stream', type=inputs.boolean, default=False, location='args')
+
+    def parse_args(self):
+        return self.parser.parse_args()
+
+    @api.doc(params={'after_id': '[Optional] Return users with an id greater than this cursor',
+                     'limit': '[Optional] Page size',
+                     'stream': '[Optional] Stream all users as one JSON array instead of a page'})
     def get(self):
-        """Get all users"""
-        users = services.get_all_users()
-        return [{"id": user.id, "name": user.name} for user in users]
+        """Get users sorted by id, a page at a time. The next page cursor is in the X-Next-Cursor header"""
+        args = self.parse_args()
+        if args['stream']:
+            return Response(stream_with_context(self._stream()), mimetype='application/json')
+
+        limit = current_app.config['USERS_PAGE_SIZE'] if args['limit'] is None else args['limit']
+        limit = min(limit, self.MAX_PAGE_SIZE)
+        if limit < 1:
+            return {"error": "limit must be positive"}, 400
+
+        # fetch one extra row to know whether there is a next page
+        users = services.get_users_page(args['after_id'], limit + 1)
+        if len(users) > limit:
+            users = users[:limit]
+            return users, 200, {'X-Next-Cursor': str(users[-1]['id'])}
+        return users
+
+    @staticmethod
+    def _stream():
+        yield '['
+        separator = ''
+        for batch in services.iter_users():
+            yield separator + ','.join(json.dumps(user) for user in batch)
+            separator = ','
+        yield ']'
+
+
+@api.route('/admin/cache')
+class CacheStats(Resource):
+    def get(self):
+        """Get hit and miss counters of the availability and overlap cache"""
+        return cache.stats()
 
 
 @api.route('/availability/<int:user_id>')
 class Availability(Resource):
+    range_parser = reqparse.RequestParser()
+    range_parser.add_argument('start_time', type=int, location='args')
+    range_parser.add_argument('end_time', type=int, location='args')
+    slot_parser = reqparse.RequestParser()
+    slot_parser.add_argument('start_time', type=int, required=True)
+    slot_parser.add_argument('end_time', type=int, required=True)
+
     def parse_args(self, required):
-        parser = reqparse.RequestParser()
-        parser.add_argument('start_time', type=int, required=required)
-        parser.add_argument('end_time', type=int, required=required)
-        return parser.parse_args()
+        return (self.slot_parser if required else self.range_parser).parse_args()
 
     @api.doc(params={'start_time': '[Optional] Min timestamp range', 'end_time': '[Optional] Max timestamp range'})
     def get(self, user_id):
         """Get availabilities for a user in a time range, sorted by start time"""
         args = self.parse_args(required=False)
 
-        availability = services.get_availability(user_id, args['start_time'], args['end_time'])
-        return [{"start_time": slot.start_time, "end_time": slot.end_time} for slot in availability]
+        return services.get_availability(user_id, args['start_time'], args['end_time'])
 
     @api.doc(params={'start_time': 'Start time of availability slot', 'end_time': 'End time of availability slot'})
     def post(self, user_id):
@@ -52,33 +123,223 @@ class Availability(Resource):
         return {"message": "Availability set successfully"}, 201
 
 
+@api.route('/availability/<int:user_id>/rules')
+class AvailabilityRules(Resource):
+    parser = reqparse.RequestParser()
+    parser.add_argument('weekdays', type=int, action='append', required=True)
+    parser.add_argument('start_offset', type=int, required=True)
+    parser.add_argument('end_offset', type=int, required=True)
+    parser.add_argument('valid_from', type=int, required=True)
+    parser.add_argument('valid_until', type=int)
+    parser.add_argument('timezone', type=str, default='UTC')
+
+    def parse_args(self):
+        return self.parser.parse_args()
+
+    def get(self, user_id):
+        """Get the recurring availability rules of a user"""
+        return services.get_availability_rules(user_id)
+
+    @api.doc(params={'weekdays': 'Days of the week the rule applies to, 0 is Monday and 6 is Sunday',
+                     'start_offset': 'Start of the daily slot, in seconds after local midnight',
+                     'end_offset': 'End of the daily slot, in seconds after local midnight (at most 86400)',
+                     'valid_from': 'Epoch timestamp the rule starts at',
+                     'valid_until': '[Optional] Epoch timestamp the rule ends at',
+                     'timezone': '[Optional] IANA timezone of the local days, UTC by default'})
+    def post(self, user_id):
+        """Make a user available every week on the given days"""
+        args = self.parse_args()
+
+        try:
+            rule = services.add_availability_rule(user_id, args['weekdays'], args['start_offset'], args['end_offset'],
+                                                  args['valid_from'], args['valid_until'], args['timezone'])
+        except UserNotFoundError:
+            return {"error": "user do not exist"}, 404
+        except (AvailabilityError, InvalidTimestampError) as e:
+            return {"error": str(e)}, 400
+
+        return rule, 201
+
+
+@api.route('/availability/<int:user_id>/rules/<int:rule_id>')
+class AvailabilityRule(Resource):
+    def delete(self, user_id, rule_id):
+        """Delete a recurring availability rule"""
+        if not services.delete_availability_rule(user_id, rule_id):
+            return {"error": "rule does not exist"}, 404
+        return {"message": "Rule deleted successfully"}, 200
+
+
+@api.route('/availability/<int:user_id>/exceptions')
+class AvailabilityExceptions(Resource):
+    parser = reqparse.RequestParser()
+    parser.add_argument('start_time', type=int, required=True)
+    parser.add_argument('end_time', type=int, required=True)
+
+    def parse_args(self):
+        return self.parser.parse_args()
+
+    @api.doc(params={'start_time': 'Start time of the absence', 'end_time': 'End time of the absence'})
+    def post(self, user_id):
+        """Take a period out of a user's recurring availability"""
+        args = self.parse_args()
+
+        try:
+            services.add_availability_exception(user_id, args['start_time'], args['end_time'])
+        except UserNotFoundError:
+            return {"error": "user do not exist"}, 404
+        except InvalidTimestampError as e:
+            return {"error": str(e)}, 400
+
+        return {"message": "Exception added successfully"}, 201
+
+
+@api.route('/availability/bulk')
+class BulkAvailability(Resource):
+    MAX_SLOTS = 10000
+    parser = reqparse.RequestParser()
+    parser.add_argument('slots', type=object_list, location='json', required=True, nullable=False)
+
+    def parse_args(self):
+        return self.parser.parse_args()
+
+    @api.doc(params={'slots': 'List of availability slots: [{"user_id": int, "start_time": int, "end_time": int}]'})
+    def post(self):
+        """Set many availability slots, for one or many users, in a single transaction"""
+        args = self.parse_args()
+        if len(args['slots']) > self.MAX_SLOTS:
+            return {"error": f"at most {self.MAX_SLOTS} slots are allowed"}, 400
+
+        results = services.bulk_set_availability(args['slots'])
+        created = sum(1 for result in results if result['status'] == 'created')
+        return {"created": created, "failed": len(results) - created, "results": results}, 200
+
+
 @api.route('/overlap')
 class Overlap(Resource):
+    MAX_PAGE_SIZE = 1000
+    parser = reqparse.RequestParser()
+    parser.add_argument('user1_id', type=int, required=True, location='args')
+    parser.add_argument('user2_id', type=int, required=True, location='args')
+    parser.add_argument('start_time', type=int, location='args')
+    parser.add_argument('end_time', type=int, location='args')
+    parser.add_argument('limit', type=int, location='args')
+    parser.add_argument('after', type=int, location='args')
 
     def parse_args(self):
-        parser = reqparse.RequestParser()
-        parser.add_argument('user1_id', type=int, required=True)
-        parser.add_argument('user2_id', type=int, required=True)
-        return parser.parse_args()
+        return self.parser.parse_args()
 
-    @api.doc(params={'user1_id': 'ID of first user', 'user2_id': 'ID of second user'})
+    @api.doc(params={'user1_id': 'ID of first user', 'user2_id': 'ID of second user',
+                     'start_time': '[Optional] Only search from this epoch timestamp',
+                     'end_time': '[Optional] Only search until this epoch timestamp',
+                     'limit': '[Optional] Page size, the next page cursor is in the X-Next-Cursor header',
+                     'after': '[Optional] Cursor, return the overlap after this epoch timestamp'})
     def get(self):
         """Get overlap between two users' availability"""
         args = self.parse_args()
-        overlap_slots = services.find_overlap(args['user1_id'], args['user2_id'])
+        start_time, end_time, limit = args['start_time'], args['end_time'], args['limit']
+        if args['after'] is not None:
+            start_time = args['after'] if start_time is None else max(start_time, args['after'])
+        if start_time is not None and end_time is not None and end_time <= start_time:
+            return {"error": "end_time must be after start_time"}, 400
+        if limit is None:
+            return services.find_overlap(args['user1_id'], args['user2_id'], start_time, end_time)
 
+        if not 1 <= limit <= self.MAX_PAGE_SIZE:
+            return {"error": f"limit must be between 1 and {self.MAX_PAGE_SIZE}"}, 400
+        # fetch one extra slot to know whether there is a next page
+        overlap_slots = services.find_overlap(args['user1_id'], args['user2_id'], start_time, end_time, limit + 1)
+        if len(overlap_slots) > limit:
+            overlap_slots = overlap_slots[:limit]
+            return overlap_slots, 200, {'X-Next-Cursor': str(overlap_slots[-1]['end_time'])}
         return overlap_slots
 
 
+@api.route('/overlap/group')
+class GroupOverlap(Resource):
+    MAX_GROUP_SIZE = 100
+    parser = reqparse.RequestParser()
+    parser.add_argument('user_ids', type=int, action='append', required=True, location='args')
+    parser.add_argument('start_time', type=int, location='args')
+    parser.add_argument('end_time', type=int, location='args')
+    parser.add_argument('min_duration', type=int, default=0, location='args')
+
+    def parse_args(self):
+        return self.parser.parse_args()
+
+    @api.doc(params={'user_ids': 'IDs of the users, repeat the parameter for every user (user_ids=1&user_ids=2)',
+                     'start_time': 'Only search from this epoch timestamp',
+                     'end_time': 'Only search until this epoch timestamp',
+                     'min_duration': 'Only return slots at least this many seconds long'})
+    def get(self):
+        """Get the common availability of a group of users"""
+        args = self.parse_args()
+        user_ids = set(args['user_ids'])
+        if len(user_ids) < 2:
+            return {"error": "at least two users are required"}, 400
+        if len(user_ids) > self.MAX_GROUP_SIZE:
+            return {"error": f"at most {self.MAX_GROUP_SIZE} users are allowed"}, 400
+        if args['start_time'] is not None and args['end_time'] is not None and args['start_time'] >= args['end_time']:
+            return {"error": "end_time must be after start_time"}, 400
+        if args['min_duration'] < 0:
+            return {"error": "min_duration must not be negative"}, 400
+
+        return services.find_group_overlap(list(user_ids), args['start_time'], args['end_time'], args['min_duration'])
+
+
+@api.route('/suggestions')
+class Suggestions(Resource):
+    MAX_GROUP_SIZE = 100
+    MAX_SUGGESTIONS = 100
+    parser = reqparse.RequestParser()
+    parser.add_argument('user_ids', type=int, action='append', required=True, location='args')
+    parser.add_argument('duration', type=int, required=True, location='args')
+    parser.add_argument('start_time', type=int, location='args')
+    parser.add_argument('end_time', type=int, location='args')
+    parser.add_argument('k', type=int, default=5, location='args')
+    parser.add_argument('step', type=int, location='args')
+
+    def parse_args(self):
+        return self.parser.parse_args()
+
+    @api.doc(params={'user_ids': 'IDs of the users, repeat the parameter for every user (user_ids=1&user_ids=2)',
+                     'duration': 'Meeting length in seconds',
+                     'start_time': 'Earliest meeting start, epoch timestamp (default now)',
+                     'end_time': 'Latest meeting end, epoch timestamp',
+                     'k': 'Number of suggestions',
+                     'step': 'Suggest a start every step seconds within a common slot, instead of one per slot'})
+    def get(self):
+        """Get the earliest meeting times at which all the users are available"""
+        args = self.parse_args()
+        user_ids = set(args['user_ids'])
+        start_time = int(time.time()) if args['start_time'] is None else args['start_time']
+        if len(user_ids) < 2:
+            return {"error": "at least two users are required"}, 400
+        if len(user_ids) > self.MAX_GROUP_SIZE:
+            return {"error": f"at most {self.MAX_GROUP_SIZE} users are allowed"}, 400
+        if args['duration'] <= 0:
+            return {"error": "duration must be positive"}, 400
+        if args['end_time'] is not None and start_time >= args['end_time']:
+            return {"error": "end_time must be after start_time"}, 400
+        if not 0 < args['k'] <= self.MAX_SUGGESTIONS:
+            return {"error": f"k must be between 1 and {self.MAX_SUGGESTIONS}"}, 400
+        if args['step'] is not None and args['step'] <= 0:
+            return {"error": "step must be positive"}, 400
+
+        return services.suggest_meetings(list(user_ids), args['duration'], start_time, args['end_time'], args['k'],
+                                         args['step'])
+
+
 @api.route('/meeting')
 class Meeting(Resource):
+    parser = reqparse.RequestParser()
+    parser.add_argument('user1_id', type=int, required=True)
+    parser.add_argument('user2_id', type=int, required=True)
+    parser.add_argument('meeting_start_time', type=int, required=True)
+    parser.add_argument('meeting_end_time', type=int, required=True)
+
     def parse_args(self):
-        parser = reqparse.RequestParser()
-        parser.add_argument('user1_id', type=int, required=True)
-        parser.add_argument('user2_id', type=int, required=True)
-        parser.add_argument('meeting_start_time', type=int, required=True)
-        parser.add_argument('meeting_end_time', type=int, required=True)
-        return parser.parse_args()
+        return self.parser.parse_args()
 
     @api.doc(params={'user1_id': 'ID of first user', 'user2_id': 'ID of second user',
                         'meeting_start_time': 'Start time of meeting', 'meeting_end_time': 'End time of meeting'})
@@ -98,3 +359,103 @@ class Meeting(Resource):
 
 
         return {"message": "Meeting scheduled successfully!"}, 201
+
+
+@api.route('/meeting/bulk')
+class BulkMeeting(Resource):
+    MAX_MEETINGS = 1000
+    parser = reqparse.RequestParser()
+    parser.add_argument('meetings', type=object_list, location='json', required=True, nullable=False)
+
+    def parse_args(self):
+        return self.parser.parse_args()
+
+    @api.doc(params={'meetings': 'List of meetings: [{"user1_id": int, "user2_id": int, "meeting_start_time": int, '
+                                 '"meeting_end_time": int}]'})
+    def post(self):
+        """Schedule many meetings in one transaction, each checked against availability and the rest of the batch"""
+        args = self.parse_args()
+        if len(args['meetings']) > self.MAX_MEETINGS:
+            return {"error": f"at most {self.MAX_MEETINGS} meetings are allowed"}, 400
+
+        results = services.bulk_schedule_meetings(args['meetings'])
+        scheduled = sum(1 for result in results if result['status'] == 'scheduled')
+        return {"scheduled": scheduled, "failed": len(results) - scheduled, "results": results}, 200
+
+
+@api.route('/calendar/<int:user_id>')
+class Calendar(Resource):
+    MAX_DAYS = 366
+    parser = reqparse.RequestParser()
+    parser.add_argument('start_time', type=int, required=True, location='args')
+    parser.add_argument('end_time', type=int, required=True, location='args')
+
+    def parse_args(self):
+        return self.parser.parse_args()
+
+    @api.doc(params={'start_time': 'Start of the time range', 'end_time': 'End of the time range'})
+    def get(self, user_id):
+        """Get a user's meetings and availability in a time range as one timeline, sorted by start time"""
+        args = self.parse_args()
+        if args['end_time'] <= args['start_time']:
+            return {"error": "end_time must be after start_time"}, 400
+        if args['end_time'] - args['start_time'] > self.MAX_DAYS * 86400:
+            return {"error": f"the time range can be at most {self.MAX_DAYS} days"}, 400
+
+        return services.get_calendar(user_id, args['start_time'], args['end_time'])
+
+
+@api.route('/freebusy/<int:user_id>')
+class FreeBusy(Resource):
+    BATCH_SIZE = 1000
+    FORMATS = {'ndjson': 'application/x-ndjson', 'ics': 'text/calendar'}
+    parser = reqparse.RequestParser()
+    parser.add_argument('start_time', type=int, required=True, location='args')
+    parser.add_argument('end_time', type=int, required=True, location='args')
+    parser.add_argument('format', choices=tuple(FORMATS), default='ndjson', location='args')
+
+    def parse_args(self):
+        return self.parser.parse_args()
+
+    @api.doc(params={'start_time': 'Start of the time range', 'end_time': 'End of the time range',
+                     'format': '[Optional] ndjson (default), one calendar entry per line, or ics, an iCalendar '
+                               'VFREEBUSY where availability is free and meetings are busy'})
+    def get(self, user_id):
+        """Export a user's free/busy time in a range of any length, streamed in start time order"""
+        args = self.parse_args()
+        if args['end_time'] <= args['start_time']:
+            return {"error": "end_time must be after start_time"}, 400
+
+        batches = services.iter_calendar(user_id, args['start_time'], args['end_time'], self.BATCH_SIZE)
+        stream = self._ndjson(batches) if args['format'] == 'ndjson' else self._ics(user_id, args, batches)
+        return Response(stream_with_context(stream), mimetype=self.FORMATS[args['format']])
+
+    @staticmethod
+    def _ndjson(batches):
+        for batch in batches:
+            if orjson is None:
+                yield ''.join(json.dumps(entry) + '\n' for entry in batch)
+            else:
+                yield b''.join(orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE) for entry in batch)
+
+    @staticmethod
+    def _ics(user_id, args, batches):
+        start, end = args['start_time'], args['end_time']
+        yield _ics_lines(['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//Calendly API//Free Busy//EN', 'METHOD:PUBLISH',
+                          'BEGIN:VFREEBUSY', f'UID:freebusy-{user_id}-{start}-{end}',
+                          f'DTSTAMP:{_ics_time(time.time())}', f'DTSTART:{_ics_time(start)}',
+                          f'DTEND:{_ics_time(end)}'])
+        for batch in batches:
+            # periods are clipped to the exported range, which the first one can start before
+            yield _ics_lines(f"FREEBUSY;FBTYPE={'FREE' if entry['type'] == 'availability' else 'BUSY'}:"
+                             f"{_ics_time(max(entry['start_time'], start))}/{_ics_time(min(entry['end_time'], end))}"
+                             for entry in batch)
+        yield _ics_lines(['END:VFREEBUSY', 'END:VCALENDAR'])
+
+
+def _ics_time(timestamp) -> str:
+    return time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(timestamp))
+
+
+def _ics_lines(lines) -> str:
+    return ''.join(line + '\r\n' for line in lines)
@@ -1,73 +1,449 @@
 # Business logic for handling availability and overlaps
+import heapq
+import random
 import time
-from typing import List
+from bisect import bisect_right
+from collections import Counter, defaultdict
+from functools import wraps
+from itertools import accumulate, groupby, islice
+from typing import Dict, Iterable, Iterator, List, Optional
 
-from sqlalchemy import text
+from sqlalchemy import Select, and_, event, func, insert, select, text, update
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session, aliased
 
+from src import bitmap, cross_shard, range_backend, recurrence
 from src.api_exceptions import AvailabilityError, InvalidTimestampError, UserNotFoundError
-from src.models import Availability, Meeting, User, db
+from src.cache import cache
+from src.intervals import clip, intersect, intersect_many, subtract
+from src.models import Availability, AvailabilityException, AvailabilityRule, Meeting, MeetingParticipant, User, db
+from src.recurrence import with_recurring
+from src.replica import mark_written, reads_replica
+from src.sharding import on_shard
 
 
-def get_all_users() -> List[User]:
-    return User.query.all()
+# Postgres SQLSTATEs worth retrying: serialization_failure and deadlock_detected
+RETRYABLE_SQLSTATES = {'40001', '40P01'}
+MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 0.01  # seconds, doubled on every attempt
+
+# rows fetched at a time when availability is read lazily
+STREAM_BATCH_SIZE = 100
+
+retry_stats = Counter()
+# existing slots merged into new ones by availability writes
+merge_stats = Counter()
+
+
+def retry_on_conflict(fn):
+    """
+    Run a write transaction, retrying it with bounded exponential backoff and jitter when the database aborts it on a
+    serialization conflict or deadlock. Any other error rolls the transaction back and is raised as is.
+    """
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                return fn(*args, **kwargs)
+            except DBAPIError as e:
+                db.session.rollback()
+                if getattr(e.orig, 'pgcode', None) not in RETRYABLE_SQLSTATES or attempt == MAX_ATTEMPTS:
+                    raise
+                retry_stats['retries'] += 1
+                time.sleep(random.uniform(0, RETRY_BASE_DELAY * 2 ** attempt))
+            except Exception:
+                db.session.rollback()
+                raise
+
+    return wrapper
+
+
+def _lock_users(*user_ids: int) -> List[User]:
+    """
+    Lock the rows of the given users until the transaction ends. Rows are locked in id order, so transactions touching
+    the same users always queue up instead of deadlocking.
+    """
+    return db.session.query(User).filter(User.id.in_(set(user_ids))).order_by(User.id).with_for_update().all()
+
+
+def _invalidate(user_id: int):
+    """ Mark a user's cached availability stale, it is dropped once the transaction commits. """
+    db.session.info.setdefault('stale_users', set()).add(user_id)
+
 
+@event.listens_for(Session, 'after_commit')
+def _invalidate_stale_users(session: Session):
+    stale_users = session.info.pop('stale_users', ())
+    for user_id in stale_users:
+        cache.invalidate_user(user_id)
+        bitmap.bitmaps.invalidate_user(user_id)
+    mark_written(stale_users)
 
-def get_availability(user_id: int, start_time: int, end_time: int) -> List[Availability]:
-    availability =  Availability.query.filter(Availability.user_id == user_id)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_stale_users(session: Session, previous_transaction):
+    session.info.pop('stale_users', None)
+
+
+# Read queries are built apart from their execution, so the async read path (src/async_services.py) shares them
+
+
+def users_page_query(after_id: Optional[int], limit: int) -> Select:
+    users = select(User.id, User.name).order_by(User.id)
+    if after_id:
+        users = users.where(User.id > after_id)
+    return users.limit(limit)
+
+
+def availability_query(user_id: int, start_time: Optional[int] = None, end_time: Optional[int] = None) -> Select:
+    """ (start_time, end_time) of a user's availability in a time range, sorted by start time. """
+    availability = select(Availability.start_time, Availability.end_time).where(Availability.user_id == user_id)
     if start_time:
-        availability = availability.filter(Availability.start_time >= start_time)
+        availability = availability.where(Availability.start_time >= start_time)
     if end_time:
-        availability = availability.filter(Availability.end_time <= end_time)
-    return availability.order_by(Availability.start_time).all()
+        availability = availability.where(Availability.end_time <= end_time)
+    return availability.order_by(Availability.start_time)
 
-def find_overlap(user1_id: int, user2_id: int) -> List[dict]:
+
+def availability_window_query(user_id: int, start_time: Optional[int] = None, end_time: Optional[int] = None) -> Select:
     """
-    return a list of overlapping time slots between two users, in the format: [{"start_time": int, "end_time": int}]
+    (start_time, end_time) of a user's slots overlapping [start_time, end_time), either bound may be open, sorted by
+    start time. A range scan of the (user_id, start_time) index, see _window.
     """
+    availability = select(Availability.start_time, Availability.end_time).where(Availability.user_id == user_id)
+    return _window(availability, Availability, user_id, start_time, end_time).order_by(Availability.start_time)
 
-    query = """
-        SELECT 
-            GREATEST(a1.start_time, a2.start_time) AS overlap_start,
-            LEAST(a1.end_time, a2.end_time) AS overlap_end
-        FROM 
-            availabilities a1
-        JOIN 
-            availabilities a2 
-        ON 
-            a1.user_id = :user1_id AND a2.user_id = :user2_id
-        WHERE 
-            GREATEST(a1.start_time, a2.start_time) < LEAST(a1.end_time, a2.end_time)
-        """
 
-    result = db.session.execute(text(query), {'user1_id': user1_id, 'user2_id': user2_id})
-    overlaps = [{'start_time': row[0], 'end_time': row[1]} for row in result]
+def meetings_window_query(user_id: int, start_time: int, end_time: int) -> Select:
+    """
+    (meeting_id, start_time, end_time, other participant) of a user's meetings overlapping [start_time, end_time),
+    one row per other participant, sorted by start time. A meeting of the user with themselves has a single row, its
+    other participant NULL.
+    """
+    participant, other = MeetingParticipant, aliased(MeetingParticipant)
+    meetings = select(participant.meeting_id, participant.start_time, participant.end_time, other.user_id).outerjoin(
+        other, and_(other.meeting_id == participant.meeting_id, other.user_id != participant.user_id)).where(
+        participant.user_id == user_id)
+    return _window(meetings, participant, user_id, start_time, end_time).order_by(participant.start_time,
+                                                                                    participant.meeting_id)
+
+
+def slots_query(user_ids: List[int], start_time: Optional[int] = None, end_time: Optional[int] = None) -> Select:
+    """ (user_id, start_time, end_time) of the users' slots overlapping [start_time, end_time), by user and start. """
+    slots = select(Availability.user_id, Availability.start_time, Availability.end_time).where(
+        Availability.user_id.in_(user_ids))
+    if start_time is not None:
+        slots = slots.where(Availability.end_time > start_time)
+    if end_time is not None:
+        slots = slots.where(Availability.start_time < end_time)
+    return slots.order_by(Availability.user_id, Availability.start_time)
+
+
+def _window(query: Select, model, user_id: int, start_time: Optional[int], end_time: Optional[int]) -> Select:
+    """
+    Restrict a query of a user's rows of model, which don't overlap each other, to those overlapping
+    [start_time, end_time). Both bounds are on start_time, a range scan of the (user_id, start_time) index: the only
+    row starting before the window that can reach into it is the last one, and the lower bound is moved to it when it
+    does, so the scan stays one ordered index range.
+    """
+    if end_time is not None:
+        query = query.where(model.start_time < end_time)
+    if start_time is None:
+        return query
 
-    return overlaps
+    before = select(model.start_time, model.end_time).where(
+        model.user_id == user_id, model.start_time < start_time).order_by(model.start_time.desc()).limit(1).subquery()
+    low = select(before.c.start_time).where(before.c.end_time > start_time).scalar_subquery()
+    return query.where(model.start_time >= func.coalesce(low, start_time))
 
 
-def check_availability(user_id: int, start_time: int, end_time: int) -> bool:
-    """ Check if a user has availability during the requested meeting time directly in the database. """
-    result = db.session.query(Availability).filter(Availability.user_id == user_id,
-                                                   Availability.start_time <= start_time,
-                                                   Availability.end_time >= end_time).first()
+def as_users(rows: Iterable[tuple]) -> List[dict]:
+    return [{'id': user_id, 'name': name} for user_id, name in rows]
+
+
+def as_slots(rows: Iterable[tuple]) -> List[dict]:
+    return [{'start_time': start, 'end_time': end} for start, end in rows]
+
+
+@on_shard(across=cross_shard.get_all_users)
+@reads_replica()
+def get_all_users() -> List[User]:
+    return User.query.all()
+
+
+@on_shard(across=cross_shard.get_users_page)
+@reads_replica()
+def get_users_page(after_id: Optional[int], limit: int) -> List[dict]:
+    """ Keyset pagination over users: up to limit users with an id greater than after_id, sorted by id. """
+    return as_users(db.session.execute(users_page_query(after_id, limit)))
+
+
+@on_shard(across=cross_shard.iter_users)
+@reads_replica()
+def iter_users(batch_size: int = 1000) -> Iterator[List[dict]]:
+    """ Stream all users sorted by id in batches, from a server side cursor so memory stays flat. """
+    result = db.session.execute(select(User.id, User.name).order_by(User.id).execution_options(yield_per=batch_size))
+    for batch in result.partitions():
+        yield as_users(batch)
+
+
+@on_shard('user_id')
+@reads_replica('user_id')
+def get_availability(user_id: int, start_time: int, end_time: int) -> List[dict]:
+    """
+    return a user's availability in a time range, in the format: [{"start_time": int, "end_time": int}]
+    sorted by start time.
+    """
+
+    def load():
+        slots = db.session.execute(availability_query(user_id, start_time, end_time))
+        recurring = recurrence.recurring_slots([user_id], start_time, end_time).get(user_id)
+        if recurring is not None:
+            # like the rows, only slots entirely within the range are returned
+            slots = recurrence.within(with_recurring(slots, recurring), start_time, end_time)
+        return as_slots(slots)
+
+    return cache.get_or_load('availability', [user_id], (start_time, end_time), load)
+
+
+@on_shard('user_id')
+@reads_replica('user_id')
+def get_calendar(user_id: int, start_time: int, end_time: int) -> List[dict]:
+    """
+    return a user's meetings and availability overlapping [start_time, end_time) as one timeline sorted by start time,
+    in the format: [{"type": "availability", "start_time": int, "end_time": int},
+                    {"type": "meeting", "id": int, "start_time": int, "end_time": int, "participants": [int]}]
+    where participants are the other users of the meeting. Both come from index range scans on (user_id, start_time)
+    and are merged in a single pass.
+    """
+    return cache.get_or_load('calendar', [user_id], (start_time, end_time),
+                             lambda: list(_timeline(user_id, start_time, end_time)))
+
+
+@on_shard('user_id')
+@reads_replica('user_id')
+def iter_calendar(user_id: int, start_time: int, end_time: int,
+                  batch_size: int = STREAM_BATCH_SIZE) -> Iterator[List[dict]]:
+    """
+    Stream the get_calendar timeline in batches, from server side cursors so memory stays flat whatever the range.
+    Not cached, it is meant for exports of ranges too large to hold.
+    """
+    timeline = _timeline(user_id, start_time, end_time, batch_size)
+    while True:
+        batch = list(islice(timeline, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _timeline(user_id: int, start_time: int, end_time: int, batch_size: Optional[int] = None) -> Iterator[dict]:
+    options = {} if batch_size is None else {'yield_per': batch_size}
+    recurring = recurrence.recurring_slots([user_id], start_time, end_time).get(user_id)
+    slots = with_recurring(db.session.execute(
+        availability_window_query(user_id, start_time, end_time).execution_options(**options)), recurring)
+    meetings = groupby(db.session.execute(
+        meetings_window_query(user_id, start_time, end_time).execution_options(**options)), key=lambda row: row[:3])
+    return heapq.merge(
+        ({'type': 'availability', 'start_time': start, 'end_time': end} for start, end in slots),
+        ({'type': 'meeting', 'id': meeting_id, 'start_time': start, 'end_time': end,
+          'participants': [row[3] for row in rows if row[3] is not None]}
+         for (meeting_id, start, end), rows in meetings),
+        key=lambda entry: entry['start_time'])
+
+
+@on_shard('user1_id', 'user2_id', across=cross_shard.find_overlap)
+@reads_replica('user1_id', 'user2_id')
+def find_overlap(user1_id: int, user2_id: int, start_time: Optional[int] = None, end_time: Optional[int] = None,
+                 limit: Optional[int] = None) -> List[dict]:
+    """
+    return a list of overlapping time slots between two users, optionally cut to [start_time, end_time) and only the
+    first limit of them, in the format: [{"start_time": int, "end_time": int}] sorted by start time.
+    """
+
+    def load():
+        recurring = recurrence.recurring_slots([user1_id, user2_id], start_time, end_time)
+        results = [db.session.execute(availability_window_query(user_id, start_time, end_time).execution_options(
+            yield_per=STREAM_BATCH_SIZE)) for user_id in (user1_id, user2_id)]
+        try:
+            slots1, slots2 = (with_recurring(result, recurring.get(user_id))
+                              for user_id, result in zip((user1_id, user2_id), results))
+            return as_slots(islice(clip(intersect(slots1, slots2), start_time, end_time), limit))
+        finally:
+            for result in results:
+                result.close()
+
+    # overlap is symmetric, both orders share an entry
+    return cache.get_or_load('overlap', sorted((user1_id, user2_id)), (start_time, end_time, limit), load)
+
+
+@on_shard('user_ids', across=cross_shard.find_group_overlap)
+@reads_replica('user_ids')
+def find_group_overlap(user_ids: List[int], start_time: Optional[int] = None, end_time: Optional[int] = None,
+                       min_duration: int = 0) -> List[dict]:
+    """
+    return the time slots in which all the given users are available, optionally within [start_time, end_time) and at
+    least min_duration seconds long, in the format: [{"start_time": int, "end_time": int}] sorted by start time.
+    """
+    user_ids = sorted(set(user_ids))
+    recurring = recurrence.recurring_slots(user_ids, start_time, end_time)
+    # bitmaps hold materialized slots only
+    if bitmap.is_enabled() and not recurring:
+        return _find_group_overlap_bitmap(user_ids, start_time, end_time, min_duration)
+
+    slots = _user_slots(user_ids, start_time, end_time, recurring)
+    # a user without any availability leaves nothing in common, the intersection stops at once
+    common = clip(intersect_many([slots[user_id] for user_id in user_ids]), start_time, end_time)
+    return as_slots((start, end) for start, end in common if end - start >= max(min_duration, 1))
+
+
+def _user_slots(user_ids: List[int], start_time: Optional[int], end_time: Optional[int],
+                recurring: Optional[dict] = None) -> Dict[int, List[tuple]]:
+    """ Each user's slots overlapping [start_time, end_time), recurring ones included, sorted by start time. """
+    if recurring is None:
+        recurring = recurrence.recurring_slots(user_ids, start_time, end_time)
+    rows = db.session.execute(slots_query(user_ids, start_time, end_time))
+    slots = {user_id: [(start, end) for _, start, end in user_rows]
+             for user_id, user_rows in groupby(rows, key=lambda row: row[0])}
+    return {user_id: list(with_recurring(slots.get(user_id, []), recurring.get(user_id))) for user_id in user_ids}
+
+
+def _find_group_overlap_bitmap(user_ids: List[int], start_time: Optional[int], end_time: Optional[int],
+                               min_duration: int) -> List[dict]:
+    bitmaps = bitmap.bitmaps.get(user_ids)
+    if any(user_bitmap is None for user_bitmap in bitmaps):
+        return []
+
+    # without a window, search the span all the bitmaps cover
+    granularity = bitmap.bitmaps.granularity
+    if start_time is None:
+        start_time = max(user_bitmap.origin for user_bitmap in bitmaps) * granularity
+    if end_time is None:
+        end_time = min(user_bitmap.end for user_bitmap in bitmaps) * granularity
+    return as_slots(bitmap.free_periods(bitmaps, granularity, start_time, end_time, min_duration))
+
+
+@on_shard('user_ids', across=cross_shard.suggest_meetings)
+@reads_replica('user_ids')
+def suggest_meetings(user_ids: List[int], duration: int, start_time: int, end_time: Optional[int] = None, k: int = 5,
+                     step: Optional[int] = None) -> List[dict]:
+    """
+    return the k earliest meetings of the given duration in which all the given users are available, within
+    [start_time, end_time), in the format: [{"start_time": int, "end_time": int}] sorted by start time.
+    Without a step there is one suggestion per common slot, with one every step seconds are suggested along it.
 
-    return result is not None
+    Every user's slots are read lazily in start time order from a server side cursor, and the reads stop as soon as k
+    suggestions are found, so a user's full history is never loaded.
+    """
+    user_ids = sorted(set(user_ids))
+    recurring = recurrence.recurring_slots(user_ids, start_time, end_time)
+    results = []
+    for user_id in user_ids:
+        slots = availability_window_query(user_id, start_time, end_time)
+        results.append(db.session.execute(slots.execution_options(yield_per=STREAM_BATCH_SIZE)))
+
+    try:
+        streams = [with_recurring(result, recurring.get(user_id)) for user_id, result in zip(user_ids, results)]
+        return as_slots(_suggestions(intersect_many(streams), duration, start_time, end_time, k, step))
+    finally:
+        for result in results:
+            result.close()
+
+
+def _suggestions(common: Iterable[tuple], duration: int, start_time: int, end_time: Optional[int], k: int,
+                 step: Optional[int]) -> List[tuple]:
+    """ The k earliest meetings of the duration within the common slots and [start_time, end_time). """
+    suggestions = []
+    for start, end in common:
+        start, end = max(start, start_time), end if end_time is None else min(end, end_time)
+        while start + duration <= end and len(suggestions) < k:
+            suggestions.append((start, start + duration))
+            if step is None:
+                break
+            start += step
+        if len(suggestions) == k:
+            break
+    return suggestions
 
 
+def check_availability(user_id: int, start_time: int, end_time: int) -> bool:
+    """ Check if a user has availability during the requested meeting time directly in the database. """
+    if range_backend.is_enabled():
+        contains = range_backend.SLOT.op('@>')(range_backend.int8range(start_time, end_time))
+    else:
+        contains = (Availability.start_time <= start_time) & (Availability.end_time >= end_time)
+    result = db.session.query(Availability.id).filter(Availability.user_id == user_id, contains).first()
+    if result is not None:
+        return True
+
+    recurring = recurrence.recurring_slots([user_id], start_time, end_time).get(user_id)
+    if recurring is None:
+        return False
+    # the requested time can span a slot and a recurring one next to it
+    slots = db.session.execute(availability_query(user_id).where(Availability.end_time >= start_time,
+                                                                 Availability.start_time <= end_time))
+    return any(start <= start_time and end >= end_time for start, end in with_recurring(slots, recurring))
+
+
+# Set a slot and normalize the user's slots around it in one statement: unless a slot already covers it, or the user has
+# recurring rules (their slots can cover it too, see check_availability), delete every slot it overlaps or touches and
+# insert their union. Slots of a user never overlap or touch, so only the last one starting before the new slot can
+# reach it and the delete is one range of the (user_id, start_time) index. Every part reads the slots as they were
+# before the statement.
+NORMALIZE_SLOT = text("""
+    WITH covered AS (
+        SELECT 1 FROM (
+            SELECT end_time FROM availabilities WHERE user_id = :user_id AND start_time <= :start_time
+            ORDER BY start_time DESC LIMIT 1
+        ) last WHERE end_time >= :end_time
+    ), rules AS (
+        SELECT 1 FROM availability_rules WHERE user_id = :user_id LIMIT 1
+    ), absorbed AS (
+        DELETE FROM availabilities
+        WHERE user_id = :user_id AND start_time <= :end_time AND start_time >= COALESCE((
+            SELECT start_time FROM (
+                SELECT start_time, end_time FROM availabilities WHERE user_id = :user_id AND start_time < :start_time
+                ORDER BY start_time DESC LIMIT 1
+            ) last WHERE end_time >= :start_time), :start_time)
+          AND NOT EXISTS (SELECT 1 FROM covered) AND NOT EXISTS (SELECT 1 FROM rules)
+        RETURNING start_time, end_time
+    ), inserted AS (
+        INSERT INTO availabilities (user_id, start_time, end_time)
+        SELECT :user_id, LEAST(:start_time, min(start_time)), GREATEST(:end_time, max(end_time)) FROM absorbed
+        HAVING NOT EXISTS (SELECT 1 FROM covered) AND NOT EXISTS (SELECT 1 FROM rules)
+        RETURNING id
+    )
+    SELECT EXISTS (SELECT 1 FROM covered), EXISTS (SELECT 1 FROM rules), (SELECT count(*) FROM absorbed)
+""")
+
+
+@on_shard('user_id')
+@retry_on_conflict
 def set_user_availability(user_id: int, start_time: int, end_time: int):
-    user = User.query.get(user_id)
-    if not user:
+    if not _lock_users(user_id):
         raise UserNotFoundError("User does not exist")
 
     if not is_valid_timestamps(start_time, end_time):
         raise InvalidTimestampError("Invalid timestamps")
 
+    if db.engine.dialect.name == 'postgresql':
+        covered, has_rules, absorbed = db.session.execute(NORMALIZE_SLOT, {
+            'user_id': user_id, 'start_time': start_time, 'end_time': end_time}).one()
+        if covered:
+            raise AvailabilityError("User is already available in the requested time")
+        if not has_rules:
+            merge_stats['absorbed'] += absorbed
+            _invalidate(user_id)
+            db.session.commit()
+            return
+
     # user is already available for a bigger time slot
     if check_availability(user_id, start_time, end_time):
         raise AvailabilityError("User is already available in the requested time")
 
     # Check if after inserting it will result in consecutive slots, if yes, merge them
     merged = merge_slots(user_id, end_time, start_time)
+    _invalidate(user_id)
 
     if not merged:
         availability = Availability(user_id=user_id, start_time=start_time, end_time=end_time)
@@ -77,55 +453,221 @@ def set_user_availability(user_id: int, start_time: int, end_time: int):
 
 
 def merge_slots(user_id: int, end_time: int, start_time: int) -> bool:
-    consecutive_slots = Availability.query.filter(
-        Availability.user_id == user_id,
-        ((Availability.end_time >= start_time) & (Availability.start_time <= start_time))
-        | ((Availability.start_time <= end_time) & (Availability.end_time >= end_time))
-    ).all()
-
-    if consecutive_slots:
-        for slot in consecutive_slots:
-            if slot.end_time >= start_time >= slot.start_time:
-                slot.end_time = end_time
-            elif slot.start_time <= end_time <= slot.end_time:
-                slot.start_time = start_time
-        return True
+    """
+    Merge a new slot with every slot of the user it overlaps or touches: the first of them takes the bounds of the
+    union and the others are deleted. Returns whether there was any to merge with.
+    """
+    _invalidate(user_id)
+    if range_backend.is_enabled():
+        # [start_time - 1, end_time + 1) overlaps exactly the slots with end_time >= start and start_time <= end, all
+        # found with one GiST index scan
+        touching = range_backend.SLOT.op('&&')(range_backend.int8range(start_time - 1, end_time + 1))
+    else:
+        touching = (Availability.end_time >= start_time) & (Availability.start_time <= end_time)
+    slots = Availability.query.filter(Availability.user_id == user_id, touching).order_by(Availability.start_time).all()
+
+    if not slots:
+        return False
 
-    engulfing_slot = Availability.query.filter(
-        Availability.user_id == user_id,
-        Availability.start_time >= start_time,
-        Availability.end_time <= end_time
-    ).first()
+    slots[0].start_time = min(start_time, slots[0].start_time)
+    slots[0].end_time = max([end_time] + [slot.end_time for slot in slots])
+    for slot in slots[1:]:
+        db.session.delete(slot)
+    merge_stats['absorbed'] += len(slots)
+    return True
 
-    if engulfing_slot:
-        engulfing_slot.start_time = start_time
-        engulfing_slot.end_time = end_time
-        return True
 
-    return False
+@on_shard(across=cross_shard.bulk_set_availability)
+@retry_on_conflict
+def bulk_set_availability(slots: List[dict]) -> List[dict]:
+    """
+    Set availability slots for one or many users in a single transaction.
+    Slots are validated like set_user_availability, coalesced in memory with each user's existing slots and written
+    back with one bulk insert, update and delete. Returns a result per slot, in the format:
+    [{"index": int, "status": "created"}] or [{"index": int, "status": "error", "error": str}]
+    """
+    results = [{'index': index, 'status': 'created'} for index in range(len(slots))]
+
+    def fail(index: int, error: str):
+        results[index] = {'index': index, 'status': 'error', 'error': error}
+
+    new_slots = defaultdict(list)
+    for index, slot in enumerate(slots):
+        try:
+            user_id, start_time, end_time = int(slot['user_id']), int(slot['start_time']), int(slot['end_time'])
+        except (KeyError, TypeError, ValueError):
+            fail(index, "Slot must have user_id, start_time and end_time")
+            continue
+
+        if not is_valid_timestamps(start_time, end_time):
+            fail(index, "Invalid timestamps")
+            continue
+        new_slots[user_id].append((start_time, end_time, index))
+
+    existing_users = {user.id for user in _lock_users(*new_slots)}
+    existing_rows = db.session.query(Availability.user_id, Availability.id, Availability.start_time,
+                                     Availability.end_time).filter(Availability.user_id.in_(existing_users)).order_by(
+        Availability.user_id, Availability.start_time).all()
+    existing_slots = {user_id: [(start, end, slot_id) for _, slot_id, start, end in rows]
+                      for user_id, rows in groupby(existing_rows, key=lambda row: row[0])}
+
+    inserts, updates, deletes = [], [], []
+    for user_id, user_slots in new_slots.items():
+        if user_id not in existing_users:
+            for _, _, index in user_slots:
+                fail(index, "User does not exist")
+            continue
+
+        existing = existing_slots.get(user_id, [])
+        # latest end time among the existing slots up to each position, to find a covering slot with one bisect
+        starts = [slot[0] for slot in existing]
+        reach = list(accumulate((slot[1] for slot in existing), max))
+
+        accepted = []
+        for start_time, end_time, index in user_slots:
+            position = bisect_right(starts, start_time) - 1
+            # user is already available for a bigger time slot
+            if position >= 0 and reach[position] >= end_time:
+                fail(index, "User is already available in the requested time")
+            else:
+                accepted.append((start_time, end_time, None))
+
+        accepted.sort(key=lambda slot: slot[0])
+        if accepted:
+            _invalidate(user_id)
+        _diff_slots(user_id, existing, accepted, inserts, updates, deletes)
+
+    if inserts:
+        db.session.execute(insert(Availability), inserts)
+    if updates:
+        db.session.execute(update(Availability), updates)
+    if deletes:
+        db.session.query(Availability).filter(Availability.id.in_(deletes)).delete(synchronize_session=False)
+    db.session.commit()
+
+    return results
 
 
+def _diff_slots(user_id: int, existing: List[tuple], new: List[tuple], inserts: List[dict], updates: List[dict],
+                deletes: List[int]):
+    """
+    Coalesce a user's existing (start, end, id) slots with new (start, end, None) ones, both sorted by start time, and
+    collect the rows to insert, update and delete so the table holds exactly the coalesced slots.
+    """
+    merged = None
+    for start, end, slot_id in heapq.merge(existing, new, key=lambda slot: slot[0]):
+        if merged is not None and start <= merged[1]:
+            merged[1] = max(merged[1], end)
+            merged[2].append(slot_id)
+            continue
+        if merged is not None:
+            _flush_merged(user_id, merged, inserts, updates, deletes)
+        merged = [start, end, [slot_id]]
+
+    if merged is not None:
+        _flush_merged(user_id, merged, inserts, updates, deletes)
+
+
+def _flush_merged(user_id: int, merged: list, inserts: List[dict], updates: List[dict], deletes: List[int]):
+    start, end, slot_ids = merged
+    row_ids = [slot_id for slot_id in slot_ids if slot_id is not None]
+    if not row_ids:
+        inserts.append({'user_id': user_id, 'start_time': start, 'end_time': end})
+        return
+
+    # reuse the first existing row for the merged slot, the rest were absorbed into it
+    if len(slot_ids) > 1:
+        updates.append({'id': row_ids[0], 'start_time': start, 'end_time': end})
+    deletes.extend(row_ids[1:])
+
+
+@on_shard('user_id')
+@reads_replica('user_id')
+def get_availability_rules(user_id: int) -> List[dict]:
+    return recurrence.as_rules(AvailabilityRule.query.filter_by(user_id=user_id).order_by(AvailabilityRule.id).all())
+
+
+@on_shard('user_id')
+@retry_on_conflict
+def add_availability_rule(user_id: int, weekdays: List[int], start_offset: int, end_offset: int, valid_from: int,
+                          valid_until: Optional[int] = None, timezone: str = 'UTC') -> dict:
+    """ Make a user available every given weekday (0 is Monday) between two offsets from local midnight. """
+    if not _lock_users(user_id):
+        raise UserNotFoundError("User does not exist")
+
+    if not weekdays or any(day not in range(7) for day in weekdays):
+        raise AvailabilityError("weekdays must be between 0 (Monday) and 6 (Sunday)")
+    if not 0 <= start_offset < end_offset <= recurrence.DAY:
+        raise InvalidTimestampError("Invalid offsets, they must be within a day and start before they end")
+    # reads with an early start expand a rule from its valid_from, keep that within the expansion horizon
+    current_time = int(time.time())
+    if valid_from < current_time - recurrence.horizon_days * recurrence.DAY:
+        raise InvalidTimestampError("Invalid valid_from, rules can't start more than RECURRENCE_HORIZON_DAYS ago")
+    if valid_until is not None and (valid_until <= valid_from or valid_until <= current_time):
+        raise InvalidTimestampError("Invalid timestamps")
+    if not recurrence.is_valid_timezone(timezone):
+        raise AvailabilityError(f"Unknown timezone {timezone}")
+
+    rule = AvailabilityRule(user_id=user_id, weekdays=sum(1 << day for day in set(weekdays)), start_offset=start_offset,
+                            end_offset=end_offset, timezone=timezone, valid_from=valid_from, valid_until=valid_until)
+    db.session.add(rule)
+    _invalidate(user_id)
+    db.session.commit()
+    return recurrence.as_rule(rule)
+
+
+@on_shard('user_id')
+@retry_on_conflict
+def delete_availability_rule(user_id: int, rule_id: int) -> bool:
+    deleted = AvailabilityRule.query.filter_by(id=rule_id, user_id=user_id).delete()
+    _invalidate(user_id)
+    db.session.commit()
+    return deleted > 0
+
+
+@on_shard('user_id')
+@retry_on_conflict
+def add_availability_exception(user_id: int, start_time: int, end_time: int):
+    """ Take a period out of a user's recurring availability, such as a day off. """
+    if not _lock_users(user_id):
+        raise UserNotFoundError("User does not exist")
+
+    if not is_valid_timestamps(start_time, end_time):
+        raise InvalidTimestampError("Invalid timestamps")
+
+    db.session.add(AvailabilityException(user_id=user_id, start_time=start_time, end_time=end_time))
+    _invalidate(user_id)
+    db.session.commit()
+
+
+@on_shard('user1_id', 'user2_id', across=cross_shard.schedule_meeting)
+@retry_on_conflict
 def schedule_meeting(user1_id: int, user2_id: int, meeting_start_time: int, meeting_end_time: int):
-    """ Schedule a meeting between two users and update their availability. """
+    """
+    Schedule a meeting between two users and update their availability, returns the meeting's id.
+    Both users' rows stay locked until the meeting is committed, so concurrent bookings can't double book either user.
+    """
     if not is_valid_timestamps(meeting_start_time, meeting_end_time):
         raise InvalidTimestampError("Invalid timestamps")
 
-    user1 = User.query.get(user1_id)
-    user2 = User.query.get(user2_id)
-    if not user1 or not user2:
+    if len(_lock_users(user1_id, user2_id)) < len({user1_id, user2_id}):
         raise UserNotFoundError("One or both users do not exist")
 
     if (not check_availability(user1_id, meeting_start_time, meeting_end_time) or not check_availability(user2_id,
                                                                                                          meeting_start_time,
                                                                                                          meeting_end_time)):
         raise AvailabilityError("No overlap found in availability for the requested time")
-    create_meeting(user1_id, user2_id, meeting_start_time, meeting_end_time)
+    return create_meeting(user1_id, user2_id, meeting_start_time, meeting_end_time)
 
 
-def create_meeting(user1_id: int, user2_id: int, meeting_start_time: int, meeting_end_time: int):
+def create_meeting(user1_id: int, user2_id: int, meeting_start_time: int, meeting_end_time: int) -> int:
     # Create new meeting entry
-    meeting = Meeting(user1_id=user1_id, user2_id=user2_id, meeting_time=meeting_start_time)
+    meeting = Meeting(user1_id=user1_id, user2_id=user2_id, meeting_time=meeting_start_time, end_time=meeting_end_time)
     db.session.add(meeting)
+    db.session.flush()
+    meeting_id = meeting.id
+    db.session.add_all([MeetingParticipant(meeting_id=meeting_id, user_id=user_id, start_time=meeting_start_time,
+                                           end_time=meeting_end_time) for user_id in {user1_id, user2_id}])
 
     # Adjust availability for user1
     _update_availability(user1_id, meeting_start_time, meeting_end_time)
@@ -134,14 +676,153 @@ def create_meeting(user1_id: int, user2_id: int, meeting_start_time: int, meetin
     _update_availability(user2_id, meeting_start_time, meeting_end_time)
 
     db.session.commit()
+    return meeting_id
+
+
+@on_shard(across=cross_shard.bulk_schedule_meetings)
+@retry_on_conflict
+def bulk_schedule_meetings(meetings: List[dict]) -> List[dict]:
+    """
+    Schedule many meetings in a single transaction, each validated like schedule_meeting, in the order given.
+    The users' availability over the batch's time span is loaded with one query and booked in memory, so a meeting
+    also fails when it conflicts with one accepted earlier in the batch. Slot splits, meetings and participants are
+    then written with one bulk statement each. Returns a result per meeting, in the format:
+    [{"index": int, "status": "scheduled", "id": int}] or [{"index": int, "status": "error", "error": str}]
+    """
+    results = [None] * len(meetings)
+
+    def fail(index: int, error: str):
+        results[index] = {'index': index, 'status': 'error', 'error': error}
+
+    requested = []
+    for index, meeting in enumerate(meetings):
+        try:
+            user_ids = (int(meeting['user1_id']), int(meeting['user2_id']))
+            start_time, end_time = int(meeting['meeting_start_time']), int(meeting['meeting_end_time'])
+        except (KeyError, TypeError, ValueError):
+            fail(index, "Meeting must have user1_id, user2_id, meeting_start_time and meeting_end_time")
+            continue
+
+        if not is_valid_timestamps(start_time, end_time):
+            fail(index, "Invalid timestamps")
+            continue
+        requested.append((index, user_ids, start_time, end_time))
+    if not requested:
+        return results
+
+    existing_users = {user.id for user in _lock_users(*{user_id for _, user_ids, _, _ in requested
+                                                        for user_id in user_ids})}
+    span_start, span_end = min(meeting[2] for meeting in requested), max(meeting[3] for meeting in requested)
+    rows = db.session.query(Availability.user_id, Availability.id, Availability.start_time,
+                            Availability.end_time).filter(Availability.user_id.in_(existing_users),
+                                                          Availability.end_time >= span_start,
+                                                          Availability.start_time <= span_end).order_by(
+        Availability.user_id, Availability.start_time).all()
+    user_rows = {user_id: [(start, end, slot_id) for _, slot_id, start, end in user_slots]
+                 for user_id, user_slots in groupby(rows, key=lambda row: row[0])}
+    recurring = recurrence.recurring_slots(existing_users, span_start, span_end)
+    free = {user_id: _FreeSlots(with_recurring(((start, end) for start, end, _ in user_rows.get(user_id, [])),
+                                               recurring.get(user_id))) for user_id in existing_users}
+
+    accepted, booked = [], defaultdict(list)
+    for index, user_ids, start_time, end_time in requested:
+        if any(user_id not in existing_users for user_id in user_ids):
+            fail(index, "One or both users do not exist")
+            continue
+        if not all(free[user_id].contains(start_time, end_time) for user_id in user_ids):
+            conflicts = [other for user_id in user_ids for other, start, end in booked[user_id]
+                         if start < end_time and end > start_time]
+            fail(index, f"Conflicts with meeting {conflicts[0]} of the batch" if conflicts
+                 else "No overlap found in availability for the requested time")
+            continue
+
+        for user_id in set(user_ids):
+            free[user_id].book(start_time, end_time)
+            booked[user_id].append((index, start_time, end_time))
+        accepted.append((index, user_ids, start_time, end_time))
+    if not accepted:
+        db.session.rollback()
+        return results
+
+    meeting_ids = db.session.execute(insert(Meeting).returning(Meeting.id, sort_by_parameter_order=True), [
+        {'user1_id': user_ids[0], 'user2_id': user_ids[1], 'meeting_time': start_time, 'end_time': end_time}
+        for _, user_ids, start_time, end_time in accepted]).scalars().all()
+    db.session.execute(insert(MeetingParticipant), [
+        {'meeting_id': meeting_id, 'user_id': user_id, 'start_time': start_time, 'end_time': end_time}
+        for meeting_id, (_, user_ids, start_time, end_time) in zip(meeting_ids, accepted) for user_id in set(user_ids)])
+    for meeting_id, (index, _, _, _) in zip(meeting_ids, accepted):
+        results[index] = {'index': index, 'status': 'scheduled', 'id': meeting_id}
+
+    # split the slots under the booked meetings, and take them out of the recurring availability
+    inserts, deletes, exceptions = [], [], []
+    for user_id, user_meetings in booked.items():
+        _invalidate(user_id)
+        user_meetings = sorted((start, end) for _, start, end in user_meetings)
+        touched = [(start, end, slot_id) for start, end, slot_id in user_rows.get(user_id, [])
+                   if any(start < meeting_end and end > meeting_start for meeting_start, meeting_end in user_meetings)]
+        deletes.extend(slot_id for _, _, slot_id in touched)
+        inserts.extend({'user_id': user_id, 'start_time': start, 'end_time': end}
+                       for start, end in subtract(((start, end) for start, end, _ in touched), user_meetings))
+        if user_id in recurring:
+            exceptions.extend({'user_id': user_id, 'start_time': start, 'end_time': end}
+                              for start, end in user_meetings)
+
+    if deletes:
+        db.session.query(Availability).filter(Availability.id.in_(deletes)).delete(synchronize_session=False)
+    if inserts:
+        db.session.execute(insert(Availability), inserts)
+    if exceptions:
+        db.session.execute(insert(AvailabilityException), exceptions)
+    db.session.commit()
+
+    return results
+
+
+class _FreeSlots:
+    """ A user's free time as sorted, disjoint slots, booked in memory by bulk_schedule_meetings. """
+
+    def __init__(self, slots: Iterable[tuple]):
+        slots = list(slots)
+        self.starts = [start for start, _ in slots]
+        self.ends = [end for _, end in slots]
+
+    def contains(self, start_time: int, end_time: int) -> bool:
+        position = bisect_right(self.starts, start_time) - 1
+        return position >= 0 and self.ends[position] >= end_time
+
+    def book(self, start_time: int, end_time: int):
+        """ Take a contained period out, keeping what is left of its slot on either side. """
+        position = bisect_right(self.starts, start_time) - 1
+        start, end = self.starts[position], self.ends[position]
+        pieces = [(low, high) for low, high in ((start, start_time), (end_time, end)) if low < high]
+        self.starts[position:position + 1] = [low for low, _ in pieces]
+        self.ends[position:position + 1] = [high for _, high in pieces]
 
 
 def _update_availability(user_id: int, meeting_start_time: int, meeting_end_time: int):
     """ Adjust user's availability by removing or splitting slots based on the meeting time. """
-    available_slots = Availability.query.filter_by(user_id=user_id).all()
+    _invalidate(user_id)
+    # with recurring rules the meeting can span a slot and a recurring one, which is taken out through an exception
+    recurring = recurrence.has_rules(user_id)
+    if recurring:
+        db.session.add(AvailabilityException(user_id=user_id, start_time=meeting_start_time, end_time=meeting_end_time))
+
+    available_slots = Availability.query.filter_by(user_id=user_id)
+    if range_backend.is_enabled():
+        # only the slot containing the meeting is affected, or the ones overlapping it next to recurring availability
+        available_slots = available_slots.filter(range_backend.SLOT.op('&&' if recurring else '@>')(
+            range_backend.int8range(meeting_start_time, meeting_end_time)))
+    available_slots = available_slots.all()
 
     for slot in available_slots:
-        if slot.start_time <= meeting_start_time and slot.end_time >= meeting_end_time:
+        if recurring and slot.start_time < meeting_end_time and slot.end_time > meeting_start_time:
+            # keep what is left of the slot on either side of the meeting
+            if slot.start_time < meeting_start_time:
+                db.session.add(Availability(user_id=user_id, start_time=slot.start_time, end_time=meeting_start_time))
+            if slot.end_time > meeting_end_time:
+                db.session.add(Availability(user_id=user_id, start_time=meeting_end_time, end_time=slot.end_time))
+            db.session.delete(slot)
+        elif slot.start_time <= meeting_start_time and slot.end_time >= meeting_end_time:
             # If the slot exactly matches the meeting time, remove it
             if slot.start_time == meeting_start_time and slot.end_time == meeting_end_time:
                 db.session.delete(slot)
@@ -0,0 +1,675 @@
+# User sharding across several databases
+#
+# DATABASE_URL is shard 0, DATABASE_SHARD_URLS adds shards 1 to N-1 as the binds shard1, shard2, ... A user lives on one
+# shard with their availability, rules, exceptions and meetings. The user_shards directory on shard 0 maps the users
+# the rebalancer moved, a user without a row there lives on shard 0, so an unsharded database becomes shard 0 as is.
+# Lookups are cached in the process for SHARD_DIRECTORY_SECONDS.
+#
+# Service functions decorated with on_shard run on their users' shard, through the session routing of src/db.py. When
+# the users are on several shards they call a cross-shard version instead, from src/cross_shard.py: reads fetch each
+# shard's part in parallel, one thread and session per shard, and combine them in memory. A meeting between users of
+# two shards is stored on both, with the same id, and written with Postgres two-phase commit (TwoPhaseCommit), which
+# needs max_prepared_transactions > 0 on every shard. A coordinator that dies between the prepares and the commits
+# leaves prepared transactions behind, `recover` resolves them.
+#
+# usage: python -m src.sharding init|recover|rebalance [--dry-run] [--limit N]|move USER_ID SHARD
+
+import argparse
+import inspect
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial, wraps
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Tuple
+
+from flask import current_app, g, has_app_context
+from sqlalchemy import delete, func, insert, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from src import bitmap
+from src.api_exceptions import UserNotFoundError
+from src.cache import cache
+from src.db import SHARD, db
+from src.models import (Availability, AvailabilityException, AvailabilityRule, Meeting, MeetingParticipant,
+                        ShardTransaction, User, UserShard)
+from src.replica import user_arguments
+
+logger = logging.getLogger(__name__)
+
+# prefix of the global ids of prepared transactions, GID_PREFIX:<transaction id>:<first shard>:<shard>
+GID_PREFIX = 'calendly'
+# prepared transactions younger than this may still be committed by their coordinator, recover leaves them alone
+RECOVERY_GRACE = 60  # seconds
+# commit records older than this are pruned by recover
+RECORD_DAYS = 7
+# threads reading the shards of cross-shard requests, shared by the whole process
+READ_THREADS = 16
+
+# tables of a user's own rows, moved without their ids which are per shard
+USER_TABLES = (Availability, AvailabilityRule, AvailabilityException)
+
+# Run once on every shard, after create_all. The other user of a cross-shard meeting lives on another shard, so the
+# meeting tables can't reference users, and meetings keep their id on both shards: shard k of n hands out the ids
+# k + 1, k + 1 + n, ...
+INIT_SHARD = [
+    "ALTER TABLE meetings DROP CONSTRAINT IF EXISTS meetings_user1_id_fkey",
+    "ALTER TABLE meetings DROP CONSTRAINT IF EXISTS meetings_user2_id_fkey",
+    "ALTER TABLE meeting_participants DROP CONSTRAINT IF EXISTS meeting_participants_user_id_fkey",
+]
+
+# cross-shard reads, two-phase commit outcomes and moved users since the process started, exported on /metrics
+shard_stats = Counter()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class Directory:
+    """ Shard of each user, read from user_shards on shard 0 and cached in the process for a few seconds. """
+
+    MAX_USERS = 100000
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self._shards = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, user_ids: Iterable[int]) -> Dict[int, int]:
+        now = time.monotonic()
+        shards, missing = {}, set()
+        with self._lock:
+            for user_id in user_ids:
+                shard, expires = self._shards.get(user_id, (0, 0))
+                if expires > now:
+                    shards[user_id] = shard
+                else:
+                    missing.add(user_id)
+        if not missing:
+            return shards
+
+        # the directory is on shard 0 whichever shard the session is routed to
+        found = dict(db.session.execute(select(UserShard.user_id, UserShard.shard).where(
+            UserShard.user_id.in_(missing)), bind_arguments={'bind': engine(0)}).all())
+        fetched = {user_id: found.get(user_id, 0) for user_id in missing}
+        with self._lock:
+            if len(self._shards) > self.MAX_USERS:
+                self._shards = {user_id: entry for user_id, entry in self._shards.items() if entry[1] > now}
+            self._shards.update((user_id, (shard, now + self.seconds)) for user_id, shard in fetched.items())
+        shards.update(fetched)
+        return shards
+
+    def forget(self, user_ids: Iterable[int]) -> bool:
+        """ Drop the cached shards of the users, returns whether any was cached. """
+        with self._lock:
+            return any([self._shards.pop(user_id, None) is not None for user_id in user_ids])
+
+
+directory = Directory(10)
+
+
+def init_sharding(app):
+    configure_sharding(app.config)
+
+
+def configure_sharding(config: Mapping):
+    global directory
+    directory = Directory(float(config.get('SHARD_DIRECTORY_SECONDS', 10)))
+
+
+def shard_bind(shard: int) -> Optional[str]:
+    """ Bind of a shard, shard 0 is the default one. """
+    return None if shard == 0 else f'shard{shard}'
+
+
+def shard_count() -> int:
+    return int(current_app.config.get('SHARDS', 1))
+
+
+def is_sharded() -> bool:
+    return shard_count() > 1
+
+
+def engine(shard: int):
+    return db.engines[shard_bind(shard)]
+
+
+def shards_of(user_ids: Iterable[int]) -> Dict[int, int]:
+    """ Shard of each user. """
+    if not is_sharded():
+        return {user_id: 0 for user_id in user_ids}
+    return directory.lookup(user_ids)
+
+
+def by_shard(user_ids: Iterable[int]) -> Dict[int, List[int]]:
+    """ The users of each shard, in the order given. """
+    users = defaultdict(list)
+    for user_id, shard in shards_of(user_ids).items():
+        users[shard].append(user_id)
+    return dict(users)
+
+
+@contextmanager
+def use_shard(shard: int):
+    """ Route the session's statements to a shard, shard 0 included, within the block. """
+    session = db.session
+    previous = session.info.get(SHARD)
+    session.info[SHARD] = engine(shard)
+    try:
+        yield
+    finally:
+        session.info[SHARD] = previous
+
+
+def on_shard(*user_params: str, across: Optional[Callable] = None) -> Callable:
+    """
+    Run a service function on its users' shard. user_params name the arguments holding the user id, or list of user
+    ids: when they all live on one shard the function runs there, otherwise, and always without user_params, across
+    is called with the same arguments. With a single shard, and within a call already routed, the function runs as is.
+
+    A user moved since their shard was cached is no longer on the old shard. Writes fail there with
+    UserNotFoundError, reads find nothing: in either case, when the directory had the user cached, it is read afresh
+    and the call routed again, once. So an empty result is only returned after checking that the users are on the
+    shards it was read from, or that the directory, read afresh, still places them there.
+    """
+
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        def shard_of_call(args, kwargs) -> Optional[int]:
+            """ The shard the call runs on, None when it spans several. """
+            if not user_params:
+                return None
+            shards = set(shards_of(user_arguments(signature, user_params, args, kwargs)).values())
+            if len(shards) > 1:
+                return None
+            return shards.pop() if shards else 0
+
+        def runs_as_is() -> bool:
+            return not is_sharded() or db.session.info.get(SHARD) is not None
+
+        def moved(args, kwargs) -> bool:
+            return bool(user_params) and _moved_off(user_arguments(signature, user_params, args, kwargs))
+
+        if inspect.isgeneratorfunction(fn):
+            def call(args, kwargs):
+                shard = shard_of_call(args, kwargs)
+                if shard is None:
+                    yield from across(*args, **kwargs)
+                    return
+                with use_shard(shard):
+                    yield from fn(*args, **kwargs)
+
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                if runs_as_is():
+                    yield from fn(*args, **kwargs)
+                    return
+                empty = True
+                for item in call(args, kwargs):
+                    empty = False
+                    yield item
+                if empty and moved(args, kwargs):
+                    yield from call(args, kwargs)
+        else:
+            def call(args, kwargs):
+                shard = shard_of_call(args, kwargs)
+                if shard is None:
+                    return across(*args, **kwargs)
+                # shard 0 reads stay unrouted, they can go to the replica
+                if shard == 0:
+                    return fn(*args, **kwargs)
+                with use_shard(shard):
+                    return fn(*args, **kwargs)
+
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                if runs_as_is():
+                    return fn(*args, **kwargs)
+                try:
+                    result = call(args, kwargs)
+                except UserNotFoundError:
+                    if not directory.forget(user_arguments(signature, user_params, args, kwargs)):
+                        raise
+                    return call(args, kwargs)
+                if result or result is None or not moved(args, kwargs):
+                    return result
+                return call(args, kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _moved_off(user_ids: Iterable[int]) -> bool:
+    """
+    Whether some of the users are no longer on the shard the directory has cached for them, because they were moved
+    since. Their shards are then read afresh, and what calls cached from the wrong shard is dropped.
+    """
+    missing = set()
+    for shard, users in by_shard(set(user_ids)).items():
+        found = db.session.execute(select(User.id).where(User.id.in_(users)), bind_arguments={'bind': engine(shard)})
+        missing.update(set(users) - set(found.scalars()))
+    if not missing:
+        return False
+    cached = shards_of(missing)
+    if not directory.forget(missing) or shards_of(missing) == cached:
+        # users that don't exist anywhere
+        return False
+    for user_id in missing:
+        cache.invalidate_user(user_id)
+        bitmap.bitmaps.invalidate_user(user_id)
+    return True
+
+
+def on_each(calls: Mapping[int, Callable]) -> Dict[int, object]:
+    """
+    Call a function on each of the given shards in parallel, each in a thread with its own app context and session
+    routed to the shard. Returns the result of each shard.
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=READ_THREADS, thread_name_prefix='shard-read')
+    shard_stats['cross_shard_reads'] += 1
+    app = current_app._get_current_object()
+    shared = _shared_g()
+
+    def run(shard, fn):
+        with app.app_context():
+            g.__dict__.update(shared)
+            db.session.info[SHARD] = engine(shard)
+            return fn()
+
+    futures = {shard: _executor.submit(run, shard, fn) for shard, fn in calls.items()}
+    return {shard: future.result() for shard, future in futures.items()}
+
+
+def _shared_g() -> dict:
+    """ The request's values of flask.g that threads working for it share: its statement metrics (src/metrics.py). """
+    stats = g.get('request_stats') if has_app_context() else None
+    return {} if stats is None else {'request_stats': stats}
+
+
+class _Participant(threading.Thread):
+    """
+    A shard's part of a TwoPhaseCommit: a thread with its own app context and session, routed to a connection in a
+    two-phase transaction, running the calls it is sent one at a time.
+    """
+
+    def __init__(self, app, shard: int, gid: str):
+        super().__init__(name=f'two-phase-{shard}', daemon=True)
+        self.app, self.shard, self.gid = app, shard, gid
+        self.shared = _shared_g()
+        self.connection = self.transaction = None
+        self.in_doubt = False
+        self._calls, self._results = queue.Queue(), queue.Queue()
+        self.start()
+
+    def run(self):
+        with self.app.app_context():
+            g.__dict__.update(self.shared)
+            try:
+                for fn in iter(self._calls.get, None):
+                    try:
+                        self._results.put((fn(), None))
+                    except Exception as error:
+                        self._results.put((None, error))
+            finally:
+                db.session.remove()
+                if self.connection is not None:
+                    # closing rolls back, a prepared transaction in doubt is left to recover()
+                    self.connection.invalidate() if self.in_doubt else self.connection.close()
+
+    def send(self, fn: Callable):
+        self._calls.put(fn)
+
+    def result(self):
+        value, error = self._results.get()
+        if error is not None:
+            raise error
+        return value
+
+    def call(self, fn: Callable):
+        self.send(fn)
+        return self.result()
+
+    def stop(self):
+        self._calls.put(None)
+        self.join()
+
+    def begin(self):
+        self.connection = engine(self.shard).connect()
+        self.transaction = self.connection.begin_twophase(self.gid)
+        db.session.info[SHARD] = self.connection
+
+    def prepare(self):
+        db.session.flush()
+        self.transaction.prepare()
+
+    def commit(self):
+        self.transaction.commit()
+        # the session joined the transaction without owning it, its commit only runs the after_commit hooks
+        db.session.commit()
+
+    def rollback(self):
+        # the session joined the transaction, its rollback rolls the transaction back, prepared or not
+        db.session.rollback()
+        if self.transaction is not None and self.transaction.is_active:
+            self.transaction.rollback()
+
+
+class TwoPhaseCommit:
+    """
+    A transaction over several shards, committed with Postgres two-phase commit. run() calls a function on one of the
+    shards, in a participant thread whose session keeps the shard's transaction open; commit() records the commit on
+    the first shard, prepares every shard, then commits the first shard and after it the others. Leaving the with
+    block without committing rolls every shard back.
+
+    Once all are prepared the commit is decided: if the first shard's commit fails or the process dies, the prepared
+    transactions are left to recover(), which commits them when the first shard committed its record.
+    """
+
+    def __init__(self, shards: Iterable[int]):
+        self.id = str(uuid.uuid4())
+        self.shards = sorted(set(shards))
+        self.app = current_app._get_current_object()
+        self.participants: Dict[int, _Participant] = {}
+        self.prepared = self.done = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            if not self.done:
+                self.rollback()
+        finally:
+            for participant in self.participants.values():
+                participant.stop()
+
+    def gid(self, shard: int) -> str:
+        return f'{GID_PREFIX}:{self.id}:{self.shards[0]}:{shard}'
+
+    def participant(self, shard: int) -> _Participant:
+        if shard not in self.shards:
+            raise ValueError(f"Shard {shard} is not part of the transaction")
+        if shard not in self.participants:
+            participant = self.participants[shard] = _Participant(self.app, shard, self.gid(shard))
+            participant.call(participant.begin)
+        return self.participants[shard]
+
+    def run(self, shard: int, fn: Callable):
+        """ Call fn on a shard, in its transaction, and return its result. """
+        return self.participant(shard).call(fn)
+
+    def run_all(self, calls: Mapping[int, Callable]) -> Dict[int, object]:
+        """ Call a function on each of the given shards in parallel, returns the result of each. """
+        results, errors = self._on_all({shard: (self.participant(shard), fn) for shard, fn in calls.items()})
+        if errors:
+            raise next(iter(errors.values()))
+        return results
+
+    @staticmethod
+    def _on_all(calls: Mapping[int, Tuple[_Participant, Callable]]) -> Tuple[dict, dict]:
+        """
+        Send each participant its call and wait for them all, so none is still busy when an error rolls it back.
+        Returns the results and the errors by shard.
+        """
+        for participant, fn in calls.values():
+            participant.send(fn)
+        results, errors = {}, {}
+        for shard, (participant, _) in calls.items():
+            try:
+                results[shard] = participant.result()
+            except Exception as error:
+                errors[shard] = error
+        return results, errors
+
+    def prepare(self):
+        self.run(self.shards[0], lambda: db.session.add(ShardTransaction(id=self.id, committed_at=int(time.time()))))
+        self.run_all({shard: participant.prepare for shard, participant in self.participants.items()})
+        self.prepared = True
+
+    def commit(self):
+        if not self.prepared:
+            self.prepare()
+        first = self.participants[self.shards[0]]
+        try:
+            first.call(first.commit)
+        except Exception:
+            self.abandon()
+            raise
+        self.done = True
+        shard_stats['committed'] += 1
+
+        others = {shard: (participant, participant.commit) for shard, participant in self.participants.items()
+                  if participant is not first}
+        for shard, error in self._on_all(others)[1].items():
+            # decided already, the shard's transaction stays prepared until recover() commits it
+            logger.warning("commit of %s failed, left to recovery: %s", self.gid(shard), error)
+            self.participants[shard].in_doubt = True
+            shard_stats['in_doubt'] += 1
+
+    def rollback(self):
+        """ Roll every shard back, the first one last so recover() never sees it gone while others are prepared. """
+        first = self.participants.get(self.shards[0])
+        others = {shard: (participant, participant.rollback) for shard, participant in self.participants.items()
+                  if participant is not first}
+        failed = list(self._on_all(others)[1])
+        if first is not None:
+            failed += list(self._on_all({self.shards[0]: (first, first.rollback)})[1])
+        for shard in failed:
+            logger.warning("rollback of %s failed, left to recovery", self.gid(shard))
+            self.participants[shard].in_doubt = True
+        self.done = True
+        shard_stats['rolled_back'] += 1
+
+    def abandon(self):
+        """ Leave the prepared transactions to recover(), as a coordinator that died would. """
+        for participant in self.participants.values():
+            participant.in_doubt = True
+        self.done = True
+        shard_stats['in_doubt'] += 1
+
+
+def recover(grace: int = RECOVERY_GRACE) -> Counter:
+    """
+    Resolve the prepared transactions older than grace seconds left on every shard by coordinators that died: while
+    the first shard of a transaction is still prepared nothing was committed and all are rolled back, otherwise they
+    are committed if the first shard committed the transaction's record. Returns the transactions committed and
+    rolled back.
+    """
+    resolved = Counter()
+    for shard in range(shard_count()):
+        with engine(shard).connect() as connection:
+            gids = connection.execute(text(
+                "SELECT gid FROM pg_prepared_xacts WHERE database = current_database() AND gid LIKE :prefix "
+                "AND prepared < now() - make_interval(secs => :grace) ORDER BY prepared"),
+                {'prefix': f'{GID_PREFIX}:%', 'grace': grace}).scalars().all()
+        for gid in gids:
+            _, transaction_id, first, _ = gid.split(':')
+            decision = 'COMMIT' if _committed(transaction_id, int(first)) else 'ROLLBACK'
+            with engine(shard).connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+                connection.exec_driver_sql(f"{decision} PREPARED '{gid}'")
+            resolved['committed' if decision == 'COMMIT' else 'rolled_back'] += 1
+            logger.info("recovered %s: %s", gid, decision)
+
+        with engine(shard).begin() as connection:
+            connection.execute(delete(ShardTransaction).where(
+                ShardTransaction.committed_at < int(time.time()) - RECORD_DAYS * 86400))
+    return resolved
+
+
+def _committed(transaction_id: str, first: int) -> bool:
+    gid = f'{GID_PREFIX}:{transaction_id}:{first}:{first}'
+    with engine(first).connect() as connection:
+        if connection.execute(text("SELECT 1 FROM pg_prepared_xacts WHERE gid = :gid"), {'gid': gid}).first():
+            return False
+        return connection.execute(select(ShardTransaction.id).where(
+            ShardTransaction.id == transaction_id)).first() is not None
+
+
+def init_shards():
+    """ Prepare every shard's tables for cross-shard meetings, see INIT_SHARD. """
+    count = shard_count()
+    for shard in range(count):
+        with engine(shard).begin() as connection:
+            for statement in INIT_SHARD:
+                connection.execute(text(statement))
+            sequence = connection.execute(text("SELECT pg_get_serial_sequence('meetings', 'id')")).scalar()
+            last = connection.execute(select(func.coalesce(func.max(Meeting.id), 0))).scalar()
+            # the next id of the shard's series past the existing ones
+            next_id = last + 1 + (shard - last) % count
+            connection.execute(text(f"ALTER SEQUENCE {sequence} INCREMENT BY {count}"))
+            connection.execute(text("SELECT setval(:sequence, :next_id, false)"),
+                               {'sequence': sequence, 'next_id': next_id})
+
+
+def move_user(user_id: int, target: int) -> bool:
+    """
+    Move a user to another shard with their availability, rules, exceptions and meetings, and point the directory to
+    it, in one two-phase transaction. The user's row stays locked on the old shard until the move commits, writes
+    waiting on it then find the user gone and are routed again. Rules and slots get new ids on the new shard, meetings
+    keep theirs. Returns False when the user already lives there.
+    """
+    if not 0 <= target < shard_count():
+        raise ValueError(f"No shard {target}")
+    directory.forget([user_id])
+    source = shards_of([user_id])[user_id]
+    if source == target:
+        return False
+
+    with TwoPhaseCommit([source, target, 0]) as transaction:
+        rows = transaction.run(source, partial(_take_user, user_id))
+        if rows is None:
+            raise UserNotFoundError("User does not exist")
+        transaction.run(target, partial(_put_user, rows))
+        transaction.run(0, partial(_set_shard, user_id, target))
+        transaction.commit()
+
+    directory.forget([user_id])
+    cache.invalidate_user(user_id)
+    bitmap.bitmaps.invalidate_user(user_id)
+    shard_stats['moved_users'] += 1
+    return True
+
+
+def _take_user(user_id: int) -> Optional[dict]:
+    """
+    Lock a user on their shard, read their rows and delete them. Their meetings stay on the shard while another of
+    their users lives there.
+    """
+    user = db.session.execute(select(User.id, User.name).where(User.id == user_id).with_for_update()).first()
+    if user is None:
+        return None
+
+    meeting_ids = select(MeetingParticipant.meeting_id).where(MeetingParticipant.user_id == user_id)
+    rows = {User: [user._asdict()]}
+    for model in USER_TABLES:
+        columns = [column for column in model.__table__.columns if column.key != 'id']
+        rows[model] = [row._asdict() for row in db.session.execute(
+            select(*columns).where(model.user_id == user_id).order_by(model.id))]
+    rows[Meeting] = [row._asdict() for row in db.session.execute(
+        select(*Meeting.__table__.columns).where(Meeting.id.in_(meeting_ids)))]
+    rows[MeetingParticipant] = [row._asdict() for row in db.session.execute(
+        select(*MeetingParticipant.__table__.columns).where(MeetingParticipant.meeting_id.in_(meeting_ids)))]
+
+    # a user's row is only on their own shard
+    staying = set(db.session.execute(select(MeetingParticipant.meeting_id).join(
+        User, User.id == MeetingParticipant.user_id).where(MeetingParticipant.meeting_id.in_(meeting_ids),
+                                                             MeetingParticipant.user_id != user_id)).scalars())
+    leaving = [meeting['id'] for meeting in rows[Meeting] if meeting['id'] not in staying]
+    if leaving:
+        db.session.execute(delete(MeetingParticipant).where(MeetingParticipant.meeting_id.in_(leaving)))
+        db.session.execute(delete(Meeting).where(Meeting.id.in_(leaving)))
+    for model in USER_TABLES:
+        db.session.execute(delete(model).where(model.user_id == user_id))
+    db.session.execute(delete(User).where(User.id == user_id))
+    return rows
+
+
+def _put_user(rows: dict):
+    """ Insert the rows _take_user read, the meetings already on the shard with another of their users are kept. """
+    for model in (User,) + USER_TABLES:
+        if rows[model]:
+            db.session.execute(insert(model), rows[model])
+    for model in (Meeting, MeetingParticipant):
+        if rows[model]:
+            db.session.execute(pg_insert(model).on_conflict_do_nothing(), rows[model])
+
+
+def _set_shard(user_id: int, shard: int):
+    db.session.execute(pg_insert(UserShard).values(user_id=user_id, shard=shard).on_conflict_do_update(
+        index_elements=[UserShard.user_id], set_={'shard': shard}))
+
+
+def user_counts() -> Dict[int, int]:
+    """ Users living on each shard. """
+    return on_each({shard: lambda: db.session.execute(select(func.count(User.id))).scalar()
+                    for shard in range(shard_count())})
+
+
+def rebalance(limit: Optional[int] = None, dry_run: bool = False) -> List[Tuple[int, int, int]]:
+    """
+    Move users from the shards with the most users to those with the fewest until their counts differ by at most one,
+    the most recent users (highest ids) first, and at most limit of them. Returns the (user_id, source, target) moves.
+    """
+    counts = user_counts()
+    moves = []
+    while limit is None or len(moves) < limit:
+        fullest, emptiest = max(counts, key=counts.get), min(counts, key=counts.get)
+        if counts[fullest] - counts[emptiest] <= 1:
+            break
+        counts[fullest] -= 1
+        counts[emptiest] += 1
+        moves.append((fullest, emptiest))
+
+    leaving = Counter(source for source, _ in moves)
+    users = on_each({shard: partial(_last_users, count) for shard, count in leaving.items()})
+    moved = [(users[source].pop(0), source, target) for source, target in moves]
+    if not dry_run:
+        for user_id, _, target in moved:
+            move_user(user_id, target)
+    return moved
+
+
+def _last_users(count: int) -> List[int]:
+    return db.session.execute(select(User.id).order_by(User.id.desc()).limit(count)).scalars().all()
+
+
+if __name__ == '__main__':
+    from app import create_app
+
+    parser = argparse.ArgumentParser(description="Manage the user shards")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('init', help="prepare the tables of every shard for cross-shard meetings")
+    recover_parser = commands.add_parser('recover', help="resolve prepared transactions left by crashed requests")
+    recover_parser.add_argument('--grace', type=int, default=RECOVERY_GRACE,
+                                help="seconds a prepared transaction is left to its coordinator")
+    rebalance_parser = commands.add_parser('rebalance', help="move users until every shard has as many")
+    rebalance_parser.add_argument('--limit', type=int, help="move at most this many users")
+    rebalance_parser.add_argument('--dry-run', action='store_true', help="only print the moves")
+    move_parser = commands.add_parser('move', help="move a user to a shard")
+    move_parser.add_argument('user_id', type=int)
+    move_parser.add_argument('shard', type=int)
+    args = parser.parse_args()
+
+    with create_app().app_context():
+        if args.command == 'init':
+            init_shards()
+            print(f"{shard_count()} shards ready")
+        elif args.command == 'recover':
+            result = recover(args.grace)
+            print(f"{result['committed']} committed, {result['rolled_back']} rolled back")
+        elif args.command == 'rebalance':
+            for user_id, source, target in rebalance(args.limit, args.dry_run):
+                print(f"user {user_id}: shard {source} -> {target}")
+            print(f"users per shard: {user_counts()}")
+        else:
+            print(f"user {args.user_id} {'moved' if move_user(args.user_id, args.shard) else 'already there'}")
@@ -0,0 +1,225 @@
+import asyncio
+import importlib.util
+import json
+import os
+import threading
+import unittest
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+from app import create_app
+from src import replica
+from src.cache import MemoryBackend, cache, configure_cache
+from src.models import User, db
+
+HOUR = 3600
+DAY = 86400
+# 2025-01-01 is a Wednesday
+MIDNIGHT = int(datetime(2025, 1, 1, tzinfo=timezone.utc).timestamp())
+
+WINDOWS = [(None, None), (MIDNIGHT + DAY, None), (None, MIDNIGHT + 3 * DAY), (MIDNIGHT + DAY + 10 * HOUR,
+                                                                              MIDNIGHT + 5 * DAY)]
+
+
+async def asgi_get(app, path: str, params: dict):
+    """ A GET request straight through the ASGI interface, as uvicorn would make it. """
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+             'path': path, 'raw_path': path.encode(), 'root_path': '', 'headers': [], 'server': ('testserver', 80),
+             'client': ('testclient', 50000),
+             'query_string': urlencode({name: value for name, value in params.items() if value is not None}).encode()}
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    headers = {name.decode().lower(): value.decode() for name, value in messages[0]['headers']}
+    body = b''.join(message.get('body', b'') for message in messages[1:])
+    return messages[0]['status'], headers.get('x-next-cursor'), json.loads(body)
+
+
+@unittest.skipUnless(os.environ.get('DATABASE_URL', '').startswith('postgres') and importlib.util.find_spec('asyncpg')
+                     and importlib.util.find_spec('starlette'), "the ASGI app needs requirements-asgi.txt and Postgres")
+class TestAsgiParity(unittest.TestCase):
+    """ The read endpoints of asgi.py answer as those of the WSGI app, on the same data. """
+
+    def setUp(self):
+        import asgi
+
+        self.asgi = asgi
+        self.loop = asyncio.new_event_loop()
+        self.app = create_app()
+        self.client = self.app.test_client()
+        self.app.config['TESTING'] = True
+
+        with self.app.app_context():
+            db.drop_all()
+            db.create_all()
+            db.session.add_all([User(name=f"User{user_id}") for user_id in range(1, 4)])
+            db.session.commit()
+
+        # user 1 has slots and works 9 to 17 in Berlin on weekdays for two weeks, but not on the 2nd
+        for day, start_hour, end_hour in [(0, 6, 8), (1, 18, 20), (3, 7, 12), (6, 10, 14), (20, 9, 10)]:
+            self.post('/api/availability/1', start_time=self.at(day, start_hour), end_time=self.at(day, end_hour))
+        self.post('/api/availability/1/rules', weekdays=[0, 1, 2, 3, 4], start_offset=9 * HOUR,
+                  end_offset=17 * HOUR, valid_from=MIDNIGHT, valid_until=MIDNIGHT + 14 * DAY, timezone='Europe/Berlin')
+        self.post('/api/availability/1/exceptions', start_time=self.at(1, 0), end_time=self.at(2, 0))
+        # user 2 has slots overlapping them and works 8 to 12 UTC every day for ten days
+        for day, start_hour, end_hour in [(0, 7, 9), (1, 19, 23), (3, 0, 24), (6, 12, 13), (20, 8, 12)]:
+            self.post('/api/availability/2', start_time=self.at(day, start_hour), end_time=self.at(day, end_hour))
+        self.post('/api/availability/2/rules', weekdays=list(range(7)), start_offset=8 * HOUR, end_offset=12 * HOUR,
+                  valid_from=MIDNIGHT, valid_until=MIDNIGHT + 10 * DAY)
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.asgi.engine.dispose())
+        self.loop.close()
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    @staticmethod
+    def at(day: int, hour: int) -> int:
+        return MIDNIGHT + day * DAY + hour * HOUR
+
+    def post(self, path: str, **body):
+        response = self.client.post(path, json=body)
+        self.assertEqual(201, response.status_code, response.json)
+
+    def wsgi_get(self, path: str, params: dict):
+        response = self.client.get(path, query_string={name: value for name, value in params.items()
+                                                       if value is not None})
+        return response.status_code, response.headers.get('X-Next-Cursor'), response.json
+
+    def assertSameResponse(self, path: str, **params):
+        wsgi = self.wsgi_get(path, params)
+        self.assertEqual(wsgi, self.loop.run_until_complete(asgi_get(self.asgi.app, path, params)), params)
+        return wsgi
+
+    def test_availability(self):
+        for user_id in (1, 2, 3):
+            for start_time, end_time in WINDOWS:
+                with self.subTest(user_id=user_id, start_time=start_time, end_time=end_time):
+                    status, _, slots = self.assertSameResponse(f'/api/availability/{user_id}', start_time=start_time,
+                                                               end_time=end_time)
+                    self.assertEqual(200, status)
+                    if user_id != 3:
+                        self.assertTrue(slots)
+
+    def test_overlap(self):
+        for start_time, end_time in WINDOWS:
+            for limit in (None, 1, 2, 1000):
+                with self.subTest(start_time=start_time, end_time=end_time, limit=limit):
+                    status, _, overlaps = self.assertSameResponse('/api/overlap', user1_id=1, user2_id=2,
+                                                                  start_time=start_time, end_time=end_time,
+                                                                  limit=limit)
+                    self.assertEqual(200, status)
+                    self.assertTrue(overlaps)
+
+    def test_overlap_pages(self):
+        for start_time, end_time in WINDOWS:
+            with self.subTest(start_time=start_time, end_time=end_time):
+                pages, after = [], None
+                while True:
+                    _, after, page = self.assertSameResponse('/api/overlap', user1_id=1, user2_id=2,
+                                                             start_time=start_time, end_time=end_time, limit=2,
+                                                             after=after)
+                    pages.extend(page)
+                    if after is None:
+                        break
+                _, _, overlaps = self.wsgi_get('/api/overlap', {'user1_id': 1, 'user2_id': 2,
+                                                                'start_time': start_time, 'end_time': end_time})
+                self.assertEqual(overlaps, pages)
+                self.assertGreater(len(pages), 2)
+
+    def test_recurring_rules(self):
+        # reads between two of user 1's slots only return rule occurrences, in Berlin time
+        _, _, slots = self.assertSameResponse('/api/availability/1', start_time=self.at(7, 0),
+                                              end_time=self.at(9, 0))
+        self.assertEqual([{'start_time': self.at(7, 8), 'end_time': self.at(7, 16)},
+                          {'start_time': self.at(8, 8), 'end_time': self.at(8, 16)}], slots)
+        self.post('/api/availability/1/exceptions', start_time=self.at(8, 0), end_time=self.at(9, 0))
+        _, _, slots = self.assertSameResponse('/api/availability/1', start_time=self.at(7, 0),
+                                              end_time=self.at(9, 0))
+        self.assertEqual([{'start_time': self.at(7, 8), 'end_time': self.at(7, 16)}], slots)
+
+    def test_validation(self):
+        for params in ({'user1_id': 1}, {'user1_id': 1, 'user2_id': 2, 'limit': 0},
+                       {'user1_id': 1, 'user2_id': 2, 'start_time': MIDNIGHT, 'end_time': MIDNIGHT}):
+            with self.subTest(params=params):
+                status, _, _ = self.assertSameResponse('/api/overlap', **params)
+                self.assertEqual(400, status)
+
+
+class TestSharedCache(TestAsgiParity):
+    """ With a cache, each app reads the entries of the other, as with redis between the two processes. """
+
+    def setUp(self):
+        super().setUp()
+        configure_cache({'CACHE_BACKEND': 'memory'})
+
+    def tearDown(self):
+        configure_cache(self.app.config)
+        super().tearDown()
+
+    def asgi_get(self, path: str, params: dict):
+        return self.loop.run_until_complete(asgi_get(self.asgi.app, path, params))
+
+    def test_filled_by_either_app(self):
+        requests = [('/api/availability/1', {'start_time': self.at(7, 0), 'end_time': self.at(9, 0)}),
+                    ('/api/availability/2', {}),
+                    ('/api/overlap', {'user1_id': 1, 'user2_id': 2}),
+                    ('/api/overlap', {'user1_id': 2, 'user2_id': 1, 'start_time': self.at(1, 0), 'limit': 3})]
+        for fill, read in ((self.asgi_get, self.wsgi_get), (self.wsgi_get, self.asgi_get)):
+            with self.subTest(fill=fill.__name__):
+                configure_cache({'CACHE_BACKEND': 'none'})
+                uncached = [read(path, params) for path, params in requests]
+                configure_cache({'CACHE_BACKEND': 'memory'})
+                filled = [fill(path, params) for path, params in requests]
+                self.assertEqual((0, len(requests)), (cache.stats()['hits'], cache.stats()['misses']))
+                # what the reading app gets from the other's entries is what it reads from the database
+                self.assertEqual(uncached, [read(path, params) for path, params in requests])
+                self.assertEqual((len(requests), len(requests)), (cache.stats()['hits'], cache.stats()['misses']))
+                self.assertEqual(uncached, filled)
+                self.assertTrue(all(body for _, _, body in filled))
+
+    def test_off_the_event_loop(self):
+        """ Cache and read-your-writes lookups, redis round trips in production, don't run on the loop's thread. """
+        threads = set()
+
+        class Backend(MemoryBackend):
+            def generations(self, names):
+                threads.add(threading.get_ident())
+                return super().generations(names)
+
+            def get(self, key):
+                threads.add(threading.get_ident())
+                return super().get(key)
+
+            def set(self, key, value):
+                threads.add(threading.get_ident())
+                super().set(key, value)
+
+        class Client:
+            def exists(self, *keys):
+                threads.add(threading.get_ident())
+                return 0
+
+        configure_cache({'CACHE_BACKEND': 'memory'}, Backend())
+        replica.configure_replica({}, Client())
+        # as with DATABASE_REPLICA_URL set, sessions of users without recent writes go to the replica
+        self.asgi.ReplicaSession = self.asgi.async_sessionmaker(self.asgi.engine, expire_on_commit=False)
+        try:
+            self.asgi_get('/api/availability/1', {})
+            self.asgi_get('/api/overlap', {'user1_id': 1, 'user2_id': 2})
+        finally:
+            self.asgi.ReplicaSession = self.asgi.Session
+            replica.configure_replica(self.app.config)
+        self.assertTrue(threads)
+        self.assertNotIn(threading.get_ident(), threads)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+
+from src import bitmap
+from src.bitmap import DAY, UserBitmap, free_periods
+
+
+@unittest.skipIf(bitmap.np is None, "numpy is not installed")
+class TestUserBitmap(unittest.TestCase):
+
+    def test_cells_fully_covered(self):
+        user_bitmap = UserBitmap.from_slots([(DAY + 100, DAY + 1000), (DAY + 1200, DAY + 1500)], 300)
+        self.assertEqual(DAY // 300, user_bitmap.origin)
+        self.assertEqual(DAY // 300 + DAY // 300, user_bitmap.end)
+        self.assertEqual([False, True, True, False, True, False], list(user_bitmap.window(DAY // 300, DAY // 300 + 6)))
+
+    def test_window_outside_the_bitmap(self):
+        user_bitmap = UserBitmap.from_slots([(DAY, DAY + 600)], 300)
+        self.assertEqual([False, False, True, True, False], list(user_bitmap.window(DAY // 300 - 2, DAY // 300 + 3)))
+
+    def test_slots_shorter_than_a_cell(self):
+        self.assertFalse(UserBitmap.from_slots([(100, 200)], 300).window(0, 10).any())
+
+
+@unittest.skipIf(bitmap.np is None, "numpy is not installed")
+class TestFreePeriods(unittest.TestCase):
+
+    def test_common_runs_across_days(self):
+        bitmaps = [UserBitmap.from_slots([(DAY - 3600, DAY + 3600)], 300),
+                   UserBitmap.from_slots([(0, DAY - 1800), (DAY - 900, 2 * DAY)], 300)]
+        self.assertEqual([(DAY - 3600, DAY - 1800), (DAY - 900, DAY + 3600)],
+                         free_periods(bitmaps, 300, 0, 2 * DAY))
+
+    def test_min_duration_and_window(self):
+        bitmaps = [UserBitmap.from_slots([(0, 600), (1200, 4800)], 300)] * 2
+        self.assertEqual([(1500, 3600)], free_periods(bitmaps, 300, 1400, 3600, min_duration=900))
+
+    def test_nothing_in_common(self):
+        bitmaps = [UserBitmap.from_slots([(0, 600)], 300), UserBitmap.from_slots([(600, 1200)], 300)]
+        self.assertEqual([], free_periods(bitmaps, 300, 0, DAY))
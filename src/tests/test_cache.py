@@ -0,0 +1,103 @@
+import threading
+import unittest
+from unittest import mock
+
+from src.cache import MISSING, Cache, MemoryBackend, RedisBackend, cache as app_cache, configure_cache
+
+
+class LocalRedis:
+    """ Stand-in for a redis client, implementing the few commands the cache uses. """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def incr(self, key):
+        self.data[key] = int(self.data.get(key, 0)) + 1
+
+
+class TestCache(unittest.TestCase):
+
+    def check_invalidation(self, cache: Cache):
+        loads = []
+
+        def loader(value):
+            return lambda: loads.append(value) or value
+
+        self.assertEqual([1], cache.get_or_load('availability', [1], (None, None), loader([1])))
+        self.assertEqual([1], cache.get_or_load('availability', [1], (None, None), loader([2])))
+        self.assertEqual('pair', cache.get_or_load('overlap', [1, 2], (), loader('pair')))
+        self.assertEqual('other', cache.get_or_load('availability', [2], (None, None), loader('other')))
+
+        cache.invalidate_user(1)
+        self.assertEqual([3], cache.get_or_load('availability', [1], (None, None), loader([3])))
+        self.assertEqual('new pair', cache.get_or_load('overlap', [1, 2], (), loader('new pair')))
+        # other users' entries survive
+        self.assertEqual('other', cache.get_or_load('availability', [2], (None, None), loader('stale')))
+
+        self.assertEqual([[1], 'pair', 'other', [3], 'new pair'], loads)
+        self.assertEqual({'hits': 2, 'misses': 5, 'hit_ratio': 2 / 7}, cache.stats())
+
+    def test_memory_backend(self):
+        self.check_invalidation(Cache(MemoryBackend()))
+
+    def test_redis_backend(self):
+        self.check_invalidation(Cache(RedisBackend(LocalRedis())))
+
+    def test_disabled(self):
+        cache = Cache()
+        self.assertEqual(1, cache.get_or_load('availability', [1], (), lambda: 1))
+        self.assertEqual(2, cache.get_or_load('availability', [1], (), lambda: 2))
+
+    def test_disabled_by_default(self):
+        # a memory cache per worker would keep serving entries another worker's write invalidated
+        configure_cache({})
+        self.assertIsNone(app_cache.backend)
+        configure_cache({'CACHE_BACKEND': 'memory'})
+        self.assertIsInstance(app_cache.backend, MemoryBackend)
+        configure_cache({})
+
+    def test_stats_from_threads(self):
+        cache = Cache(MemoryBackend())
+        cache.get_or_load('availability', [1], (), lambda: 1)
+
+        def lookups():
+            for _ in range(2000):
+                cache.lookup('availability', [1], ())
+
+        threads = [threading.Thread(target=lookups) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual({'hits': 16000, 'misses': 1}, {name: cache.stats()[name] for name in ('hits', 'misses')})
+
+    def test_lru_eviction(self):
+        backend = MemoryBackend(max_entries=2)
+        backend.set('a', 1)
+        backend.set('b', 2)
+        backend.get('a')
+        backend.set('c', 3)
+        self.assertEqual(1, backend.get('a'))
+        self.assertEqual(3, backend.get('c'))
+        self.assertEqual(2, len(backend))
+
+    def test_ttl(self):
+        backend = MemoryBackend(ttl=10)
+        with mock.patch('src.cache.time.monotonic', return_value=100):
+            backend.set('a', 1)
+        with mock.patch('src.cache.time.monotonic', return_value=111):
+            self.assertIs(MISSING, backend.get('a'))
+        self.assertEqual(0, len(backend))
+
+
+if __name__ == '__main__':
+    unittest.main()
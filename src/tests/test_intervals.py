@@ -0,0 +1,82 @@
+import unittest
+
+from src.intervals import coalesce, intersect, intersect_many, subtract
+
+
+class TestCoalesce(unittest.TestCase):
+
+    def test_merges_overlapping_and_consecutive(self):
+        self.assertEqual([(0, 30), (40, 50)], list(coalesce([(0, 10), (5, 20), (20, 30), (40, 50)])))
+
+    def test_engulfed_slot(self):
+        self.assertEqual([(0, 100)], list(coalesce([(0, 100), (10, 20)])))
+
+    def test_empty(self):
+        self.assertEqual([], list(coalesce([])))
+
+
+class TestIntersect(unittest.TestCase):
+
+    def test_partial_and_full_overlaps(self):
+        slots1 = [(0, 10), (20, 30), (40, 50)]
+        slots2 = [(5, 25), (40, 50)]
+        self.assertEqual([(5, 10), (20, 25), (40, 50)], list(intersect(slots1, slots2)))
+
+    def test_touching_slots_do_not_overlap(self):
+        self.assertEqual([], list(intersect([(0, 10)], [(10, 20)])))
+
+    def test_redundant_input_slots(self):
+        # overlapping slots of the same user must not produce duplicate overlaps
+        self.assertEqual([(0, 20)], list(intersect([(0, 15), (5, 20)], [(0, 20)])))
+
+    def test_one_side_empty(self):
+        self.assertEqual([], list(intersect([], [(0, 10)])))
+
+
+class TestIntersectMany(unittest.TestCase):
+
+    def test_matches_pairwise_intersection(self):
+        streams = [[(0, 10), (20, 40), (50, 60)], [(5, 25), (30, 55)], [(0, 100)]]
+        expected = list(intersect(intersect(streams[0], streams[1]), streams[2]))
+        self.assertEqual([(5, 10), (20, 25), (30, 40), (50, 55)], expected)
+        self.assertEqual(expected, list(intersect_many(streams)))
+
+    def test_stops_when_a_stream_runs_out(self):
+        def recorded(slots, pulled):
+            for slot in slots:
+                pulled.append(slot)
+                yield slot
+
+        long_slots = [(start, start + 5) for start in range(0, 1000, 10)]
+        pulled = [[], [], []]
+        streams = [recorded([(0, 20)], pulled[0]), recorded(long_slots, pulled[1]), recorded(long_slots, pulled[2])]
+        self.assertEqual([(0, 5), (10, 15)], list(intersect_many(streams)))
+        # the other streams are read up to the slot after the last common one, and one more as coalesce looks ahead
+        self.assertEqual([[(0, 20)], long_slots[:4], long_slots[:4]], pulled)
+
+        pulled = []
+        self.assertEqual([], list(intersect_many([recorded(long_slots, pulled), []])))
+        self.assertEqual(long_slots[:2], pulled)
+        pulled = []
+        self.assertEqual([], list(intersect_many([[], recorded(long_slots, pulled)])))
+        self.assertEqual([], pulled)
+
+    def test_no_streams(self):
+        self.assertEqual([], list(intersect_many([])))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class TestSubtract(unittest.TestCase):
+
+    def test_cuts_inside_across_and_around_slots(self):
+        self.assertEqual([(0, 3), (4, 6), (7, 9), (22, 25), (26, 30)],
+                         list(subtract([(0, 10), (20, 30)], [(3, 4), (6, 7), (9, 22), (25, 26)])))
+
+    def test_slot_removed_entirely(self):
+        self.assertEqual([(20, 30)], list(subtract([(0, 10), (20, 30)], [(0, 10)])))
+
+    def test_overlapping_slots(self):
+        self.assertEqual([(0, 3), (4, 10)], list(subtract([(0, 10), (2, 5)], [(3, 4)])))
@@ -0,0 +1,206 @@
+import os
+import unittest
+from collections import Counter
+from datetime import datetime
+from typing import List, NamedTuple, Optional
+
+from sqlalchemy import event
+
+from app import create_app
+from src.cache import configure_cache
+from src.models import Availability, User, db
+
+IS_POSTGRES = os.environ.get('DATABASE_URL', '').startswith('postgres')
+SCAN_NODES = {'Seq Scan', 'Index Scan', 'Index Only Scan', 'Bitmap Heap Scan'}
+
+
+class Statement(NamedTuple):
+    sql: str
+    parameters: object
+    executemany: bool
+    rowcount: int
+    # EXPLAIN ANALYZE plan of a query on Postgres, taken right before it ran
+    plan: Optional[dict] = None
+
+
+class QueryRecorder:
+    """
+    Records every statement executed on an engine while active, through engine events, with the rows it returned or
+    changed. Used as a context manager around a request.
+
+    On Postgres, queries (WITH ones included) are first run under EXPLAIN ANALYZE on the request's own connection, in
+    a savepoint rolled back before the statement itself runs: the plan sees the data as the statement does, writes of
+    earlier statements in the transaction included and its own not yet applied.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements: List[Statement] = []
+        self._plans = []
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._explain)
+        event.listen(self.engine, 'after_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._explain)
+        event.remove(self.engine, 'after_cursor_execute', self._record)
+
+    def _explain(self, conn, cursor, statement, parameters, context, executemany):
+        query = statement.lstrip().upper().startswith(('SELECT', 'WITH'))
+        if not IS_POSTGRES or executemany or not query:
+            self._plans.append(None)
+            return
+        # a cursor of its own, the statement's may be a server side one
+        with cursor.connection.cursor() as explain:
+            explain.execute("SAVEPOINT query_budget")
+            # the test tables are tiny, plan as for real ones instead of scanning them whole
+            explain.execute("SET LOCAL enable_seqscan = off")
+            explain.execute(f"EXPLAIN (ANALYZE, FORMAT JSON) {statement}", parameters)
+            self._plans.append(explain.fetchone()[0][0]['Plan'])
+            explain.execute("ROLLBACK TO SAVEPOINT query_budget")
+            explain.execute("RELEASE SAVEPOINT query_budget")
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(Statement(statement, parameters, executemany, cursor.rowcount, self._plans.pop()))
+
+    @staticmethod
+    def rows_scanned(statement: Statement) -> int:
+        """
+        Rows the database read for a statement: for a query on Postgres, the rows each scan node of its plan returned
+        or filtered out. Plain writes and other databases count the rows returned or changed.
+        """
+        if statement.plan is None:
+            return max(statement.rowcount, 0)
+        return _scanned(statement.plan)
+
+    def report(self) -> str:
+        """ The statements with the rows each scanned, repeated ones (N+1 candidates) counted once. """
+        repeats = Counter(statement.sql for statement in self.statements)
+        lines, seen = [], set()
+        for statement in self.statements:
+            if statement.sql not in seen:
+                seen.add(statement.sql)
+                lines.append(f"  x{repeats[statement.sql]} rows={self.rows_scanned(statement)}: "
+                             f"{' '.join(statement.sql.split())}")
+        return '\n'.join(lines)
+
+
+def _scanned(node: dict) -> int:
+    rows = 0
+    if node['Node Type'] in SCAN_NODES:
+        rows = (node['Actual Rows'] + node.get('Rows Removed by Filter', 0)
+                + node.get('Rows Removed by Index Recheck', 0)) * node['Actual Loops']
+    return rows + sum(_scanned(child) for child in node.get('Plans', []))
+
+
+class Budget(NamedTuple):
+    method: str
+    path: str
+    queries: int
+    rows: int
+    body: Optional[dict] = None
+    # statements on SQLite where they differ, its driver sends an INSERT .. RETURNING per row instead of batching rows
+    sqlite_queries: Optional[int] = None
+
+    @property
+    def max_queries(self) -> int:
+        """ Statement budget on the database under test. """
+        if IS_POSTGRES or self.sqlite_queries is None:
+            return self.queries
+        return self.sqlite_queries
+
+
+DAY = 86400
+START = int(datetime.fromisoformat('2025-01-01T00:00:00').timestamp())
+# every user has a slot a day for SLOT_DAYS days, the requests read the first ones, the rest only make the tables
+# selective by user as in production, so the planner picks the same indexes on every run
+SLOT_DAYS = 30
+USERS = 50
+SLOT = {'start_time': START + 9 * 3600, 'end_time': START + 17 * 3600}
+
+
+def meeting(user1_id: int, user2_id: int, day: int) -> dict:
+    return {'user1_id': user1_id, 'user2_id': user2_id, 'meeting_start_time': START + day * DAY + 10 * 3600,
+            'meeting_end_time': START + day * DAY + 11 * 3600}
+
+
+# SQL statements and rows scanned each request may take against the data in setUp, with the cache off. Lower a budget
+# when a change makes an endpoint cheaper, raise it only for a reason worth a review.
+BUDGETS = [
+    Budget('GET', '/api/admin/users', queries=1, rows=USERS),
+    Budget('GET', '/api/availability/1', queries=2, rows=30),
+    Budget('GET', f'/api/availability/1?start_time={START}&end_time={START + 7 * DAY}', queries=2, rows=30),
+    Budget('GET', '/api/overlap?user1_id=1&user2_id=2', queries=3, rows=60),
+    Budget('GET', f'/api/overlap?user1_id=1&user2_id=2&start_time={START}&end_time={START + 7 * DAY}&limit=3',
+           queries=3, rows=14),
+    Budget('GET', '/api/overlap/group?user_ids=1&user_ids=2&user_ids=3', queries=2, rows=90),
+    Budget('GET', f'/api/suggestions?user_ids=1&user_ids=2&duration=3600&start_time={START}&k=3', queries=3, rows=60),
+    Budget('GET', f'/api/calendar/1?start_time={START}&end_time={START + 7 * DAY}', queries=3, rows=7),
+    Budget('GET', '/api/availability/1/rules', queries=1, rows=0),
+    # off Postgres the write checks, merges and inserts in separate statements
+    Budget('POST', '/api/availability/1', queries=2, rows=3,
+           body={'start_time': START + 40 * DAY, 'end_time': START + 40 * DAY + 3600}, sqlite_queries=5),
+    Budget('POST', '/api/availability/bulk', queries=3, rows=65,
+           body={'slots': [{'user_id': user_id, 'start_time': START + 40 * DAY, 'end_time': START + 40 * DAY + 3600}
+                           for user_id in (1, 2)]}),
+    Budget('POST', '/api/meeting', queries=13, rows=83, body=meeting(1, 2, 3), sqlite_queries=15),
+    Budget('POST', '/api/meeting/bulk', queries=7, rows=77,
+           body={'meetings': [meeting(1, 2, day) for day in range(4, 9)]}, sqlite_queries=11),
+    Budget('POST', '/api/availability/1/exceptions', queries=2, rows=2,
+           body={'start_time': START + DAY, 'end_time': START + 2 * DAY}),
+]
+
+
+class TestQueryBudgets(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client()
+        self.app.config['TESTING'] = True
+        # budgets are for the database path
+        configure_cache({'CACHE_BACKEND': 'none'})
+
+        with self.app.app_context():
+            db.drop_all()
+            db.create_all()
+            db.session.add_all([User(id=user_id, name=f"User{user_id}") for user_id in range(1, USERS + 1)])
+            db.session.commit()
+            db.session.add_all([Availability(user_id=user_id, start_time=SLOT['start_time'] + day * DAY,
+                                             end_time=SLOT['end_time'] + day * DAY)
+                                for user_id in range(1, USERS + 1) for day in range(SLOT_DAYS)])
+            db.session.commit()
+            if IS_POSTGRES:
+                db.session.execute(db.text("ANALYZE"))
+                db.session.commit()
+
+    def tearDown(self):
+        configure_cache(self.app.config)
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_budgets(self):
+        for budget in BUDGETS:
+            with self.subTest(budget.method + ' ' + budget.path):
+                with self.app.app_context(), QueryRecorder(db.engine) as recorder:
+                    response = self.client.open(budget.path, method=budget.method, json=budget.body)
+                self.assertLess(response.status_code, 300, response.json)
+
+                rows = sum(recorder.rows_scanned(statement) for statement in recorder.statements)
+                if len(recorder.statements) > budget.max_queries or rows > budget.rows:
+                    self.fail(f"{budget.method} {budget.path} ran {len(recorder.statements)} statements "
+                              f"(budget {budget.max_queries}) scanning {rows} rows (budget {budget.rows}):\n"
+                              f"{recorder.report()}")
+
+    def test_recorder_reports_repeated_statements(self):
+        with self.app.app_context(), QueryRecorder(db.engine) as recorder:
+            for user_id in (1, 2, 3):
+                db.session.get(User, user_id)
+        self.assertEqual(3, len(recorder.statements))
+        self.assertIn('x3 rows=', recorder.report())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import time
+import unittest
+from datetime import datetime
+from itertools import islice
+
+from src.models import AvailabilityRule
+from src.recurrence import DAY, expand, expansion_range, occurrences
+
+WEEKDAYS = 0b0011111
+
+
+def timestamp(value: str) -> int:
+    return int(datetime.fromisoformat(value).timestamp())
+
+
+class TestOccurrences(unittest.TestCase):
+
+    def test_weekdays_only(self):
+        # 2025-01-03 is a Friday
+        monday = timestamp('2025-01-06T00:00:00+00:00')
+        rule = AvailabilityRule(weekdays=WEEKDAYS, start_offset=9 * 3600, end_offset=17 * 3600, timezone='UTC',
+                                valid_from=0, valid_until=None)
+        slots = list(occurrences(rule, timestamp('2025-01-03T00:00:00+00:00'), monday + DAY))
+        self.assertEqual([(monday - 3 * DAY + 9 * 3600, monday - 3 * DAY + 17 * 3600),
+                          (monday + 9 * 3600, monday + 17 * 3600)], slots)
+
+    def test_local_hours_across_dst(self):
+        # Berlin moves from UTC+1 to UTC+2 on 2025-03-30
+        rule = AvailabilityRule(weekdays=0b1111111, start_offset=9 * 3600, end_offset=17 * 3600,
+                                timezone='Europe/Berlin', valid_from=0, valid_until=None)
+        slots = list(occurrences(rule, timestamp('2025-03-29T00:00:00+00:00'), timestamp('2025-03-31T00:00:00+00:00')))
+        self.assertEqual([(timestamp('2025-03-29T08:00:00+00:00'), timestamp('2025-03-29T16:00:00+00:00')),
+                          (timestamp('2025-03-30T07:00:00+00:00'), timestamp('2025-03-30T15:00:00+00:00'))], slots)
+
+    def test_cut_to_validity(self):
+        start = timestamp('2025-01-01T00:00:00+00:00')
+        rule = AvailabilityRule(weekdays=0b1111111, start_offset=0, end_offset=DAY, timezone='UTC',
+                                valid_from=start + 3600, valid_until=start + DAY + 7200)
+        self.assertEqual([(start + 3600, start + DAY), (start + DAY, start + DAY + 7200)],
+                         list(occurrences(rule, start - DAY, start + 10 * DAY)))
+
+    def test_window_overlap(self):
+        start = timestamp('2025-01-01T00:00:00+00:00')
+        rule = AvailabilityRule(weekdays=0b1111111, start_offset=9 * 3600, end_offset=17 * 3600, timezone='UTC',
+                                valid_from=0, valid_until=None)
+        self.assertEqual([(start + 9 * 3600, start + 17 * 3600)],
+                         list(occurrences(rule, start + 16 * 3600, start + 17 * 3600)))
+
+
+class TestExpand(unittest.TestCase):
+
+    def test_exceptions_are_streamed(self):
+        start = timestamp('2025-01-01T00:00:00+00:00')
+        rules = [AvailabilityRule(user_id=user_id, weekdays=0b1111111, start_offset=9 * 3600, end_offset=17 * 3600,
+                                  timezone='UTC', valid_from=0, valid_until=None) for user_id in (1, 2)]
+        pulled = []
+
+        def exceptions():
+            # a day off every other day for user 1 and every third day for user 2, over ten years
+            for day in range(3650):
+                for user_id, every in ((1, 2), (2, 3)):
+                    if day % every == 0:
+                        pulled.append((user_id, day))
+                        yield user_id, start + day * DAY, start + (day + 1) * DAY
+
+        slots = expand(rules, exceptions(), start, start + 3650 * DAY)
+        self.assertEqual([(start + DAY + 9 * 3600, start + DAY + 17 * 3600),
+                          (start + 3 * DAY + 9 * 3600, start + 3 * DAY + 17 * 3600)], list(islice(slots[1], 2)))
+        # only the exceptions up to the slots read, and one ahead, are pulled, with user 2's on the way
+        self.assertEqual([(1, 0), (2, 0), (1, 2), (2, 3), (1, 4), (1, 6)], pulled)
+        self.assertEqual((start + DAY + 9 * 3600, start + DAY + 17 * 3600), next(slots[2]))
+        self.assertEqual([(2, 6)], pulled[6:])
+
+
+class TestExpansionRange(unittest.TestCase):
+
+    def test_open_ends_stop_at_the_horizon(self):
+        before = int(time.time())
+        start_time, end_time = expansion_range(None, None, 10)
+        after = int(time.time())
+        self.assertTrue(before - 10 * DAY <= start_time <= after - 10 * DAY)
+        self.assertTrue(before + 10 * DAY <= end_time <= after + 10 * DAY)
+        self.assertEqual((0, 1), expansion_range(0, 1, 10))
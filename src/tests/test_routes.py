@@ -1,9 +1,16 @@
 import json
+import os
+import time
 import unittest
-from datetime import datetime
+from datetime import datetime, timezone
+
+from sqlalchemy import exc, text
 
 from app import create_app
-from src.models import User, db
+from src import bitmap, compaction, partitioning, range_backend, replica, services
+from src.cache import configure_cache
+from src.models import ArchivedAvailability, Availability, Meeting, User, db
+from src.recurrence import configure_recurrence
 
 
 class BaseAPITestCase(unittest.TestCase):
@@ -51,6 +58,41 @@ class TestGetUsers(BaseAPITestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.json), 0)
 
+class TestUsersPagination(BaseAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            db.session.add_all([User(name=f"User{i}") for i in range(3, 6)])
+            db.session.commit()
+
+    def test_keyset_pages(self):
+        response = self.client.get('/api/admin/users?limit=2')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(['User1', 'User2'], [user['name'] for user in response.json])
+        self.assertEqual('2', response.headers['X-Next-Cursor'])
+
+        response = self.client.get('/api/admin/users?limit=2&after_id=2')
+        self.assertEqual(['User3', 'User4'], [user['name'] for user in response.json])
+
+        response = self.client.get('/api/admin/users?limit=2&after_id=4')
+        self.assertEqual(['User5'], [user['name'] for user in response.json])
+        self.assertNotIn('X-Next-Cursor', response.headers)
+
+    def test_stream(self):
+        response = self.client.get('/api/admin/users?stream=true')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([f"User{i}" for i in range(1, 6)], [user['name'] for user in json.loads(response.data)])
+
+    def test_stream_no_users(self):
+        with self.app.app_context():
+            db.session.query(User).delete()
+            db.session.commit()
+
+        response = self.client.get('/api/admin/users?stream=true')
+        self.assertEqual([], json.loads(response.data))
+
+
 class TestAvailability(BaseAPITestCase):
 
     def test_non_overlapping(self):
@@ -125,6 +167,18 @@ class TestAvailability(BaseAPITestCase):
         self.assertEqual(self.start_time - 600, data[0]['start_time'])
         self.assertEqual(self.end_time + 600, data[0]['end_time'])
 
+    def test_bridging_slots(self):
+        start = int(self.start_time)
+        for slot_start, slot_end in ((start, start + 600), (start + 1200, start + 1800), (start + 2400, start + 3000)):
+            response = self.client.post('/api/availability/1', json={'start_time': slot_start, 'end_time': slot_end})
+            self.assertEqual(201, response.status_code)
+
+        # touches the first slot, engulfs the second and overlaps the third
+        response = self.client.post('/api/availability/1', json={'start_time': start + 600, 'end_time': start + 2500})
+        self.assertEqual(201, response.status_code)
+        self.assertEqual([{'start_time': start, 'end_time': start + 3000}], self.client.get('/api/availability/1').json)
+        with self.app.app_context():
+            self.assertEqual(1, db.session.query(Availability).count())
 
     def test_invalid_time(self):
         # cannot modify a past availability
@@ -182,6 +236,67 @@ class TestAvailability(BaseAPITestCase):
         self.assertEqual(self.end_time, data[0]['end_time'])
 
 
+class TestBulkAvailability(BaseAPITestCase):
+
+    def test_coalesces_with_existing_slots(self):
+        response = self.client.post('/api/availability/1', json={'start_time': self.start_time, 'end_time': self.end_time})
+        self.assertEqual(201, response.status_code)
+
+        slots = [
+            # bridges the existing slot with the next one in the batch
+            {'user_id': 1, 'start_time': self.end_time, 'end_time': self.end_time + 3600},
+            {'user_id': 1, 'start_time': self.end_time + 1800, 'end_time': self.end_time + 7200},
+            {'user_id': 1, 'start_time': self.end_time + 36000, 'end_time': self.end_time + 39600},
+            {'user_id': 2, 'start_time': self.start_time, 'end_time': self.end_time},
+        ]
+        response = self.client.post('/api/availability/bulk', json={'slots': slots})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(4, response.json['created'])
+        self.assertEqual(0, response.json['failed'])
+
+        response = self.client.get('/api/availability/1')
+        self.assertEqual([{'start_time': self.start_time, 'end_time': self.end_time + 7200},
+                          {'start_time': self.end_time + 36000, 'end_time': self.end_time + 39600}], response.json)
+
+        response = self.client.get('/api/availability/2')
+        self.assertEqual([{'start_time': self.start_time, 'end_time': self.end_time}], response.json)
+
+    def test_per_slot_errors(self):
+        response = self.client.post('/api/availability/1', json={'start_time': self.start_time, 'end_time': self.end_time})
+        self.assertEqual(201, response.status_code)
+
+        slots = [
+            {'user_id': 1, 'start_time': self.start_time + 600, 'end_time': self.end_time - 600},
+            {'user_id': 1, 'start_time': self.end_time, 'end_time': self.start_time},
+            {'user_id': 99, 'start_time': self.start_time, 'end_time': self.end_time},
+            {'user_id': 2, 'start_time': self.start_time},
+            {'user_id': 2, 'start_time': self.start_time, 'end_time': self.end_time},
+        ]
+        response = self.client.post('/api/availability/bulk', json={'slots': slots})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, response.json['created'])
+        self.assertEqual(['User is already available in the requested time', 'Invalid timestamps',
+                          'User does not exist', 'Slot must have user_id, start_time and end_time'],
+                         [result['error'] for result in response.json['results'][:4]])
+        self.assertEqual({'index': 4, 'status': 'created'}, response.json['results'][4])
+
+        response = self.client.get('/api/availability/1')
+        self.assertEqual([{'start_time': self.start_time, 'end_time': self.end_time}], response.json)
+
+    def test_not_a_list_of_slots(self):
+        response = self.client.post('/api/availability/bulk', json={'slots': 'abc'})
+        self.assertEqual(400, response.status_code)
+        self.assertEqual({'slots': 'slots must be a list of objects'}, response.json['errors'])
+        for slots in ({'user_id': 1}, [1, 2], [{'user_id': 1, 'start_time': 0, 'end_time': 60}, 'abc'], None):
+            with self.subTest(slots=slots):
+                response = self.client.post('/api/availability/bulk', json={'slots': slots})
+                self.assertEqual(400, response.status_code)
+
+        response = self.client.post('/api/meeting/bulk', json={'meetings': 'abc'})
+        self.assertEqual(400, response.status_code)
+        self.assertEqual({'meetings': 'meetings must be a list of objects'}, response.json['errors'])
+
+
 class TestOverlap(BaseAPITestCase):
 
     def test_perfect_overlap(self):
@@ -216,6 +331,448 @@ class TestOverlap(BaseAPITestCase):
         self.assertEqual(self.start_time + 1800, data[0]['start_time'])
         self.assertEqual(self.end_time, data[0]['end_time'])
 
+    def test_multiple_overlaps_sorted(self):
+        for start, end in [(7200, 10800), (0, 3600)]:
+            response = self.client.post('/api/availability/1',
+                                        json={'start_time': self.start_time + start, 'end_time': self.start_time + end})
+            self.assertEqual(201, response.status_code)
+
+        response = self.client.post('/api/availability/2',
+                                    json={'start_time': self.start_time + 1800, 'end_time': self.start_time + 9000})
+        self.assertEqual(201, response.status_code)
+
+        response = self.client.get('/api/overlap?user1_id=1&user2_id=2')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([{'start_time': self.start_time + 1800, 'end_time': self.start_time + 3600},
+                          {'start_time': self.start_time + 7200, 'end_time': self.start_time + 9000}], response.json)
+
+    def _add_hours(self, user_id, hours):
+        for hour in hours:
+            response = self.client.post(f'/api/availability/{user_id}',
+                                        json={'start_time': self.start_time + hour * 3600 + 600,
+                                              'end_time': self.start_time + hour * 3600 + 3000})
+            self.assertEqual(201, response.status_code)
+
+    def test_window(self):
+        self._add_hours(1, range(6))
+        self._add_hours(2, range(6))
+        start = int(self.start_time)
+
+        # a window cutting into the slots at both of its ends
+        response = self.client.get(f'/api/overlap?user1_id=1&user2_id=2&start_time={start + 3600 + 1800}'
+                                   f'&end_time={start + 3 * 3600 + 1200}')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([{'start_time': start + 3600 + 1800, 'end_time': start + 3600 + 3000},
+                          {'start_time': start + 2 * 3600 + 600, 'end_time': start + 2 * 3600 + 3000},
+                          {'start_time': start + 3 * 3600 + 600, 'end_time': start + 3 * 3600 + 1200}], response.json)
+
+        response = self.client.get(f'/api/overlap?user1_id=1&user2_id=2&start_time={start + 6 * 3600}')
+        self.assertEqual([], response.json)
+
+        response = self.client.get(f'/api/overlap?user1_id=1&user2_id=2&start_time={start}&end_time={start}')
+        self.assertEqual(400, response.status_code)
+
+    def test_pagination(self):
+        self._add_hours(1, range(5))
+        self._add_hours(2, range(5))
+
+        pages, cursor = [], None
+        while True:
+            response = self.client.get('/api/overlap?user1_id=1&user2_id=2&limit=2'
+                                       + ('' if cursor is None else f'&after={cursor}'))
+            self.assertEqual(200, response.status_code)
+            pages.append(response.json)
+            cursor = response.headers.get('X-Next-Cursor')
+            if cursor is None:
+                break
+
+        self.assertEqual([2, 2, 1], [len(page) for page in pages])
+        everything = self.client.get('/api/overlap?user1_id=1&user2_id=2').json
+        self.assertEqual(everything, [slot for page in pages for slot in page])
+
+        response = self.client.get('/api/overlap?user1_id=1&user2_id=2&limit=0')
+        self.assertEqual(400, response.status_code)
+
+
+@unittest.skipUnless(os.environ.get('DATABASE_URL', '').startswith('postgres'), "query plans need Postgres")
+class TestOverlapWindowPlan(BaseAPITestCase):
+
+    def test_window_uses_composite_index(self):
+        with self.app.app_context():
+            query = services.availability_window_query(1, 2_000_000_000, 2_000_086_400)
+            statement = str(query.compile(db.engine, compile_kwargs={'literal_binds': True}))
+            # the table is tiny, make sure a sequential scan is not chosen for being cheaper
+            db.session.execute(db.text("SET LOCAL enable_seqscan = off"))
+            plan = '\n'.join(row[0] for row in db.session.execute(db.text(f"EXPLAIN {statement}")))
+            db.session.rollback()
+
+        self.assertIn('ix_availabilities_user_id_start_time', plan)
+        self.assertNotIn('Seq Scan', plan)
+        # rows come in index order, a paginated read stops early
+        self.assertNotIn('Sort', plan)
+
+
+class TestGroupOverlap(BaseAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            db.session.add(User(name="User3"))
+            db.session.commit()
+
+    def test_common_availability(self):
+        for user_id, start, end in [(1, 0, 7200), (2, 1800, 10800), (3, 0, 3600), (3, 5400, 10800)]:
+            response = self.client.post(f'/api/availability/{user_id}',
+                                        json={'start_time': self.start_time + start, 'end_time': self.start_time + end})
+            self.assertEqual(201, response.status_code)
+
+        response = self.client.get('/api/overlap/group?user_ids=1&user_ids=2&user_ids=3')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([{'start_time': self.start_time + 1800, 'end_time': self.start_time + 3600},
+                          {'start_time': self.start_time + 5400, 'end_time': self.start_time + 7200}], response.json)
+
+    def test_user_without_availability(self):
+        response = self.client.post('/api/availability/1', json={'start_time': self.start_time, 'end_time': self.end_time})
+        self.assertEqual(201, response.status_code)
+
+        response = self.client.get('/api/overlap/group?user_ids=1&user_ids=2&user_ids=3')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([], response.json)
+
+    def test_single_user(self):
+        response = self.client.get('/api/overlap/group?user_ids=1&user_ids=1')
+        self.assertEqual(400, response.status_code)
+        self.assertEqual('at least two users are required', response.json['error'])
+
+    def test_window_and_min_duration(self):
+        for user_id, start, end in [(1, 0, 10800), (2, 0, 3600), (2, 5400, 6000), (2, 7200, 10800), (3, 1800, 10800)]:
+            response = self.client.post(f'/api/availability/{user_id}',
+                                        json={'start_time': self.start_time + start, 'end_time': self.start_time + end})
+            self.assertEqual(201, response.status_code)
+
+        response = self.client.get(f'/api/overlap/group?user_ids=1&user_ids=2&user_ids=3&min_duration=1800'
+                                   f'&start_time={int(self.start_time) + 2700}&end_time={int(self.start_time) + 9000}')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([{'start_time': self.start_time + 7200, 'end_time': self.start_time + 9000}], response.json)
+
+        response = self.client.get(f'/api/overlap/group?user_ids=1&user_ids=2&start_time={int(self.start_time)}'
+                                   f'&end_time={int(self.start_time)}')
+        self.assertEqual(400, response.status_code)
+
+
+@unittest.skipIf(bitmap.np is None, "numpy is not installed")
+class TestGroupOverlapBitmap(TestGroupOverlap):
+    """ The group overlap tests again, on bitmaps. """
+
+    def setUp(self):
+        super().setUp()
+        self.app.config['AVAILABILITY_BITMAPS'] = True
+
+    def test_write_rebuilds_bitmap(self):
+        for user_id in (1, 2):
+            response = self.client.post(f'/api/availability/{user_id}',
+                                        json={'start_time': self.start_time, 'end_time': self.end_time})
+            self.assertEqual(201, response.status_code)
+        response = self.client.get('/api/overlap/group?user_ids=1&user_ids=2')
+        self.assertEqual([{'start_time': self.start_time, 'end_time': self.end_time}], response.json)
+
+        response = self.client.post('/api/availability/2', json={'start_time': self.end_time - 600,
+                                                                 'end_time': self.end_time + 3600})
+        self.assertEqual(201, response.status_code)
+        response = self.client.post('/api/availability/1', json={'start_time': self.end_time,
+                                                                 'end_time': self.end_time + 1800})
+        self.assertEqual(201, response.status_code)
+        response = self.client.get('/api/overlap/group?user_ids=1&user_ids=2')
+        self.assertEqual([{'start_time': self.start_time, 'end_time': self.end_time + 1800}], response.json)
+
+
+class TestSuggestions(BaseAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        for user_id, start, end in [(1, 0, 3600), (1, 5400, 14400), (2, 1800, 7200), (2, 9000, 12600),
+                                    (2, 12600, 14400)]:
+            response = self.client.post(f'/api/availability/{user_id}',
+                                        json={'start_time': self.start_time + start, 'end_time': self.start_time + end})
+            self.assertEqual(201, response.status_code)
+        self.start_time = int(self.start_time)
+
+    def suggest(self, query: str):
+        return self.client.get(f'/api/suggestions?user_ids=1&user_ids=2&start_time={self.start_time}&{query}')
+
+    def test_one_per_common_slot(self):
+        response = self.suggest('duration=1800&k=3')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([{'start_time': self.start_time + 1800, 'end_time': self.start_time + 3600},
+                          {'start_time': self.start_time + 5400, 'end_time': self.start_time + 7200},
+                          {'start_time': self.start_time + 9000, 'end_time': self.start_time + 10800}], response.json)
+
+    def test_too_short_slots_are_skipped(self):
+        response = self.suggest('duration=3600&k=1')
+        self.assertEqual([{'start_time': self.start_time + 9000, 'end_time': self.start_time + 12600}],
+                         response.json)
+
+    def test_step_and_window(self):
+        response = self.suggest(f'duration=900&k=10&step=900&end_time={self.start_time + 7200}')
+        self.assertEqual([self.start_time + start for start in (1800, 2700, 5400, 6300)],
+                         [suggestion['start_time'] for suggestion in response.json])
+
+    def test_invalid_arguments(self):
+        self.assertEqual('duration must be positive', self.suggest('duration=0').json['error'])
+        self.assertEqual('k must be between 1 and 100', self.suggest('duration=60&k=0').json['error'])
+        response = self.client.get('/api/suggestions?user_ids=1&duration=60')
+        self.assertEqual(400, response.status_code)
+
+
+class TestRecurringAvailability(BaseAPITestCase):
+    HOUR = 3600
+    DAY = 86400
+
+    def setUp(self):
+        super().setUp()
+        # reads without an end expand rules from now on, reach the fixed dates below whenever the tests run
+        configure_recurrence({'RECURRENCE_HORIZON_DAYS': 36500})
+        # 2025-01-01 is a Wednesday, user 1 is available every weekday from 9 to 17 UTC
+        self.midnight = int(datetime.fromisoformat('2025-01-01T00:00:00+00:00').timestamp())
+        response = self.client.post('/api/availability/1/rules', json={
+            'weekdays': [0, 1, 2, 3, 4], 'start_offset': 9 * self.HOUR, 'end_offset': 17 * self.HOUR,
+            'valid_from': self.midnight})
+        self.assertEqual(201, response.status_code)
+        self.rule = response.json
+
+    def tearDown(self):
+        configure_recurrence(self.app.config)
+        super().tearDown()
+
+    def availability(self, user_id: int, days: int):
+        return self.client.get(f'/api/availability/{user_id}?start_time={self.midnight}'
+                               f'&end_time={self.midnight + days * self.DAY}').json
+
+    def slot(self, day: int, start_hour: int, end_hour: int) -> dict:
+        return {'start_time': self.midnight + day * self.DAY + start_hour * self.HOUR,
+                'end_time': self.midnight + day * self.DAY + end_hour * self.HOUR}
+
+    def test_expanded_for_the_requested_range(self):
+        self.assertEqual([0, 1, 2, 3, 4], self.rule['weekdays'])
+        self.assertEqual([self.slot(day, 9, 17) for day in (0, 1, 2, 5, 6)], self.availability(1, 7))
+        self.assertEqual([self.rule], self.client.get('/api/availability/1/rules').json)
+
+    def test_merged_with_slots(self):
+        response = self.client.post('/api/availability/1', json=self.slot(0, 17, 19))
+        self.assertEqual(201, response.status_code)
+        response = self.client.post('/api/availability/1', json=self.slot(1, 10, 12))
+        self.assertEqual(400, response.status_code)
+        self.assertEqual([self.slot(0, 9, 19), self.slot(1, 9, 17)], self.availability(1, 2))
+
+    def test_slot_bridging_slots(self):
+        # users with rules are normalized by the ORM path, on a Saturday the rule leaves free
+        for slot in (self.slot(3, 8, 9), self.slot(3, 10, 11), self.slot(3, 9, 10)):
+            response = self.client.post('/api/availability/1', json=slot)
+            self.assertEqual(201, response.status_code)
+        day = self.slot(3, 0, 24)
+        self.assertEqual([self.slot(3, 8, 11)], self.client.get(
+            f"/api/availability/1?start_time={day['start_time']}&end_time={day['end_time']}").json)
+        with self.app.app_context():
+            self.assertEqual(1, db.session.query(Availability).count())
+
+    def test_overlap_and_meeting(self):
+        response = self.client.post('/api/availability/2', json=self.slot(0, 16, 18))
+        self.assertEqual(201, response.status_code)
+        response = self.client.post('/api/availability/1', json=self.slot(0, 17, 18))
+        self.assertEqual(201, response.status_code)
+        self.assertEqual([self.slot(0, 16, 18)], self.client.get('/api/overlap?user1_id=1&user2_id=2').json)
+
+        # spans the recurring slot and the materialized one after it
+        meeting = self.slot(0, 16, 18)
+        response = self.client.post('/api/meeting', json={'user1_id': 1, 'user2_id': 2,
+                                                          'meeting_start_time': meeting['start_time'],
+                                                          'meeting_end_time': meeting['end_time']})
+        self.assertEqual(201, response.status_code)
+        self.assertEqual([self.slot(0, 9, 16), self.slot(1, 9, 17)], self.availability(1, 2))
+        self.assertEqual([], self.client.get('/api/overlap?user1_id=1&user2_id=2').json)
+
+    def test_bulk_meetings(self):
+        for slot in (self.slot(0, 16, 18), self.slot(1, 8, 12)):
+            response = self.client.post('/api/availability/2', json=slot)
+            self.assertEqual(201, response.status_code)
+        response = self.client.post('/api/availability/1', json=self.slot(0, 17, 18))
+        self.assertEqual(201, response.status_code)
+
+        meetings = [{'user1_id': 1, 'user2_id': 2, 'meeting_start_time': slot['start_time'],
+                     'meeting_end_time': slot['end_time']} for slot in (self.slot(0, 16, 18), self.slot(1, 10, 11))]
+        response = self.client.post('/api/meeting/bulk', json={'meetings': meetings})
+        self.assertEqual(2, response.json['scheduled'])
+        self.assertEqual([self.slot(0, 9, 16), self.slot(1, 9, 10), self.slot(1, 11, 17)], self.availability(1, 2))
+        self.assertEqual([self.slot(1, 8, 10), self.slot(1, 11, 12)], self.availability(2, 2))
+
+    def test_exception_and_rule_deletion(self):
+        response = self.client.post('/api/availability/1/exceptions', json=self.slot(1, 0, 24))
+        self.assertEqual(201, response.status_code)
+        self.assertEqual([self.slot(0, 9, 17), self.slot(2, 9, 17)], self.availability(1, 3))
+
+        response = self.client.delete(f'/api/availability/1/rules/{self.rule["id"]}')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([], self.availability(1, 3))
+        response = self.client.delete(f'/api/availability/1/rules/{self.rule["id"]}')
+        self.assertEqual(404, response.status_code)
+
+    def test_invalid_rules(self):
+        rule = {'weekdays': [0], 'start_offset': 0, 'end_offset': self.HOUR, 'valid_from': self.midnight}
+        # rules start at most the default horizon ago and end in the future
+        configure_recurrence(self.app.config)
+        now = int(time.time())
+        for invalid in ({'weekdays': [7]}, {'start_offset': self.HOUR}, {'end_offset': 2 * self.DAY},
+                        {'timezone': 'Mars/Olympus'}, {'valid_until': self.midnight}, {'valid_from': 0},
+                        {'valid_from': now - 366 * self.DAY},
+                        {'valid_from': now - self.DAY, 'valid_until': now - self.HOUR}):
+            response = self.client.post('/api/availability/1/rules', json={**rule, **invalid})
+            self.assertEqual(400, response.status_code, invalid)
+        response = self.client.post('/api/availability/9/rules', json=rule)
+        self.assertEqual(404, response.status_code)
+
+
+class TestCache(BaseAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        # the test client runs in a single process, the memory backend is enough
+        configure_cache({'CACHE_BACKEND': 'memory'})
+
+    def tearDown(self):
+        configure_cache(self.app.config)
+        super().tearDown()
+
+    def test_reads_are_cached_until_a_write(self):
+        response = self.client.post('/api/availability/1', json={'start_time': self.start_time, 'end_time': self.end_time})
+        self.assertEqual(201, response.status_code)
+
+        self.assertEqual(1, len(self.client.get('/api/availability/1').json))
+        self.assertEqual(1, len(self.client.get('/api/availability/1').json))
+        self.assertEqual({'hits': 1, 'misses': 1, 'hit_ratio': 0.5}, self.client.get('/api/admin/cache').json)
+
+        response = self.client.post('/api/availability/1',
+                                    json={'start_time': self.start_time + 7200, 'end_time': self.end_time + 7200})
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(2, len(self.client.get('/api/availability/1').json))
+
+    def test_meeting_invalidates_overlap_of_both_users(self):
+        for user_id in (1, 2):
+            response = self.client.post(f'/api/availability/{user_id}',
+                                        json={'start_time': self.start_time, 'end_time': self.end_time})
+            self.assertEqual(201, response.status_code)
+
+        self.assertEqual(1, len(self.client.get('/api/overlap?user1_id=1&user2_id=2').json))
+        # both orders of the pair share one entry
+        self.assertEqual(1, len(self.client.get('/api/overlap?user1_id=2&user2_id=1').json))
+        self.assertEqual(1, self.client.get('/api/admin/cache').json['hits'])
+
+        response = self.client.post('/api/meeting', json={'user1_id': 1, 'user2_id': 2, 'meeting_start_time': self.start_time,
+                                                          'meeting_end_time': self.end_time})
+        self.assertEqual(201, response.status_code)
+        self.assertEqual([], self.client.get('/api/overlap?user1_id=1&user2_id=2').json)
+
+
+class TestMetrics(BaseAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        configure_cache({'CACHE_BACKEND': 'memory'})
+
+    def tearDown(self):
+        configure_cache(self.app.config)
+        super().tearDown()
+
+    def test_metrics(self):
+        response = self.client.post('/api/availability/1', json={'start_time': self.start_time, 'end_time': self.end_time})
+        self.assertEqual(201, response.status_code)
+        self.client.get('/api/availability/1')
+
+        response = self.client.get('/metrics')
+        self.assertEqual(200, response.status_code)
+        metrics = response.data.decode()
+        self.assertIn('http_request_duration_seconds_count{method="POST",route="/api/availability/<int:user_id>"} 1',
+                      metrics)
+        self.assertIn('http_responses_total{method="GET",route="/api/availability/<int:user_id>",status="200"} 1',
+                      metrics)
+        self.assertIn('db_statements_per_request_count{route="/api/availability/<int:user_id>"} 2', metrics)
+        self.assertIn('cache_misses_total 1', metrics)
+
+    def test_slow_request_log(self):
+        self.app.extensions['metrics'].slow_request_seconds = 0
+        with self.assertLogs('src.metrics', level='WARNING') as logs:
+            self.client.get('/api/availability/1')
+        self.assertIn('Slow request GET /api/availability/1?', logs.output[0])
+        self.assertIn('FROM availabilities', logs.output[0])
+
+    def test_streamed_response(self):
+        metrics = self.app.extensions['metrics']
+        # the users are read while the body is sent, after the view returned
+        response = self.client.get('/api/admin/users?stream=true')
+        self.assertNotIn('/api/admin/users', metrics.statements)
+        response.get_data()
+        response.close()
+        self.assertEqual(1, metrics.responses[('GET', '/api/admin/users', 200)])
+        self.assertEqual(1, metrics.statements['/api/admin/users'].sum)
+
+    def test_failed_statement(self):
+        with self.app.app_context():
+            with self.assertRaises(exc.DBAPIError):
+                db.session.execute(text('SELECT * FROM no_such_table'))
+            db.session.rollback()
+            connection = db.session.connection()
+            db.session.execute(text('SELECT 1'))
+            # nothing is left behind on the connection for the statements after it
+            self.assertNotIn('query_started', connection.info)
+
+
+@unittest.skipUnless(os.environ.get('DATABASE_URL', '').startswith('postgres'), "range types need Postgres")
+class TestRangeBackend(BaseAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            # overlapping slots left behind by older versions, the migration has to merge them
+            db.session.add_all([Availability(user_id=1, start_time=self.start_time, end_time=self.end_time),
+                                Availability(user_id=1, start_time=self.start_time + 1800, end_time=self.end_time + 1800),
+                                Availability(user_id=2, start_time=self.start_time, end_time=self.end_time)])
+            db.session.commit()
+            if not range_backend.is_available():
+                self.skipTest("btree_gist extension is not installed")
+            range_backend.migrate()
+        self.app.config['AVAILABILITY_RANGE_BACKEND'] = True
+
+    def test_migration_merges_overlapping_slots(self):
+        response = self.client.get('/api/availability/1')
+        self.assertEqual([{'start_time': self.start_time, 'end_time': self.end_time + 1800}], response.json)
+
+    def test_new_slot_bridging_two_slots(self):
+        response = self.client.post('/api/availability/1',
+                                    json={'start_time': self.end_time + 7200, 'end_time': self.end_time + 10800})
+        self.assertEqual(201, response.status_code)
+        response = self.client.post('/api/availability/1',
+                                    json={'start_time': self.end_time + 1800, 'end_time': self.end_time + 7200})
+        self.assertEqual(201, response.status_code)
+
+        response = self.client.get('/api/availability/1')
+        self.assertEqual([{'start_time': self.start_time, 'end_time': self.end_time + 10800}], response.json)
+
+        response = self.client.post('/api/availability/1',
+                                    json={'start_time': self.start_time + 600, 'end_time': self.end_time})
+        self.assertEqual(400, response.status_code)
+
+    def test_overlap_and_meeting(self):
+        response = self.client.get('/api/overlap?user1_id=1&user2_id=2')
+        self.assertEqual([{'start_time': self.start_time, 'end_time': self.end_time}], response.json)
+
+        response = self.client.post('/api/meeting', json={'user1_id': 1, 'user2_id': 2,
+                                                          'meeting_start_time': self.start_time + 600,
+                                                          'meeting_end_time': self.end_time - 600})
+        self.assertEqual(201, response.status_code)
+        response = self.client.get('/api/availability/1')
+        self.assertEqual([{'start_time': self.start_time, 'end_time': self.start_time + 600},
+                          {'start_time': self.end_time - 600, 'end_time': self.end_time + 1800}], response.json)
+
+
 class TestMeeting(BaseAPITestCase):
     def test_schedule_meeting(self):
         response = self.client.post('/api/availability/1',
@@ -315,5 +872,336 @@ class TestMeeting(BaseAPITestCase):
         self.assertEqual('Invalid timestamps', response.json['error'])
 
 
+class TestBulkMeeting(BaseAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            db.session.add(User(name="User3"))
+            db.session.commit()
+        for user_id in (1, 2, 3):
+            response = self.client.post(f'/api/availability/{user_id}',
+                                        json={'start_time': self.start_time, 'end_time': self.end_time})
+            self.assertEqual(201, response.status_code)
+
+    def meeting(self, user1_id, user2_id, start, end):
+        return {'user1_id': user1_id, 'user2_id': user2_id, 'meeting_start_time': self.start_time + start,
+                'meeting_end_time': self.start_time + end}
+
+    def test_schedules_in_one_transaction(self):
+        meetings = [self.meeting(1, 2, 0, 600), self.meeting(1, 3, 1200, 1800), self.meeting(2, 3, 2400, 3600)]
+        response = self.client.post('/api/meeting/bulk', json={'meetings': meetings})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(3, response.json['scheduled'])
+        self.assertEqual(0, response.json['failed'])
+        self.assertEqual(['scheduled'] * 3, [result['status'] for result in response.json['results']])
+
+        start = self.start_time
+        self.assertEqual([{'start_time': start + 600, 'end_time': start + 1200},
+                          {'start_time': start + 1800, 'end_time': start + 3600}],
+                         self.client.get('/api/availability/1').json)
+        self.assertEqual([{'start_time': start + 600, 'end_time': start + 2400}],
+                         self.client.get('/api/availability/2').json)
+        self.assertEqual([{'start_time': start, 'end_time': start + 1200},
+                          {'start_time': start + 1800, 'end_time': start + 2400}],
+                         self.client.get('/api/availability/3').json)
+
+        calendar = self.client.get(f'/api/calendar/3?start_time={int(start)}&end_time={int(self.end_time)}').json
+        self.assertEqual([(1, response.json['results'][1]['id']), (2, response.json['results'][2]['id'])],
+                         [(entry['participants'][0], entry['id']) for entry in calendar if entry['type'] == 'meeting'])
+
+    def test_per_meeting_errors(self):
+        meetings = [
+            self.meeting(1, 2, 0, 1800),
+            # overlaps the first meeting for user 2
+            self.meeting(2, 3, 1200, 2400),
+            self.meeting(1, 3, 3000, 4200),
+            self.meeting(1, 99, 2400, 3000),
+            self.meeting(1, 2, 600, 0),
+            {'user1_id': 1, 'user2_id': 2},
+            self.meeting(1, 3, 1800, 3000),
+        ]
+        response = self.client.post('/api/meeting/bulk', json={'meetings': meetings})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(2, response.json['scheduled'])
+        self.assertEqual(['Conflicts with meeting 0 of the batch',
+                          'No overlap found in availability for the requested time', 'One or both users do not exist',
+                          'Invalid timestamps',
+                          'Meeting must have user1_id, user2_id, meeting_start_time and meeting_end_time'],
+                         [result['error'] for result in response.json['results'][1:6]])
+        self.assertEqual('scheduled', response.json['results'][6]['status'])
+
+        response = self.client.post('/api/meeting/bulk', json={'meetings': [self.meeting(1, 2, 0, 600)]})
+        self.assertEqual(0, response.json['scheduled'])
+        self.assertEqual('No overlap found in availability for the requested time',
+                         response.json['results'][0]['error'])
+
+
+class CalendarTestCase(BaseAPITestCase):
+    """ Users 1 and 2 are available for an hour and meet from its 10th to its 30th minute. """
+
+    def setUp(self):
+        super().setUp()
+        for user_id in (1, 2):
+            response = self.client.post(f'/api/availability/{user_id}',
+                                        json={'start_time': self.start_time, 'end_time': self.end_time})
+            self.assertEqual(201, response.status_code)
+        response = self.client.post('/api/meeting', json={'user1_id': 1, 'user2_id': 2,
+                                                          'meeting_start_time': self.start_time + 600,
+                                                          'meeting_end_time': self.start_time + 1800})
+        self.assertEqual(201, response.status_code)
+
+
+class TestCalendar(CalendarTestCase):
+
+    def test_timeline(self):
+        start, end = int(self.start_time), int(self.end_time)
+        response = self.client.get(f'/api/calendar/1?start_time={start}&end_time={end}')
+        self.assertEqual(200, response.status_code)
+        meeting_id = response.json[1]['id']
+        self.assertEqual([{'type': 'availability', 'start_time': start, 'end_time': start + 600},
+                          {'type': 'meeting', 'id': meeting_id, 'start_time': start + 600, 'end_time': start + 1800,
+                           'participants': [2]},
+                          {'type': 'availability', 'start_time': start + 1800, 'end_time': end}], response.json)
+
+        response = self.client.get(f'/api/calendar/2?start_time={start}&end_time={end}')
+        self.assertEqual([1], response.json[1]['participants'])
+
+    def test_meeting_with_oneself(self):
+        start, end = int(self.start_time), int(self.end_time)
+        response = self.client.post('/api/meeting', json={'user1_id': 1, 'user2_id': 1, 'meeting_start_time': end - 600,
+                                                          'meeting_end_time': end})
+        self.assertEqual(201, response.status_code)
+        response = self.client.get(f'/api/calendar/1?start_time={start}&end_time={end}')
+        self.assertEqual({'type': 'meeting', 'id': response.json[-1]['id'], 'start_time': end - 600, 'end_time': end,
+                          'participants': []}, response.json[-1])
+        response = self.client.get(f'/api/freebusy/1?start_time={start}&end_time={end}&format=ics')
+        self.assertEqual(2, response.data.decode().count('FBTYPE=BUSY'))
+
+    def test_range(self):
+        start, end = int(self.start_time), int(self.end_time)
+        # entries starting before the range are included when they reach into it
+        response = self.client.get(f'/api/calendar/1?start_time={start + 1200}&end_time={start + 2400}')
+        self.assertEqual(['meeting', 'availability'], [entry['type'] for entry in response.json])
+
+        response = self.client.get(f'/api/calendar/1?start_time={end}&end_time={end + 3600}')
+        self.assertEqual([], response.json)
+
+        response = self.client.get(f'/api/calendar/1?start_time={end}&end_time={start}')
+        self.assertEqual(400, response.status_code)
+        response = self.client.get(f'/api/calendar/1?start_time={start}&end_time={start + 400 * 86400}')
+        self.assertEqual(400, response.status_code)
+        response = self.client.get('/api/calendar/1')
+        self.assertEqual(400, response.status_code)
+
+
+class TestFreeBusy(CalendarTestCase):
+
+    def test_ndjson(self):
+        start, end = int(self.start_time), int(self.end_time)
+        response = self.client.get(f'/api/freebusy/1?start_time={start}&end_time={end}')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('application/x-ndjson', response.mimetype)
+        entries = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual(self.client.get(f'/api/calendar/1?start_time={start}&end_time={end}').json, entries)
+
+    def test_ics(self):
+        start, end = int(self.start_time), int(self.end_time)
+        response = self.client.get(f'/api/freebusy/1?start_time={start + 1200}&end_time={end}&format=ics')
+        self.assertEqual('text/calendar', response.mimetype)
+        lines = response.data.decode().split('\r\n')
+
+        def ics(timestamp):
+            return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+        self.assertEqual(['BEGIN:VCALENDAR', 'BEGIN:VFREEBUSY'], [line for line in lines if line.startswith('BEGIN')])
+        self.assertIn(f'DTSTART:{ics(start + 1200)}', lines)
+        # the meeting starting before the range is clipped to it
+        self.assertEqual([f'FREEBUSY;FBTYPE=BUSY:{ics(start + 1200)}/{ics(start + 1800)}',
+                          f'FREEBUSY;FBTYPE=FREE:{ics(start + 1800)}/{ics(end)}'],
+                         [line for line in lines if line.startswith('FREEBUSY')])
+        self.assertEqual(['END:VFREEBUSY', 'END:VCALENDAR', ''], lines[-3:])
+
+    def test_batches(self):
+        start, end = int(self.start_time), int(self.end_time)
+        with self.app.app_context():
+            batches = list(services.iter_calendar(1, start, end, batch_size=2))
+        self.assertEqual([2, 1], [len(batch) for batch in batches])
+        self.assertEqual(['availability', 'meeting', 'availability'], [entry['type'] for batch in batches
+                                                                        for entry in batch])
+
+    def test_invalid_arguments(self):
+        start, end = int(self.start_time), int(self.end_time)
+        response = self.client.get(f'/api/freebusy/1?start_time={end}&end_time={start}')
+        self.assertEqual(400, response.status_code)
+        response = self.client.get(f'/api/freebusy/1?start_time={start}&end_time={end}&format=xml')
+        self.assertEqual(400, response.status_code)
+        response = self.client.get('/api/freebusy/1')
+        self.assertEqual(400, response.status_code)
+
+
+class TestCompaction(BaseAPITestCase):
+
+    def _add_slots(self, user_id, slots):
+        with self.app.app_context():
+            db.session.add_all([Availability(user_id=user_id, start_time=start, end_time=end) for start, end in slots])
+            db.session.commit()
+
+    def test_expired_slots_are_removed_in_batches(self):
+        now = int(self.start_time)
+        self._add_slots(1, [(now - 7200 * hour, now - 7200 * hour + 3600) for hour in range(1, 6)])
+        self._add_slots(1, [(now - 1800, now + 1800), (now + 3600, now + 7200)])
+        # cached before the compaction, the purge must expire it
+        self.assertEqual(7, len(self.client.get('/api/availability/1').json))
+
+        with self.app.app_context():
+            report = compaction.compact(now, batch_size=2)
+        self.assertEqual({'availabilities': 5, 'availability_exceptions': 0}, report['removed'])
+        self.assertEqual([{'start_time': now - 1800, 'end_time': now + 1800},
+                          {'start_time': now + 3600, 'end_time': now + 7200}],
+                         self.client.get('/api/availability/1').json)
+
+        metrics = self.client.get('/metrics').data.decode()
+        self.assertIn('compaction_rows_total{table="availabilities",action="removed"}', metrics)
+
+    def test_archive(self):
+        now = int(self.start_time)
+        self._add_slots(2, [(now - 7200, now - 3600)])
+
+        with self.app.app_context():
+            report = compaction.compact(now, archive=True)
+            archived = db.session.query(ArchivedAvailability.user_id, ArchivedAvailability.start_time,
+                                        ArchivedAvailability.end_time).all()
+        self.assertEqual(1, report['removed']['availabilities'])
+        self.assertEqual([(2, now - 7200, now - 3600)], archived)
+        if os.environ.get('DATABASE_URL', '').startswith('postgres'):
+            self.assertIn('availabilities', report['index_bytes']['after'])
+
+    @unittest.skipUnless(os.environ.get('DATABASE_URL', '').startswith('postgres'), "coalescing needs Postgres")
+    def test_fragmented_slots(self):
+        now = int(self.start_time)
+        # left fragmented by writes before they merged bridging slots
+        self._add_slots(1, [(now, now + 1200), (now + 600, now + 1800), (now + 1800, now + 2400)])
+        self._add_slots(2, [(now, now + 600), (now + 1200, now + 1800)])
+        self.assertEqual(3, len(self.client.get('/api/availability/1').json))
+
+        with self.app.app_context():
+            self.assertEqual(2, compaction.compact(now)['fragmented_slots'])
+            self.assertIn('availability_fragmented_slots 2', self.client.get('/metrics').data.decode())
+
+        # the release migration only coalesces, expired slots stay until the scheduled compaction
+        self._add_slots(2, [(now - 7200, now - 3600)])
+        with self.app.app_context():
+            report = compaction.compact(now, coalesce=True, purge=False)
+            expired = Availability.query.filter(Availability.end_time <= now).count()
+        self.assertEqual((2, 0, {}), (report['coalesced'], report['fragmented_slots'], report['removed']))
+        self.assertEqual(1, expired)
+        self.assertEqual([{'start_time': now, 'end_time': now + 2400}], self.client.get('/api/availability/1').json)
+        self.assertEqual(3, len(self.client.get('/api/availability/2').json))
+
+
+@unittest.skipUnless(os.environ.get('DATABASE_URL', '').startswith('postgres'), "partitioning needs Postgres")
+class TestMeetingPartitions(BaseAPITestCase):
+
+    def test_migrate_extend_detach_rollback(self):
+        def meeting_tables():
+            return {name: count for name, count in db.session.execute(db.text(
+                "SELECT tableoid::regclass::text, count(*) FROM meetings GROUP BY 1"))}
+
+        start, end = int(self.start_time), int(self.end_time)
+        with self.app.app_context():
+            db.session.add_all([Meeting(user1_id=1, user2_id=2, meeting_time=start - 400 * 86400),
+                                Meeting(user1_id=1, user2_id=2, meeting_time=start)])
+            db.session.commit()
+
+            partitioning.migrate(months_ahead=1)
+            self.assertTrue(partitioning.is_partitioned())
+            month = f"meetings_{datetime.fromtimestamp(start - 400 * 86400, timezone.utc):%Y_%m}"
+            self.assertEqual(1, meeting_tables()[month])
+
+            # months beyond the partitions land in the default one until they get their own
+            db.session.add(Meeting(user1_id=1, user2_id=2, meeting_time=start + 60))
+            db.session.commit()
+            self.assertEqual(2, meeting_tables().get('meetings_default'))
+            partitioning.create_partitions(start, start + 1)
+            self.assertEqual({month: 1, f"meetings_{datetime.fromtimestamp(start, timezone.utc):%Y_%m}": 2},
+                             meeting_tables())
+
+            detached = partitioning.detach(start - 200 * 86400, drop=True)
+            self.assertIn(month, detached)
+            self.assertEqual(2, db.session.query(Meeting).count())
+
+            partitioning.rollback()
+            self.assertFalse(partitioning.is_partitioned())
+            db.session.add(Meeting(user1_id=1, user2_id=2, meeting_time=start + 120))
+            db.session.commit()
+            self.assertEqual(3, db.session.query(Meeting).count())
+
+
+@unittest.skipUnless(os.environ.get('TEST_REPLICA_DATABASE_URL'), "needs a second database as the replica")
+class TestReadReplica(BaseAPITestCase):
+    """
+    The database in TEST_REPLICA_DATABASE_URL stands in for the replica. Nothing replicates to it but replicate(), so
+    the tests see which database a read went to.
+    """
+
+    def setUp(self):
+        os.environ['DATABASE_REPLICA_URL'] = os.environ['TEST_REPLICA_DATABASE_URL']
+        super().setUp()
+        # reads have to reach a database
+        configure_cache({'CACHE_BACKEND': 'none'})
+        with self.app.app_context():
+            db.metadata.drop_all(db.engines['replica'])
+            db.metadata.create_all(db.engines['replica'])
+
+    def tearDown(self):
+        del os.environ['DATABASE_REPLICA_URL']
+        configure_cache(self.app.config)
+        replica.configure_replica(self.app.config)
+        with self.app.app_context():
+            db.session.remove()
+            db.metadata.drop_all(db.engines['replica'])
+        super().tearDown()
+
+    def replicate(self):
+        with self.app.app_context(), db.engines['replica'].begin() as connection:
+            for table in reversed(db.metadata.sorted_tables):
+                connection.execute(table.delete())
+            for table in db.metadata.sorted_tables:
+                rows = [row._asdict() for row in db.session.execute(table.select())]
+                if rows:
+                    connection.execute(table.insert(), rows)
+
+    def test_reads_go_to_the_replica(self):
+        self.assertEqual([], self.client.get('/api/admin/users').json)
+        self.replicate()
+        self.assertEqual(['User1', 'User2'], [user['name'] for user in self.client.get('/api/admin/users').json])
+
+    def test_read_your_writes(self):
+        slot = {'start_time': int(self.start_time), 'end_time': int(self.end_time)}
+        response = self.client.post('/api/availability/1', json=slot)
+        self.assertEqual(201, response.status_code)
+
+        # not replicated yet, reads of the written user stay on the primary for the window
+        self.assertEqual([slot], self.client.get('/api/availability/1').json)
+        self.assertEqual([slot], self.client.get('/api/overlap?user1_id=1&user2_id=1').json)
+        self.assertEqual([], self.client.get('/api/availability/2').json)
+
+        # past the window, the replica's lagging copy is read
+        replica.configure_replica({'READ_YOUR_WRITES_SECONDS': 0})
+        self.assertEqual([], self.client.get('/api/availability/1').json)
+        response = self.client.get(f'/api/freebusy/1?start_time={slot["start_time"]}&end_time={slot["end_time"]}')
+        self.assertEqual(b'', response.data)
+        self.replicate()
+        self.assertEqual([slot], self.client.get('/api/availability/1').json)
+
+    def test_metrics(self):
+        self.client.get('/api/admin/users')
+        metrics = self.client.get('/metrics').data.decode()
+        self.assertIn('db_pool_connections{bind="replica",state="idle"}', metrics)
+        self.assertIn('db_pool_checkout_wait_seconds_count{bind="replica"}', metrics)
+        self.assertRegex(metrics, r'db_reads_total{bind="replica"} [1-9]')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,326 @@
+import json
+import os
+import subprocess
+import sys
+import time
+import unittest
+from datetime import datetime
+
+from sqlalchemy import event, func, insert, select, text
+
+from app import create_app
+from src import services, sharding
+from src.cache import configure_cache
+from src.models import Availability, AvailabilityRule, Meeting, MeetingParticipant, User, UserShard, db
+
+SHARD_URLS = [url for url in os.environ.get('TEST_SHARD_DATABASE_URLS', '').split(',') if url]
+# users 1 and 2 on shard 0, 3 on shard 1 and 4 on shard 2
+PLACEMENT = {1: 0, 2: 0, 3: 1, 4: 2}
+
+DAY = 86400
+START = int(datetime.fromisoformat('2025-01-01T00:00:00').timestamp())
+
+
+@unittest.skipUnless(len(SHARD_URLS) == 3, "TEST_SHARD_DATABASE_URLS takes three Postgres databases, on servers with "
+                                           "max_prepared_transactions > 0")
+class TestSharding(unittest.TestCase):
+    """ The databases in TEST_SHARD_DATABASE_URLS are shards 0, 1 and 2, the users are placed as in PLACEMENT. """
+
+    def setUp(self):
+        self.environ = {name: os.environ.get(name) for name in ('DATABASE_URL', 'DATABASE_SHARD_URLS')}
+        os.environ['DATABASE_URL'], os.environ['DATABASE_SHARD_URLS'] = SHARD_URLS[0], ','.join(SHARD_URLS[1:])
+        self.app = create_app()
+        self.client = self.app.test_client()
+        self.app.config['TESTING'] = True
+        # reads have to reach a database
+        configure_cache({'CACHE_BACKEND': 'none'})
+
+        with self.app.app_context():
+            for shard in range(3):
+                db.metadata.drop_all(sharding.engine(shard))
+                db.metadata.create_all(sharding.engine(shard))
+            sharding.init_shards()
+            for user_id, shard in PLACEMENT.items():
+                with sharding.engine(shard).begin() as connection:
+                    connection.execute(insert(User), {'id': user_id, 'name': f"User{user_id}"})
+            with sharding.engine(0).begin() as connection:
+                connection.execute(insert(UserShard), [{'user_id': user_id, 'shard': shard}
+                                                       for user_id, shard in PLACEMENT.items() if shard])
+
+    def tearDown(self):
+        configure_cache(self.app.config)
+        with self.app.app_context():
+            db.session.remove()
+            # prepared transactions left by a failed test would hold their locks
+            sharding.recover(grace=0)
+            for shard in range(3):
+                db.metadata.drop_all(sharding.engine(shard))
+        for name, value in self.environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+    def rows(self, shard: int, query) -> list:
+        with self.app.app_context(), sharding.engine(shard).connect() as connection:
+            return [tuple(row) for row in connection.execute(query)]
+
+    def slots(self, shard: int, user_id: int) -> list:
+        return self.rows(shard, select(Availability.start_time, Availability.end_time).where(
+            Availability.user_id == user_id).order_by(Availability.start_time))
+
+    def set_slot(self, user_id: int, start: int, end: int):
+        response = self.client.post(f'/api/availability/{user_id}', json={'start_time': start, 'end_time': end})
+        self.assertEqual(201, response.status_code, response.json)
+
+    def test_users_across_shards(self):
+        self.assertEqual([1, 2, 3, 4], [user['id'] for user in self.client.get('/api/admin/users').json])
+
+        response = self.client.get('/api/admin/users?limit=2&after_id=1')
+        self.assertEqual([2, 3], [user['id'] for user in response.json])
+        self.assertEqual('3', response.headers['X-Next-Cursor'])
+
+        response = self.client.get('/api/admin/users?stream=true')
+        self.assertEqual([1, 2, 3, 4], [user['id'] for user in json.loads(response.data)])
+        with self.app.app_context():
+            self.assertEqual([1, 2, 3, 4], [user.id for user in services.get_all_users()])
+
+    def test_writes_go_to_the_users_shard(self):
+        self.set_slot(3, START, START + 3600)
+        self.assertEqual([(START, START + 3600)], self.slots(1, 3))
+        self.assertEqual([], self.slots(0, 3))
+        self.assertEqual([{'start_time': START, 'end_time': START + 3600}],
+                         self.client.get('/api/availability/3').json)
+
+        self.assertEqual(404, self.client.post('/api/availability/5', json={'start_time': START,
+                                                                           'end_time': START + 3600}).status_code)
+
+    def test_overlap_across_shards(self):
+        self.set_slot(1, START, START + 4 * 3600)
+        self.set_slot(3, START + 3600, START + 6 * 3600)
+        self.set_slot(4, START + 2 * 3600, START + 8 * 3600)
+
+        response = self.client.get('/api/overlap?user1_id=1&user2_id=3')
+        self.assertEqual([{'start_time': START + 3600, 'end_time': START + 4 * 3600}], response.json)
+        response = self.client.get(f'/api/overlap?user1_id=3&user2_id=1&start_time={START + 2 * 3600}&limit=1')
+        self.assertEqual([{'start_time': START + 2 * 3600, 'end_time': START + 4 * 3600}], response.json)
+
+        response = self.client.get('/api/overlap/group?user_ids=1&user_ids=3&user_ids=4')
+        self.assertEqual([{'start_time': START + 2 * 3600, 'end_time': START + 4 * 3600}], response.json)
+        response = self.client.get('/api/overlap/group?user_ids=1&user_ids=2&user_ids=3')
+        self.assertEqual([], response.json)
+
+        response = self.client.get(f'/api/suggestions?user_ids=1&user_ids=3&user_ids=4&duration=1800&step=1800'
+                                   f'&start_time={START}&k=3')
+        self.assertEqual([START + 2 * 3600, START + 2 * 3600 + 1800, START + 3 * 3600],
+                         [suggestion['start_time'] for suggestion in response.json])
+
+    def test_meeting_across_shards(self):
+        self.set_slot(1, START, START + 4 * 3600)
+        self.set_slot(3, START, START + 4 * 3600)
+        meeting = {'user1_id': 1, 'user2_id': 3, 'meeting_start_time': START + 3600,
+                   'meeting_end_time': START + 2 * 3600}
+        self.assertEqual(201, self.client.post('/api/meeting', json=meeting).status_code)
+
+        # the meeting is on both shards with the same id, from shard 0's series
+        meetings = select(Meeting.id, Meeting.user1_id, Meeting.user2_id)
+        participants = select(MeetingParticipant.meeting_id, MeetingParticipant.user_id).order_by(
+            MeetingParticipant.user_id)
+        for shard in (0, 1):
+            self.assertEqual([(1, 1, 3)], self.rows(shard, meetings))
+            self.assertEqual([(1, 1), (1, 3)], self.rows(shard, participants))
+        split = [(START, START + 3600), (START + 2 * 3600, START + 4 * 3600)]
+        self.assertEqual(split, self.slots(0, 1))
+        self.assertEqual(split, self.slots(1, 3))
+
+        calendar = self.client.get(f'/api/calendar/3?start_time={START}&end_time={START + DAY}').json
+        self.assertEqual([{'type': 'meeting', 'id': 1, 'start_time': START + 3600, 'end_time': START + 2 * 3600,
+                           'participants': [1]}], [entry for entry in calendar if entry['type'] == 'meeting'])
+
+        # booked already on both shards, and user 4 has no availability: both roll back
+        self.assertEqual(400, self.client.post('/api/meeting', json=meeting).status_code)
+        meeting.update(user2_id=4, meeting_start_time=START + 2 * 3600, meeting_end_time=START + 3 * 3600)
+        self.assertEqual(400, self.client.post('/api/meeting', json=meeting).status_code)
+        self.assertEqual(split, self.slots(0, 1))
+        self.assertEqual([(1,)], self.rows(0, select(Meeting.id)))
+        self.assertEqual([], self.rows(0, text("SELECT gid FROM pg_prepared_xacts")))
+        self.assertEqual(404, self.client.post('/api/meeting', json=dict(meeting, user2_id=5)).status_code)
+
+    def test_bulk_across_shards(self):
+        slots = [{'user_id': user_id, 'start_time': START, 'end_time': START + 4 * 3600} for user_id in (1, 2, 3, 4)]
+        response = self.client.post('/api/availability/bulk', json={'slots': slots + [{'user_id': 5}, {
+            'user_id': 5, 'start_time': START, 'end_time': START + 3600}]})
+        self.assertEqual(['created'] * 4 + ['error', 'error'],
+                         [result['status'] for result in response.json['results']])
+        self.assertEqual(list(range(6)), [result['index'] for result in response.json['results']])
+        self.assertEqual([(START, START + 4 * 3600)], self.slots(2, 4))
+
+        meetings = [{'user1_id': 1, 'user2_id': 3, 'meeting_start_time': START, 'meeting_end_time': START + 3600},
+                    {'user1_id': 1, 'user2_id': 2, 'meeting_start_time': START + 3600,
+                     'meeting_end_time': START + 2 * 3600},
+                    {'user1_id': 3, 'user2_id': 4, 'meeting_start_time': START, 'meeting_end_time': START + 3600},
+                    {'user1_id': 1}]
+        results = self.client.post('/api/meeting/bulk', json={'meetings': meetings}).json['results']
+        self.assertEqual(['scheduled', 'scheduled', 'error', 'error'], [result['status'] for result in results])
+        self.assertEqual(len({results[0]['id'], results[1]['id']}), 2)
+        self.assertEqual([(START + 2 * 3600, START + 4 * 3600)], self.slots(0, 1))
+
+    def test_recover(self):
+        with self.app.app_context():
+            def add_slot(user_id):
+                return lambda: db.session.add(Availability(user_id=user_id, start_time=START, end_time=START + 60))
+
+            # the coordinator dies after the first shard committed: the others are committed
+            with sharding.TwoPhaseCommit([0, 1]) as transaction:
+                transaction.run_all({0: add_slot(1), 1: add_slot(3)})
+                transaction.prepare()
+                first = transaction.participants[0]
+                first.call(first.commit)
+                transaction.abandon()
+
+            # and before any commit: all are rolled back
+            with sharding.TwoPhaseCommit([0, 2]) as transaction:
+                transaction.run_all({0: add_slot(2), 2: add_slot(4)})
+                transaction.prepare()
+                transaction.abandon()
+
+            self.assertEqual(3, len(self.rows(0, text("SELECT gid FROM pg_prepared_xacts"))))
+            self.assertEqual({}, sharding.recover(grace=3600))
+            self.assertEqual({'committed': 1, 'rolled_back': 2}, sharding.recover(grace=0))
+
+        self.assertEqual([], self.rows(0, text("SELECT gid FROM pg_prepared_xacts")))
+        self.assertEqual([(START, START + 60)], self.slots(0, 1))
+        self.assertEqual([(START, START + 60)], self.slots(1, 3))
+        self.assertEqual([], self.slots(0, 2))
+        self.assertEqual([], self.slots(2, 4))
+
+    def test_move_user(self):
+        self.set_slot(3, START, START + 4 * 3600)
+        rule = {'weekdays': [0], 'start_offset': 9 * 3600, 'end_offset': 10 * 3600, 'valid_from': START}
+        self.assertEqual(201, self.client.post('/api/availability/3/rules', json=rule).status_code)
+        self.set_slot(1, START, START + 4 * 3600)
+        self.set_slot(4, START, START + 4 * 3600)
+        for other, hour in ((1, 0), (4, 1)):
+            meeting = {'user1_id': 3, 'user2_id': other, 'meeting_start_time': START + hour * 3600,
+                       'meeting_end_time': START + (hour + 1) * 3600}
+            self.assertEqual(201, self.client.post('/api/meeting', json=meeting).status_code)
+        calendar = self.client.get(f'/api/calendar/3?start_time={START}&end_time={START + DAY}').json
+
+        with self.app.app_context():
+            self.assertTrue(sharding.move_user(3, 0))
+            self.assertFalse(sharding.move_user(3, 0))
+            with self.assertRaises(services.UserNotFoundError):
+                sharding.move_user(5, 1)
+
+        # nothing of user 3 is left on shard 1, the meetings are on the shards of both their users
+        for model in (User, Availability, AvailabilityRule, Meeting, MeetingParticipant):
+            self.assertEqual([(0,)], self.rows(1, select(func.count()).select_from(model)))
+        self.assertEqual([(START + 2 * 3600, START + 4 * 3600)], self.slots(0, 3))
+        self.assertEqual(2, len(self.rows(0, select(Meeting.id))))
+        self.assertEqual(1, len(self.rows(2, select(Meeting.id))))
+        self.assertEqual([(3, 0)], self.rows(0, select(UserShard.user_id, UserShard.shard).where(
+            UserShard.user_id == 3)))
+        self.assertEqual(calendar, self.client.get(f'/api/calendar/3?start_time={START}&end_time={START + DAY}').json)
+        self.assertEqual(1, len(self.client.get('/api/availability/3/rules').json))
+
+    def test_moved_user_is_routed_again(self):
+        self.client.get('/api/availability/3')
+        with self.app.app_context():
+            sharding.move_user(3, 2)
+        # as in a worker that cached the shard before the move
+        sharding.directory._shards[3] = (1, time.monotonic() + 60)
+
+        self.set_slot(3, START, START + 3600)
+        self.assertEqual([(START, START + 3600)], self.slots(2, 3))
+
+    def test_stale_reads_are_routed_again(self):
+        configure_cache({'CACHE_BACKEND': 'memory'})
+        self.set_slot(3, START, START + 3600)
+        self.set_slot(4, START, START + 3600)
+        with self.app.app_context():
+            sharding.move_user(3, 2)
+        overlap = [{'start_time': START, 'end_time': START + 3600}]
+
+        for path in ('/api/availability/3', '/api/overlap?user1_id=3&user2_id=4', '/api/overlap?user1_id=1&user2_id=3',
+                     f'/api/freebusy/3?start_time={START}&end_time={START + DAY}'):
+            with self.subTest(path=path):
+                # as in a worker that cached the shard before the move, the read finds nothing on shard 1
+                sharding.directory._shards[3] = (1, time.monotonic() + 60)
+                response = self.client.get(path)
+                self.assertEqual(200, response.status_code)
+                self.assertEqual(path.startswith('/api/overlap?user1_id=1'), not response.data.strip(b'[]\n'))
+                # and it was not cached either
+                self.assertEqual(response.data, self.client.get(path).data)
+        self.assertEqual(overlap, self.client.get('/api/availability/3').json)
+
+    def test_stale_bulk_writes_are_routed_again(self):
+        slots = [{'user_id': 3, 'start_time': START, 'end_time': START + 3600},
+                 {'user_id': 5, 'start_time': START, 'end_time': START + 3600}]
+        meetings = [{'user1_id': 3, 'user2_id': 4, 'meeting_start_time': START, 'meeting_end_time': START + 600}]
+        self.set_slot(4, START, START + 3600)
+        with self.app.app_context():
+            sharding.move_user(3, 2)
+
+        sharding.directory._shards[3] = (1, time.monotonic() + 60)
+        results = self.client.post('/api/availability/bulk', json={'slots': slots}).json['results']
+        self.assertEqual([{'index': 0, 'status': 'created'},
+                          {'index': 1, 'status': 'error', 'error': 'User does not exist'}], results)
+        self.assertEqual([(START, START + 3600)], self.slots(2, 3))
+
+        sharding.directory._shards[3] = (1, time.monotonic() + 60)
+        results = self.client.post('/api/meeting/bulk', json={'meetings': meetings}).json['results']
+        self.assertEqual('scheduled', results[0]['status'], results)
+        self.assertEqual(1, len(self.rows(2, select(Meeting.id))))
+
+    def test_rebalance(self):
+        with self.app.app_context(), sharding.engine(0).begin() as connection:
+            connection.execute(insert(User), [{'id': user_id, 'name': f"User{user_id}"} for user_id in range(5, 9)])
+        with self.app.app_context():
+            self.assertEqual({0: 6, 1: 1, 2: 1}, sharding.user_counts())
+            moves = sharding.rebalance(dry_run=True)
+            self.assertEqual({0: 6, 1: 1, 2: 1}, sharding.user_counts())
+            self.assertEqual(moves, sharding.rebalance())
+            self.assertEqual({0: 3, 1: 3, 2: 2}, sharding.user_counts())
+        self.assertEqual([(8, 0, 1), (7, 0, 2), (6, 0, 1)], moves)
+        self.assertEqual(list(range(1, 9)), [user['id'] for user in self.client.get('/api/admin/users').json])
+
+    def test_metrics(self):
+        statements = []
+
+        def executed(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engines = {sharding.engine(shard) for shard in range(3)}
+        for engine in engines:
+            event.listen(engine, 'after_cursor_execute', executed)
+            self.addCleanup(event.remove, engine, 'after_cursor_execute', executed)
+        self.client.get('/api/overlap?user1_id=1&user2_id=3')
+        # the reads run on each shard's thread are counted for the request
+        self.assertEqual(len(statements), self.app.extensions['metrics'].statements['/api/overlap'].sum)
+        metrics = self.client.get('/metrics').data.decode()
+        self.assertIn('db_cross_shard_reads_total', metrics)
+        self.assertIn('db_two_phase_commits_total{outcome="committed"}', metrics)
+        self.assertIn('db_pool_connections{bind="shard2",state="idle"}', metrics)
+
+
+class TestSingleDatabaseEntryPoints(unittest.TestCase):
+    """ The entry points without shard routing refuse to run with DATABASE_SHARD_URLS set. """
+
+    def test_asgi_refuses_shards(self):
+        environ = dict(os.environ, DATABASE_SHARD_URLS='postgresql://localhost/shard1')
+        result = subprocess.run([sys.executable, '-c', 'import asgi'], env=environ, capture_output=True, text=True)
+        self.assertNotEqual(0, result.returncode)
+        self.assertIn("the ASGI app reads a single database", result.stderr)
+
+    def test_seed_refuses_shards(self):
+        import seed
+
+        app = create_app()
+        app.config['SHARDS'] = 2
+        with app.app_context(), self.assertRaisesRegex(RuntimeError, "python -m src.sharding rebalance"):
+            seed.prepare_database(app)
+
+
+if __name__ == '__main__':
+    unittest.main()